@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Measures irc.ConnectionPool memory and CPU usage per joined channel.
+
+A local fake Twitch server answers JOINs with a NAMES list and sends chat
+traffic to every joined channel. Once all channels are joined, the CPU time
+of the bot thread and the memory allocated by lib/irc.py are measured over a
+period of chat traffic. Finally one connection is dropped by the server to
+measure how long it takes the pool to move its channels to other connections.
+
+Usage: python3 bench/connection_pool.py [--channels 500] [--per-connection 50]
+"""
+
+import argparse
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import irc
+
+_PRIVMSG = ('@badges=subscriber/12;color=#1E90FF;display-name=User%(user)d;'
+            'mod=0;subscriber=1;user-type= '
+            ':user%(user)d!user%(user)d@user%(user)d.tmi.twitch.tv '
+            'PRIVMSG %(chan)s :message number %(idx)d\r\n')
+
+
+class _FakeServer(threading.Thread):
+    """Bare bones Twitch IRC server."""
+
+    def __init__(self, users_per_channel, messages_per_second):
+        super().__init__(daemon=True)
+        self._users_per_channel = users_per_channel
+        self._messages_per_second = messages_per_second
+        self._server = socket.socket()
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(100)
+        self._server.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        # Client socket -> list of channels it joined.
+        self._clients = {}
+        self._drop_one = False
+
+    def GetAddress(self):
+        return self._server.getsockname()
+
+    def DropOneConnection(self):
+        with self._lock:
+            self._drop_one = True
+
+    def _HandleLine(self, client, line):
+        if not line.startswith('JOIN '):
+            return
+        chan = line[5:]
+        self._clients[client].append(chan)
+        names = ' '.join('user%d' % i for i in range(self._users_per_channel))
+        client.sendall((':benchbot!benchbot@benchbot JOIN %s\r\n'
+                        ':tmi 353 benchbot = %s :%s\r\n'
+                        ':tmi 366 benchbot %s :End of /NAMES list\r\n' %
+                        (chan, chan, names, chan)).encode('utf-8'))
+
+    def _SendTraffic(self, idx):
+        for client, channels in self._clients.items():
+            if not channels:
+                continue
+            chan = channels[idx % len(channels)]
+            client.sendall((_PRIVMSG % {
+                'user': idx % self._users_per_channel,
+                'chan': chan,
+                'idx': idx}).encode('utf-8'))
+
+    def run(self):
+        buffers = {}
+        idx = 0
+        next_message = time.time()
+        while True:
+            for key, _ in self._selector.select(timeout=0.001):
+                if key.fileobj is self._server:
+                    client, _ = self._server.accept()
+                    self._selector.register(client, selectors.EVENT_READ)
+                    self._clients[client] = []
+                    buffers[client] = b''
+                    continue
+                client = key.fileobj
+                data = client.recv(65536)
+                if not data:
+                    self._selector.unregister(client)
+                    del self._clients[client]
+                    continue
+                *lines, buffers[client] = (buffers[client] + data).split(
+                    b'\r\n')
+                for line in lines:
+                    self._HandleLine(client, line.decode('utf-8'))
+            with self._lock:
+                if self._drop_one and self._clients:
+                    client = next(iter(self._clients))
+                    self._selector.unregister(client)
+                    del self._clients[client]
+                    client.close()
+                    self._drop_one = False
+            now = time.time()
+            while next_message <= now:
+                self._SendTraffic(idx)
+                idx += 1
+                next_message += 1 / self._messages_per_second
+
+
+def _Pump(pool, handler, duration, done=None):
+    """Run the pool like irc.Client, returns the number of lines handled."""
+    end_time = time.time() + duration
+    count = 0
+    while time.time() < end_time:
+        for line in pool.ReadLines(0.05):
+            msg = irc.Message()
+            if msg.Parse(line):
+                handler.HandleMessage(msg)
+            count += 1
+        if done and done():
+            break
+    return count
+
+
+def _AllUserlistsKnown(pool, channels):
+    return all(pool.GetUserList(chan) for chan in channels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=500)
+    parser.add_argument('--per-connection', type=int, default=50)
+    parser.add_argument('--users', type=int, default=20,
+                        help='users listed in each channel')
+    parser.add_argument('--rate', type=int, default=50,
+                        help='chat messages per second on each connection')
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    server = _FakeServer(args.users, args.rate)
+    server.start()
+
+    tracemalloc.start()
+    channels = ['#chan%d' % i for i in range(args.channels)]
+    pool = irc.ConnectionPool(
+        args.per_connection,
+        rate_limits=irc.RateLimits(message_rate=1000, join_rate=100000,
+                                   join_period=1))
+    handler = irc.CoreHandler(pool)
+    start = time.perf_counter()
+    pool.Connect(*server.GetAddress(), 'benchbot', channels=channels)
+    _Pump(pool, handler, 60, lambda: _AllUserlistsKnown(pool, channels))
+    print('joined %d channels on %d connections in %.3fs' %
+          (args.channels, len(pool._shards), time.perf_counter() - start))
+
+    cpu_start = time.thread_time()
+    lines = _Pump(pool, handler, args.duration)
+    cpu = time.thread_time() - cpu_start
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, irc.__file__)])
+    memory = sum(stat.size for stat in snapshot.statistics('filename'))
+    print('%d lines in %.1fs, CPU %.1f%% (%.3f%% per channel)' %
+          (lines, args.duration, 100 * cpu / args.duration,
+           100 * cpu / args.duration / args.channels))
+    print('lib/irc.py memory %.1f KiB (%.2f KiB per channel)' %
+          (memory / 1024, memory / 1024 / args.channels))
+
+    moved = [chan for chan in channels
+             if pool._channel_shards[chan] is pool._shards[0]]
+    server.DropOneConnection()
+    start = time.perf_counter()
+    _Pump(pool, handler, 60,
+          lambda: all(chan in pool.channels and
+                      not pool._channel_shards[chan].IsClosed()
+                      for chan in moved) and len(pool._shards) > 0 and
+                  all(not shard.IsClosed() for shard in pool._shards))
+    print('moved %d channels of a dropped connection in %.3fs' %
+          (len(moved), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
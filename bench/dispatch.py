@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of dispatching messages through a chain of plugins.
+
+By default each of the plugins owns one chat command ("!cmd<N>"), with
+--catch-all they instead look at every PRIVMSG but never handle it. The
+dispatched messages are a mix of PRIVMSGs, some of them commands, and
+commands none of the plugins handle (CLEARCHAT, USERNOTICE, numerics).
+
+Checks first that chat commands reach their plugin however they're typed:
+multi-word, after the bot nickname or in another case.
+
+Usage: python3 bench/dispatch.py [--plugins 10] [--catch-all]
+                                 [--messages 200000]
+"""
+
+import argparse
+import configparser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import irc
+from plugins import chain
+
+_LINES = (
+    ':viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #gogcom :hello',
+    ':viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #gogcom :!cmd3 some args',
+    ':tmi.twitch.tv CLEARCHAT #gogcom :viewer',
+    ':viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #gogcom :!unknown',
+    ':tmi.twitch.tv USERNOTICE #gogcom :resub',
+    ':tmi.twitch.tv 372 gogbot :You are in a maze of twisty passages.',
+    ':tmi.twitch.tv ROOMSTATE #gogcom',
+)
+
+
+class _CommandPlugin(irc.HandlerBase):
+    """Plugin that owns one chat command but never handles it."""
+
+    def __init__(self, conn, index):
+        super().__init__(conn)
+        self._command = '!cmd%d' % index
+
+    def ChatCommands(self):
+        return (self._command,)
+
+    def HandleChat(self, chat):
+        return False
+
+
+class _CatchAllPlugin(irc.HandlerBase):
+    """Plugin that looks at PRIVMSGs but never handles them."""
+
+    def HandlePRIVMSG(self, msg):
+        return False
+
+
+class _RecordingPlugin(irc.HandlerBase):
+    """Plugin recording the chat messages routed to it."""
+
+    def __init__(self, conn, commands):
+        super().__init__(conn)
+        self._commands = commands
+        self.texts = []
+
+    def ChatCommands(self):
+        return self._commands
+
+    def HandleChat(self, chat):
+        self.texts.append(chat.text)
+        return False
+
+
+# Commands declared by the routing check plugins, and messages each of them
+# must get.
+_ROUTES = (
+    (('!multi word',), ('!multi word', '!MULTI word')),
+    (('gogbot', '@gogbot:'), ('gogbot up', '@GogBot: up', 'gogbot: up',
+                             '@gogbot up', '@gogbot:\tup')),
+)
+
+
+class _Chain(chain.Handler):
+    plugin_count = 10
+    catch_all = False
+
+    routes = None
+
+    @classmethod
+    def _LoadPlugins(cls, plugins, conn, conf):
+        if cls.routes is not None:
+            return [_RecordingPlugin(conn, commands)
+                    for commands, _ in cls.routes]
+        if cls.catch_all:
+            return [_CatchAllPlugin(conn) for _ in range(cls.plugin_count)]
+        return [_CommandPlugin(conn, i) for i in range(cls.plugin_count)]
+
+
+def _CheckRoutes(config):
+    """Exits if a chat command doesn't reach the plugin owning it."""
+    _Chain.routes = _ROUTES
+    handler = _Chain(irc.Connection(), config)
+    _Chain.routes = None
+    plugins = handler._handlers[1:]
+    for plugin, (commands, texts) in zip(plugins, _ROUTES):
+        for text in texts:
+            handler.HandleMessage(irc.Message(
+                ':viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #gogcom :' +
+                text))
+        if plugin.texts != list(texts):
+            sys.exit('Plugin owning %r got %r instead of %r' %
+                     (commands, plugin.texts, list(texts)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--plugins', type=int, default=10)
+    parser.add_argument('--catch-all', action='store_true')
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    _Chain.plugin_count = args.plugins
+    _Chain.catch_all = args.catch_all
+    config = configparser.ConfigParser()
+    config.read_dict({'GENERAL': {'plugins': 'bench'}})
+    _CheckRoutes(config)
+    handler = _Chain(irc.Connection(), config)
+    messages = [irc.Message(_LINES[i % len(_LINES)])
+                for i in range(args.messages)]
+
+    start = time.perf_counter()
+    for msg in messages:
+        handler.HandleMessage(msg)
+    elapsed = time.perf_counter() - start
+    print('%d messages through %d %s plugins: %.0f msgs/s, %.2f us/msg' %
+          (args.messages, args.plugins,
+           'catch-all' if args.catch_all else 'command',
+           args.messages / elapsed, elapsed / args.messages * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Measures the sliding window used by the rate limiter.
+
+Feeds --rate chat messages per second, on a simulated clock, to the rate
+limiter message pool with a --window seconds window, doing what the rate
+limiter does for each message: count by sender, count by text, record.
+Senders are drawn from --senders users and a --unique-texts fraction of the
+messages have a text never seen before, the others repeat a few commands.
+The defaults flood the window with about a million distinct texts. Reports
+the time per message, the size of the window at the end and the memory it
+uses every --sample seconds of simulated time, which stays flat once the
+window is full. With --bucket-width the approximate, bucketed, pool is
+used. With --sketch-width texts are counted in a sketch of that many
+counters per row instead, which keeps memory flat however many distinct
+texts come.
+
+With --gcra the GCRA pool is measured instead, limiting each sender and
+each text to --rate-per-sender and --rate-per-text messages per --window
+seconds. Like the rate limiter, it only records the messages within limits.
+
+Usage: python3 bench/event_queue.py [--rate 20000] [--window 50]
+                                    [--bucket-width 1] [--sketch-width 16384]
+                                    [--gcra] [--sample 10]
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import clock as clock_lib
+from plugins import ratelimiter
+
+_COMMANDS = ('up', 'down', 'left', 'right', 'use', 'pass', 'help')
+
+
+def _Messages(args):
+    rng = random.Random(42)
+    for idx in range(int(args.rate * args.duration)):
+        sender = 'user%d' % rng.randrange(args.senders)
+        if rng.random() < args.unique_texts:
+            text = 'unique message %d' % idx
+        else:
+            text = rng.choice(_COMMANDS)
+        yield sender, text
+
+
+def _Sample(idx, args, samples):
+    """Appends (simulated seconds, traced bytes) to "samples", if given,
+    every --sample seconds of simulated time."""
+    if samples is not None and idx % int(args.rate * args.sample) == 0:
+        samples.append((idx / args.rate, tracemalloc.get_traced_memory()[0]))
+
+
+def _Run(messages, args, samples=None):
+    """Returns the message pool once all messages went through it and the
+    seconds it took."""
+    clock = clock_lib.VirtualClock(1000000.0)
+    pool = ratelimiter._NewMessagePool(args.window, args.bucket_width, clock,
+                                       args.sketch_width)
+    step = 1 / args.rate
+    start = time.perf_counter()
+    for idx, (sender, text) in enumerate(messages, 1):
+        clock.Advance(step)
+        pool.CountBySender(sender)
+        pool.CountByText(text)
+        pool.RecordMessage(ratelimiter._Message(sender, text, clock()))
+        _Sample(idx, args, samples)
+    return pool, time.perf_counter() - start
+
+
+def _RunGcra(messages, args, samples=None):
+    """Same as _Run() with the GCRA pool, also returns the number of
+    messages within limits."""
+    clock = clock_lib.VirtualClock(1000000.0)
+    pool = ratelimiter._GcraPool()
+    pool.SetLimits(args.window, args.rate_per_sender, args.rate_per_sender,
+                   args.rate_per_text, args.rate_per_text)
+    step = 1 / args.rate
+    passed = 0
+    start = time.perf_counter()
+    for idx, (sender, text) in enumerate(messages, 1):
+        clock.Advance(step)
+        now = clock()
+        if (pool.by_sender.Allows(sender, now) and
+            pool.by_text.Allows(text, now)):
+            pool.RecordMessage(ratelimiter._Message(sender, text, now))
+            passed += 1
+        _Sample(idx, args, samples)
+    return pool, passed, time.perf_counter() - start
+
+
+def _Trace(run, messages, args):
+    """Runs "run" again tracing allocations, which slows it down too much to
+    time. Returns its result, the memory samples and the memory used at the
+    end."""
+    samples = []
+    gc.collect()
+    tracemalloc.start()
+    result = run(messages, args, samples)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, samples, memory
+
+
+def _PrintMemory(samples, memory):
+    for seconds, used in samples:
+        print('%6ds: %.1f MiB' % (seconds, used / 2**20))
+    return '%.1f MiB' % (memory / 2**20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rate', type=int, default=20000,
+                        help='messages per second')
+    parser.add_argument('--window', type=int, default=50,
+                        help='sliding window length in seconds')
+    parser.add_argument('--duration', type=int, default=80,
+                        help='simulated seconds of chat')
+    parser.add_argument('--senders', type=int, default=5000)
+    parser.add_argument('--unique-texts', type=float, default=0.99)
+    parser.add_argument('--bucket-width', type=float, default=0,
+                        help='seconds per bucket, 0 to count exactly')
+    parser.add_argument('--sketch-width', type=int, default=0,
+                        help='counters per sketch row, 0 to count texts '
+                        'by key')
+    parser.add_argument('--gcra', action='store_true')
+    parser.add_argument('--rate-per-sender', type=int, default=5)
+    parser.add_argument('--rate-per-text', type=int, default=15)
+    parser.add_argument('--sample', type=float, default=10,
+                        help='simulated seconds between memory samples')
+    args = parser.parse_args()
+
+    messages = list(_Messages(args))
+    if args.gcra:
+        _MainGcra(messages, args)
+        return
+    pool, elapsed = _Run(messages, args)
+    del pool
+    (pool, _), samples, memory = _Trace(_Run, messages, args)
+
+    if args.sketch_width:
+        counting = '%dx4 sketch' % args.sketch_width
+    elif args.bucket_width:
+        counting = '%gs buckets' % args.bucket_width
+    else:
+        counting = 'exact'
+    print('%d messages at %d msgs/s over a %ds window, %s: %.2f us/msg' % (
+        len(messages), args.rate, args.window, counting,
+        elapsed / len(messages) * 1e6))
+    memory = _PrintMemory(samples, memory)
+    distinct = pool.CountKeys()
+    if distinct is None:
+        texts = 'top text %r (%d)' % pool.TopTexts(1)[0]
+    else:
+        texts = '%d distinct texts' % distinct
+    print('window: %d messages, %s, %s' % (pool.CountAll(), texts, memory))
+
+
+def _MainGcra(messages, args):
+    pool, passed, elapsed = _RunGcra(messages, args)
+    del pool
+    (pool, _, _), samples, memory = _Trace(_RunGcra, messages, args)
+
+    now = 1000000.0 + len(messages) / args.rate
+    print('%d messages at %d msgs/s, GCRA %d/%d per %ds: %.2f us/msg' % (
+        len(messages), args.rate, args.rate_per_sender, args.rate_per_text,
+        args.window, elapsed / len(messages) * 1e6))
+    memory = _PrintMemory(samples, memory)
+    print('%d passed, %d senders and %d texts tracked, %s' % (
+        passed, pool.by_sender.CountKeys(now), pool.by_text.CountKeys(now),
+        memory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Measures irc.Connection line framing throughput on a burst of chat lines.
+
+A local server accepts the bot connection and sends a burst of Twitch style
+PRIVMSG lines at once, the client then reads them all with ReadNextLine() or,
+with --batch, with ReadLines().
+
+Usage: python3 bench/irc_framing.py [--lines 50000] [--batch]
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import irc
+
+_LINE = ('@badge-info=;badges=subscriber/12,premium/1;color=#1E90FF;'
+         'display-name=Viewer%(idx)d;emotes=;flags=;id=%(idx)08x-0000;mod=0;'
+         'subscriber=1;tmi-sent-ts=1500000000000;turbo=0;user-id=%(idx)d;'
+         'user-type= :viewer%(idx)d!viewer%(idx)d@viewer%(idx)d.tmi.twitch.tv '
+         'PRIVMSG #gogcom :PogChamp hype train éè number %(idx)d\r\n')
+
+
+def _Serve(server, lines, done):
+    conn, _ = server.accept()
+    conn.sendall(''.join(_LINE % {'idx': i} for i in range(lines))
+                 .encode('utf-8'))
+    # Keep the connection open until the client is done reading.
+    done.wait()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--batch', action='store_true',
+                        help='read lines with ReadLines()')
+    args = parser.parse_args()
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    done = threading.Event()
+    thread = threading.Thread(target=_Serve, args=(server, args.lines, done))
+    thread.start()
+
+    conn = irc.Connection()
+    conn.Connect(*server.getsockname(), 'benchbot')
+    start = time.perf_counter()
+    if args.batch:
+        count = 0
+        while count < args.lines:
+            count += len(conn.ReadLines(60))
+    else:
+        for _ in range(args.lines):
+            conn.ReadNextLine(60)
+    elapsed = time.perf_counter() - start
+    done.set()
+    thread.join()
+    server.close()
+
+    print('%d lines in %.3fs: %.0f lines/s' %
+          (args.lines, elapsed, args.lines / elapsed))
+
+
+if __name__ == '__main__':
+    main()
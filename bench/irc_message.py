@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of irc.Message parsing.
+
+Parses a mix of Twitch style lines (tagged PRIVMSGs, PINGs, JOINs and
+numerics) and reports the parse rate and the memory allocated per message,
+both when handlers only look at the command (like most of the chain does for
+most messages) and when they also read the tags and sender.
+
+Usage: python3 bench/irc_message.py [--messages 200000]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import irc
+
+_LINES = (
+    '@badge-info=subscriber/14;badges=subscriber/12,premium/1;'
+    'color=#1E90FF;display-name=Viewer;emotes=25:0-4;first-msg=0;flags=;'
+    'id=b34ccfc7-4977-403a-8a94-33c6bac34fb8;mod=0;room-id=1337;'
+    'subscriber=1;tmi-sent-ts=1507246572675;turbo=0;user-id=1337;'
+    'user-type= :viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #gogcom '
+    ':Kappa Keepo Kappa',
+    'PING :tmi.twitch.tv',
+    ':viewer!viewer@viewer.tmi.twitch.tv JOIN #gogcom',
+    ':tmi.twitch.tv 353 gogbot = #gogcom :viewer1 viewer2 viewer3',
+    ':tmi.twitch.tv 366 gogbot #gogcom :End of /NAMES list',
+)
+
+
+def _Parse(lines, read_fields):
+    for line in lines:
+        msg = irc.Message(line)
+        msg.command
+        if read_fields:
+            msg.tags
+            msg.sender
+
+
+def _Measure(lines, read_fields):
+    start = time.perf_counter()
+    _Parse(lines, read_fields)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    messages = [irc.Message(line) for line in lines]
+    if read_fields:
+        for msg in messages:
+            msg.tags
+            msg.sender
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del messages
+    return elapsed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    lines = [_LINES[i % len(_LINES)] for i in range(args.messages)]
+    for read_fields in (False, True):
+        elapsed, memory = _Measure(lines, read_fields)
+        print('%-22s %8.0f msgs/s, %6.0f bytes retained per message' %
+              ('command only:' if not read_fields else 'command+tags+sender:',
+               args.messages / elapsed, memory / args.messages))
+
+
+if __name__ == '__main__':
+    main()
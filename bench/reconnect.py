@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Measures how long the bot takes to rejoin its channels after losing the
+connection.
+
+A local fake Twitch server waits for the bot to join its channels, then
+either drops the connection or, with --twitch-reconnect, sends the RECONNECT
+command Twitch uses before restarting a server. The time from then until all
+channels are joined again on a new connection is reported, along with the
+number of reads the server needed to get each login.
+
+Connections only last a fraction of a second here, --reset-after defaults to
+less than that so that each drop is measured as if the connection had been
+stable, pass 60 to see the backoff grow as with a flapping connection. The
+join rate limit is also raised, with Twitch's 20 per 10 seconds the JOINs of
+drops in quick succession would be paced.
+
+Usage: python3 bench/reconnect.py [--channels 5] [--drops 10]
+                                  [--min-delay 1] [--reset-after 0.05]
+                                  [--twitch-reconnect]
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import irc
+
+
+class _FakeServer(threading.Thread):
+    """Accepts the bot connections one after the other."""
+
+    def __init__(self, channels, drops, twitch_reconnect):
+        super().__init__(daemon=True)
+        self._channels = set(channels)
+        self._drops = drops
+        self._twitch_reconnect = twitch_reconnect
+        self._server = socket.socket()
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(5)
+        # Seconds from each drop to having all the channels joined again.
+        self.rejoin_times = []
+        # Number of reads needed to get each login.
+        self.login_reads = []
+        self.done = threading.Event()
+
+    def GetAddress(self):
+        return self._server.getsockname()
+
+    def _WaitJoins(self, client):
+        """Reads from "client" until all channels are joined."""
+        data = b''
+        joined = set()
+        reads = 0
+        while joined != self._channels:
+            chunk = client.recv(65536)
+            if not chunk:
+                raise ConnectionError('bot closed the connection')
+            reads += 1
+            data += chunk
+            lines = data.split(b'\r\n')
+            data = lines.pop()
+            for line in lines:
+                if line.startswith(b'NICK '):
+                    login_reads = reads
+                if line.startswith(b'JOIN '):
+                    joined.add(line[5:].decode())
+        self.login_reads.append(login_reads)
+
+    def run(self):
+        dropped_at = None
+        previous = None
+        for drop in range(self._drops + 1):
+            client, _ = self._server.accept()
+            if previous:
+                previous.close()
+            self._WaitJoins(client)
+            if dropped_at is not None:
+                self.rejoin_times.append(time.perf_counter() - dropped_at)
+            if drop == self._drops:
+                break
+            time.sleep(0.1)
+            dropped_at = time.perf_counter()
+            if self._twitch_reconnect:
+                # Twitch keeps the old connection up for a while.
+                client.sendall(b':tmi.twitch.tv RECONNECT\r\n')
+                previous = client
+            else:
+                client.close()
+        self.done.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--drops', type=int, default=10)
+    parser.add_argument('--min-delay', type=float, default=1)
+    parser.add_argument('--reset-after', type=float, default=0.05)
+    parser.add_argument('--twitch-reconnect', action='store_true')
+    args = parser.parse_args()
+
+    channels = ['#channel%d' % i for i in range(args.channels)]
+    server = _FakeServer(channels, args.drops, args.twitch_reconnect)
+    server.start()
+
+    conn = irc.Connection(
+        rate_limits=irc.RateLimits(join_rate=1000),
+        reconnect=irc.Backoff(min_delay=args.min_delay,
+                              reset_after=args.reset_after))
+    conn.Connect(*server.GetAddress(), 'gogbot', channels=channels,
+                 server_pass='oauth:x')
+    client = threading.Thread(target=irc.Client(irc.CoreHandler(conn)).Run,
+                              daemon=True)
+    client.start()
+    # Longest the reconnections could take, with the backoff growing.
+    max_wait = sum(min(args.min_delay * 2**drop, 120)
+                   for drop in range(args.drops))
+    if not server.done.wait(max_wait + 10):
+        print('timed out after %d reconnections' % len(server.rejoin_times))
+        return
+
+    times = server.rejoin_times
+    print('%d %s, %d channels: time to rejoined min %.3fs, mean %.3fs, '
+          'max %.3fs' % (
+              len(times),
+              'RECONNECTs' if args.twitch_reconnect else 'dropped connections',
+              args.channels, min(times), statistics.mean(times), max(times)))
+    print('reads per login: %s' % ', '.join(map(str, server.login_reads)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Replays hours of chat through the rate limiter on a virtual clock.
+
+Generates --duration simulated seconds of chat at --rate messages per
+second, from --senders users of which a few spam, and feeds it to the rate
+limiter plugin over an unconnected Connection running on a
+clock_lib.VirtualClock. The connection scheduler runs a timer every
+--report seconds of simulated time, like a plugin's periodic timer would.
+Reports how many messages passed and were rejected and how long the replay
+took for real.
+
+Usage: python3 bench/replay.py [--duration 3600] [--rate 50]
+                               [--bucket-width 1 | --gcra]
+"""
+
+import argparse
+import configparser
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import clock as clock_lib
+from lib import irc
+from plugins import ratelimiter
+
+_COMMANDS = ('!up', '!down', '!left', '!right', '!use', '!pass', '!help')
+# Fraction of the senders spamming, and of the messages they send.
+_SPAMMERS = 0.01
+_SPAM = 0.3
+
+
+def _Messages(args):
+    """Yields (delay since the previous message, PRIVMSG) pairs."""
+    rng = random.Random(42)
+    spammers = max(1, int(args.senders * _SPAMMERS))
+    for idx in range(int(args.rate * args.duration)):
+        if rng.random() < _SPAM:
+            sender = 'spammer%d' % rng.randrange(spammers)
+            text = 'BUY FOLLOWERS'
+        else:
+            sender = 'user%d' % rng.randrange(args.senders)
+            text = rng.choice(_COMMANDS)
+        yield (rng.expovariate(args.rate),
+               irc.Message(':%s!%s@%s.tmi.twitch.tv PRIVMSG #gogcom :%s' %
+                           (sender, sender, sender, text)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--duration', type=int, default=3600,
+                        help='simulated seconds of chat')
+    parser.add_argument('--rate', type=int, default=50,
+                        help='messages per second')
+    parser.add_argument('--senders', type=int, default=2000)
+    parser.add_argument('--window', type=int, default=30,
+                        help='rate limiter max_age in seconds')
+    parser.add_argument('--bucket-width', type=float, default=0,
+                        help='seconds per bucket, 0 to count exactly')
+    parser.add_argument('--gcra', action='store_true',
+                        help='use the GCRA mode instead of a window')
+    parser.add_argument('--report', type=int, default=600,
+                        help='simulated seconds between window reports')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read_dict({'RATELIMITER': {
+        'mode': 'gcra' if args.gcra else 'window',
+        'max_age': args.window,
+        'bucket_width': args.bucket_width,
+        'rate_per_sender': 3,
+        'rate_per_text': 100,
+    }})
+    clock = clock_lib.VirtualClock()
+    conn = irc.Connection(clock=clock)
+    handler = ratelimiter.Handler(conn, config)
+
+    def Report():
+        if args.gcra:
+            print('%6ds: %d senders tracked' %
+                  (clock(), handler._pool.by_sender.CountKeys(clock())))
+        else:
+            print('%6ds: %d messages in the window' %
+                  (clock(), handler._pool.CountAll()))
+    conn.scheduler.CallEvery(args.report, Report)
+
+    messages = list(_Messages(args))
+    passed = rejected = 0
+    start = time.perf_counter()
+    for delay, msg in messages:
+        clock.RunUntil(conn.scheduler, clock() + delay)
+        if handler.HandlePRIVMSG(msg):
+            rejected += 1
+        else:
+            passed += 1
+    clock.RunUntil(conn.scheduler, args.duration)
+    elapsed = time.perf_counter() - start
+    print('%d messages over %ds simulated: %d passed, %d rejected' %
+          (len(messages), args.duration, passed, rejected))
+    print('replayed in %.2fs, %.0fx real time' %
+          (elapsed, args.duration / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Measures the memory used to track the users of a large channel.
+
+A local fake Twitch server sends the NAMES list of a channel with --viewers
+users, then chat messages from --chatters users, some of them not part of the
+NAMES list (Twitch only lists the moderators of large channels). The memory
+still allocated once all of it was handled is reported.
+
+Usage: python3 bench/userlist.py [--viewers 100000] [--chatters 50000]
+"""
+
+import argparse
+import gc
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from lib import irc
+
+_CHANNEL = '#bigchannel'
+_PRIVMSG = ('@badge-info=subscriber/14;badges=subscriber/12,premium/1;'
+            'client-nonce=5bb8a2b7f1f4b8b4a8e4d3c2b1a09f8e;color=#1E90FF;'
+            'display-name=User%(user)d;emotes=;first-msg=0;flags=;'
+            'id=b34ccfc7-4977-403a-8a94-33c6bac34fb8;mod=0;returning-chatter=0;'
+            'room-id=12345678;subscriber=1;tmi-sent-ts=1700000000000;turbo=0;'
+            'user-id=%(user)d;user-type= '
+            ':user%(user)d!user%(user)d@user%(user)d.tmi.twitch.tv '
+            'PRIVMSG %(chan)s :message from user %(user)d\r\n')
+
+
+def _Serve(server, viewers, chatters):
+    client, _ = server.accept()
+    with client:
+        client.recv(65536)
+        names = ['user%d' % user for user in range(viewers)]
+        for start in range(0, viewers, 100):
+            client.sendall((':gogbot.tmi.twitch.tv 353 gogbot = %s :%s\r\n' % (
+                _CHANNEL, ' '.join(names[start:start + 100]))).encode())
+        client.sendall((':gogbot.tmi.twitch.tv 366 gogbot %s :End\r\n' %
+                        _CHANNEL).encode())
+        # Half of the chatters are listed viewers, half are not.
+        for user in range(viewers - chatters // 2,
+                          viewers - chatters // 2 + chatters):
+            client.sendall((_PRIVMSG % {'user': user, 'chan': _CHANNEL}
+                           ).encode())
+        client.sendall(b':tmi.twitch.tv PRIVMSG %s :done\r\n' %
+                       _CHANNEL.encode())
+        # Wait for the client to be done before closing.
+        client.recv(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--viewers', type=int, default=100000)
+    parser.add_argument('--chatters', type=int, default=50000)
+    args = parser.parse_args()
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    threading.Thread(target=_Serve, args=(server, args.viewers, args.chatters),
+                     daemon=True).start()
+
+    conn = irc.Connection()
+    conn.Connect(*server.getsockname(), 'gogbot', channels=(_CHANNEL,))
+    handler = irc.CoreHandler(conn)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    done = False
+    while not done:
+        for line in conn.ReadLines(1):
+            msg = irc.Message(line)
+            if msg.sender == 'tmi.twitch.tv':
+                done = True
+                break
+            handler.HandleMessage(msg)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    footprint = conn.GetUserListFootprint()
+    tracked = footprint.users + footprint.chatters
+    print('%d viewers, %d chatters handled in %.2fs' % (
+        args.viewers, args.chatters, elapsed))
+    print('%r' % footprint)
+    print('memory: %.1f MiB, %.0f bytes per tracked user' % (
+        used / 2**20, used / tracked))
+    conn.Close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Clocks for the time based parts of the bot.
+
+A clock is any callable returning the current time in seconds as a float,
+only meaningful compared to other times of the same clock. The connections,
+their scheduler and rate limits, the event queues and the Twitch API token
+all take one, the connection's being available to plugins as "conn.clock".
+
+MONOTONIC, the default, is unaffected by system clock changes. A
+VirtualClock only moves when told to, so that simulations and replays can
+go through hours of chat in seconds.
+"""
+
+import time
+
+MONOTONIC = time.monotonic
+
+
+class VirtualClock:
+    """Clock moved forward explicitly, for simulations and replays."""
+
+    def __init__(self, now=0.0):
+        self._now = now
+
+    def __call__(self):
+        return self._now
+
+    def Advance(self, seconds):
+        """Move the clock forward by "seconds"."""
+        if seconds < 0:
+            raise ValueError('clock can not go backwards: %r' % seconds)
+        self._now += seconds
+
+    def AdvanceTo(self, when):
+        """Move the clock forward to "when", if it's not already past it."""
+        self._now = max(self._now, when)
+
+    def RunUntil(self, scheduler, when):
+        """Advance to "when", running the "scheduler" timers due on the way.
+
+        Each timer runs with the clock at its due time, like the client loop
+        would run it. Returns the results of the timer callbacks.
+        """
+        results = []
+        while True:
+            timeout = scheduler.GetTimeout()
+            if timeout is None or self._now + timeout > when:
+                break
+            self._now += timeout
+            results.extend(timer.Run() for timer in scheduler.PopDue())
+        self.AdvanceTo(when)
+        return results
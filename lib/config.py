@@ -1,5 +1,165 @@
+import collections.abc
+import configparser
+import logging
+import os
+
+
+class ConfigError(Exception):
+    """The config file could not be read or has invalid values."""
+    pass
+
+
+class Option:
+    """Type, default value and constraints of a config option."""
+
+    def __init__(self, type=str, default=None, required=False, minimum=None,
+                 choices=None):
+        """The "type" is str, int, float or bool, "default" isn't parsed."""
+        self.type = type
+        self.default = default
+        self.required = required
+        self.minimum = minimum
+        self.choices = choices
+
+    def Parse(self, raw):
+        """Returns the typed value of "raw", raises ValueError if invalid."""
+        if self.type is bool:
+            value = configparser.ConfigParser.BOOLEAN_STATES.get(raw.lower())
+            if value is None:
+                raise ValueError('not a boolean: %r' % raw)
+            return value
+        value = self.type(raw)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError('%r is less than %r' % (value, self.minimum))
+        if self.choices is not None and value not in self.choices:
+            raise ValueError('%r is not one of %s' % (
+                value, ', '.join(map(repr, self.choices))))
+        return value
+
+
+class Section(collections.abc.Mapping):
+    """Typed and validated values of a config section, read only.
+
+    Compares equal to another section with the same values, that's how
+    changed sections are found when the config file is read again.
+    """
+    __slots__ = ('name', '_values')
+
+    def __init__(self, name, values):
+        self.name = name
+        self._values = values
+
+    def __getitem__(self, option):
+        return self._values[option]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'Section(%r, %r)' % (self.name, self._values)
+
+
+class Schema:
+    """The options of a config section, e.g. the one of a plugin."""
+
+    def __init__(self, section, options):
+        """The "options" map option names to Options."""
+        self.section = section.upper()
+        self.options = options
+
+    def Compile(self, all_config):
+        """Returns the Section of "all_config" with this schema's options.
+
+        Raises ConfigError listing every invalid or missing option. Options
+        not in the schema are only warned about.
+        """
+        raw = (all_config[self.section]
+               if all_config.has_section(self.section) else {})
+        values = {}
+        errors = []
+        for name, option in self.options.items():
+            if name not in raw:
+                if option.required:
+                    errors.append('"%s" not set' % name)
+                values[name] = option.default
+                continue
+            try:
+                values[name] = option.Parse(raw[name])
+            except ValueError as err:
+                errors.append('"%s": %s' % (name, err))
+        if errors:
+            raise ConfigError('invalid %s config section: %s' % (
+                self.section, '; '.join(errors)))
+        unknown = sorted(set(raw) - set(self.options) -
+                         set(all_config.defaults()))
+        if unknown:
+            logging.warning('Unknown options in %s config section: %s',
+                            self.section, ', '.join(unknown))
+        return Section(self.section, values)
+
+
+class Snapshot(configparser.ConfigParser):
+    """A config file read once, along with its typed sections.
+
+    The typed sections are compiled the first time they are asked for and
+    then reused. A changed file is read into a new snapshot, never into an
+    existing one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = None
+        # Modification time of the file when read.
+        self.mtime = None
+        # Map of schema -> compiled Section (or the ConfigError compiling it).
+        self._compiled = {}
+
+    @classmethod
+    def Load(cls, path):
+        """Returns a snapshot of the config file, raises ConfigError."""
+        snapshot = cls()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            read = snapshot.read(path)
+        except (OSError, configparser.Error) as err:
+            raise ConfigError('failed to parse config %r: %s' % (path, err))
+        if read != [path]:
+            raise ConfigError('failed to read config %r' % path)
+        snapshot.path = path
+        snapshot.mtime = mtime
+        return snapshot
+
+    def GetTyped(self, schema):
+        """Returns the compiled Section of "schema", raises ConfigError."""
+        result = self._compiled.get(schema)
+        if result is None:
+            try:
+                result = schema.Compile(self)
+            except ConfigError as err:
+                result = err
+            self._compiled[schema] = result
+        if isinstance(result, ConfigError):
+            raise result
+        return result
+
+
 def GetSection(all_config, section):
+    """Returns a config section, by name or by Schema.
+
+    Given a Schema, returns its typed Section (raising ConfigError if
+    invalid). Given a name, returns the raw section, empty if missing.
+    """
+    if isinstance(section, Schema):
+        if isinstance(all_config, Snapshot):
+            return all_config.GetTyped(section)
+        return section.Compile(all_config)
     section = section.upper()
     if section in all_config.sections():
         return all_config[section]
-    return {}
+    # An empty section that still has getboolean() and friends.
+    empty = configparser.ConfigParser()
+    empty.add_section(section)
+    return empty[section]
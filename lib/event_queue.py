@@ -1,11 +1,23 @@
+import array
 import bisect
-import time
+import collections
+import heapq
+import math
+import operator
+
+from lib import clock as clock_lib
 
 
 class Event:
-    """Base event class. Associate timestamped events with some payload."""
-    def __init__(self, data):
-        self.timestamp = time.time()
+    """Base event class. Associate timestamped events with some payload.
+
+    Events default to the time of clock_lib.MONOTONIC, pass the "timestamp"
+    when recording them in a queue with another clock.
+    """
+    def __init__(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = clock_lib.MONOTONIC()
+        self.timestamp = timestamp
         self.data = data
 
     def __repr__(self):
@@ -17,48 +29,353 @@ class Event:
 
 
 class Queue:
-    """Ordered queue of events issued in the past "max_age" seconds."""
-    def __init__(self, max_age):
+    """Sliding window of the events issued in the past "max_age" seconds.
+
+    Events are kept in a deque ordered by timestamp, along with a count of
+    events by payload. Recording an event and expiring the old ones are
+    amortised O(1), and so are the counts. Payloads with no event left in
+    the window are dropped from the counts.
+
+    Subclasses keeping their own counts should extend _Forget(), which is
+    called for every event leaving the window.
+    """
+    def __init__(self, max_age, clock=clock_lib.MONOTONIC):
         self._max_age = max_age
-        self._events = []
-        # Create a map that associates an event's payload with the events that
-        # have that payload.
-        self._idx_data = {}
+        # Returns the current time, in the same unit as event timestamps.
+        self._clock = clock
+        self._events = collections.deque()
+        # Number of events in the window by payload.
+        self._counts = {}
 
     def _RemoveExpiredEvents(self):
-        now = time.time()
-        to_remove = []
-        for ev in self._events:
-            if ev.timestamp + self._max_age >= now:
-                break
-            to_remove.append(ev)
+        # Events are ordered, the expired ones are all at the front.
+        expire = self._clock() - self._max_age
+        events = self._events
+        while events and events[0].timestamp < expire:
+            self._Forget(events.popleft())
 
-        for ev in to_remove:
-            self.RemoveEvent(ev)
+    def _Forget(self, ev):
+        """Update the counts for an event that left the window."""
+        count = self._counts[ev.data] - 1
+        if count:
+            self._counts[ev.data] = count
+        else:
+            del self._counts[ev.data]
 
     def RecordEvent(self, ev):
-        # Keep the event queue ordered by timestamp. Usually this insert
-        # happens at the end since events will tend to be added in chronological
-        # order.
-        bisect.insort_right(self._events, ev)
-        # Keep events ordered by timestamp in the payload based map.
-        bisect.insort_right(self._idx_data.setdefault(ev.data, []), ev)
+        events = self._events
+        if not events or not ev < events[-1]:
+            events.append(ev)
+        else:
+            # Only happens if the clock went backwards or for events created
+            # a while before being recorded.
+            events.insert(bisect.bisect_right(events, ev), ev)
+        self._counts[ev.data] = self._counts.get(ev.data, 0) + 1
+        self._RemoveExpiredEvents()
 
     def RemoveEvent(self, ev):
-        # Use a linear search because events are generally removed from the
-        # end of the queue by _RemoveExpiredEvents.
+        """Remove an event before it expires, in linear time."""
         for idx, candidate in enumerate(self._events):
             if candidate is ev:
-                self._events.pop(idx)
-                break
-        for idx, candidate in enumerate(self._idx_data.get(ev.data, [])):
-            if candidate is ev:
-                self._idx_data[ev.data].pop(idx)
+                del self._events[idx]
+                self._Forget(ev)
                 break
 
     def CountAll(self):
+        self._RemoveExpiredEvents()
         return len(self._events)
 
     def CountByData(self, data):
         self._RemoveExpiredEvents()
-        return len(self._idx_data.get(data, []))
+        return self._counts.get(data, 0)
+
+    def CountKeys(self):
+        """Returns the number of distinct payloads in the window."""
+        self._RemoveExpiredEvents()
+        return len(self._counts)
+
+    def TopData(self, k):
+        """Returns up to "k" (payload, count) pairs, highest counts first."""
+        self._RemoveExpiredEvents()
+        return heapq.nlargest(k, self._counts.items(),
+                              key=operator.itemgetter(1))
+
+
+class _Bucket:
+    """Events counted over one bucket of time."""
+    __slots__ = ('index', 'counts', 'total')
+
+    def __init__(self, index):
+        # Start time of the bucket divided by the bucket width.
+        self.index = index
+        # Number of events in the bucket by payload, or by counter index
+        # for SketchQueue.
+        self.counts = {}
+        self.total = 0
+
+
+class BucketedQueue:
+    """Approximate sliding window, counting events in buckets of time.
+
+    Keeps no events, only a ring of buckets each counting the events of
+    "bucket_width" seconds by payload, so memory is O(payloads x buckets)
+    whatever the event rate. Counts are amortised O(1) like with Queue.
+
+    Error bound: whole buckets enter and leave the window, the oldest one
+    counted starting before the window. Counts are never lower than the
+    exact ones and include at most the events of the "bucket_width" seconds
+    just before the window (less than 2 x "bucket_width" when it doesn't
+    divide "max_age"). That keeps rate limits strict. Events recorded out of
+    order count in the newest bucket.
+    """
+    def __init__(self, max_age, bucket_width=1, clock=clock_lib.MONOTONIC):
+        self._bucket_width = bucket_width
+        # Buckets covering the window, plus the one partly before it.
+        self._bucket_count = math.ceil(max_age / bucket_width) + 1
+        self._clock = clock
+        self._buckets = collections.deque()
+        # Number of events in the window by payload, and overall.
+        self._counts = {}
+        self._total = 0
+
+    def _RemoveExpiredEvents(self):
+        oldest = (math.floor(self._clock() / self._bucket_width) -
+                  self._bucket_count + 1)
+        buckets = self._buckets
+        while buckets and buckets[0].index < oldest:
+            bucket = buckets.popleft()
+            self._total -= bucket.total
+            counts = self._counts
+            for data, count in bucket.counts.items():
+                count = counts[data] - count
+                if count:
+                    counts[data] = count
+                else:
+                    del counts[data]
+
+    def RecordData(self, data, timestamp=None):
+        """Record an event with the "data" payload."""
+        if timestamp is None:
+            timestamp = self._clock()
+        index = math.floor(timestamp / self._bucket_width)
+        buckets = self._buckets
+        if not buckets or buckets[-1].index < index:
+            buckets.append(_Bucket(index))
+            self._RemoveExpiredEvents()
+        bucket = buckets[-1]
+        bucket.counts[data] = bucket.counts.get(data, 0) + 1
+        bucket.total += 1
+        self._counts[data] = self._counts.get(data, 0) + 1
+        self._total += 1
+
+    def RecordEvent(self, ev):
+        self.RecordData(ev.data, ev.timestamp)
+
+    def RemoveEvent(self, ev):
+        """Uncount an event, if its bucket is still in the window."""
+        index = math.floor(ev.timestamp / self._bucket_width)
+        for bucket in reversed(self._buckets):
+            if bucket.index <= index:
+                break
+        else:
+            return
+        if bucket.index != index or not bucket.counts.get(ev.data):
+            return
+        bucket.counts[ev.data] -= 1
+        if not bucket.counts[ev.data]:
+            del bucket.counts[ev.data]
+        bucket.total -= 1
+        self._total -= 1
+        count = self._counts[ev.data] - 1
+        if count:
+            self._counts[ev.data] = count
+        else:
+            del self._counts[ev.data]
+
+    def CountAll(self):
+        self._RemoveExpiredEvents()
+        return self._total
+
+    def CountByData(self, data):
+        self._RemoveExpiredEvents()
+        return self._counts.get(data, 0)
+
+    def CountKeys(self):
+        """Returns the number of distinct payloads in the window."""
+        self._RemoveExpiredEvents()
+        return len(self._counts)
+
+    def TopData(self, k):
+        """Returns up to "k" (payload, count) pairs, highest counts first."""
+        self._RemoveExpiredEvents()
+        return heapq.nlargest(k, self._counts.items(),
+                              key=operator.itemgetter(1))
+
+
+# Odd 64 bits constant spreading the bits of payload hashes, as some hash to
+# themselves (small ints).
+_SKETCH_MULTIPLIER = 0x9e3779b97f4a7c15
+_SKETCH_MASK = (1 << 64) - 1
+
+
+class SketchQueue:
+    """Approximate sliding window of fixed size, for unbounded payloads.
+
+    Counts events in buckets of time like BucketedQueue, but each bucket is
+    a count-min sketch: "depth" rows of "width" counters, every payload
+    adding to one counter per row picked by hashing it. The count of a
+    payload is the lowest of its counters. Memory is bounded, "depth" x
+    "width" counters for the window and at most as many for each bucket,
+    however many distinct payloads come. Buckets with few events only keep
+    the counters they changed, in a dict, which is also quicker to expire.
+
+    Error bound: hash collisions only ever add the events of other payloads
+    to a count, so on top of the BucketedQueue bound counts are never lower
+    than the exact ones. They are over by less than e x (events in the
+    window) / "width" with probability 1 - e^-"depth", size "width" for the
+    expected traffic.
+
+    The sketch can't list its payloads, the "top_k" ones with the highest
+    counts are tracked on the side for TopData(). Events can't be removed.
+    """
+    def __init__(self, max_age, bucket_width=1, width=1024, depth=4,
+                 top_k=10, clock=clock_lib.MONOTONIC):
+        self._bucket_width = bucket_width
+        # Buckets covering the window, plus the one partly before it.
+        self._bucket_count = math.ceil(max_age / bucket_width) + 1
+        self._width = width
+        self._depth = depth
+        # Bucket counters in a dict past that many take more memory than
+        # all the counters in an array.
+        self._sparse_size = width * depth // 16
+        self._clock = clock
+        self._buckets = collections.deque()
+        # Sum of the counters of the buckets in the window, and their total.
+        self._counters = array.array('I', [0]) * (width * depth)
+        self._total = 0
+        # Map of payload -> count when last updated, of the payloads with
+        # the highest counts. Counts are updated as buckets expire.
+        self._top_k = top_k
+        self._top = {}
+        # Lowest count in _top once full, a payload needs more to get in.
+        self._top_floor = 0
+
+    def _Indexes(self, data):
+        # The rows are hashed from one hash split in two, h1 + row x h2
+        # (double hashing), which is as good for a count-min sketch as
+        # independent hashes.
+        mixed = hash(data) * _SKETCH_MULTIPLIER & _SKETCH_MASK
+        h1 = mixed >> 32
+        h2 = mixed & 0xffffffff | 1
+        width = self._width
+        return [row * width + (h1 + row * h2) % width
+                for row in range(self._depth)]
+
+    def _Estimate(self, data):
+        counters = self._counters
+        return min(counters[idx] for idx in self._Indexes(data))
+
+    def _RemoveExpiredEvents(self):
+        oldest = (math.floor(self._clock() / self._bucket_width) -
+                  self._bucket_count + 1)
+        buckets = self._buckets
+        if not buckets or buckets[0].index >= oldest:
+            return
+        counters = self._counters
+        while buckets and buckets[0].index < oldest:
+            bucket = buckets.popleft()
+            self._total -= bucket.total
+            if isinstance(bucket.counts, dict):
+                changed = bucket.counts.items()
+            else:
+                changed = enumerate(bucket.counts)
+            for idx, count in changed:
+                counters[idx] -= count
+        self._RefreshTop()
+
+    def _RefreshTop(self):
+        top = {}
+        for data in self._top:
+            count = self._Estimate(data)
+            if count:
+                top[data] = count
+        self._top = top
+        self._UpdateTopFloor()
+
+    def _UpdateTopFloor(self):
+        if len(self._top) < self._top_k:
+            self._top_floor = 0
+        else:
+            self._top_floor = min(self._top.values())
+
+    def _Track(self, data, count):
+        top = self._top
+        if data in top or len(top) < self._top_k:
+            top[data] = count
+            if len(top) == self._top_k:
+                self._UpdateTopFloor()
+        elif count > self._top_floor:
+            lowest = min(top, key=top.get)
+            if count > top[lowest]:
+                del top[lowest]
+                top[data] = count
+            self._UpdateTopFloor()
+
+    def RecordData(self, data, timestamp=None):
+        """Record an event with the "data" payload."""
+        if timestamp is None:
+            timestamp = self._clock()
+        index = math.floor(timestamp / self._bucket_width)
+        buckets = self._buckets
+        if not buckets or buckets[-1].index < index:
+            bucket = _Bucket(index)
+            # Same "+= 1" as the array it may become.
+            bucket.counts = collections.defaultdict(int)
+            buckets.append(bucket)
+            self._RemoveExpiredEvents()
+        bucket = buckets[-1]
+        bucket_counters = bucket.counts
+        counters = self._counters
+        count = None
+        for idx in self._Indexes(data):
+            bucket_counters[idx] += 1
+            counters[idx] += 1
+            if count is None or counters[idx] < count:
+                count = counters[idx]
+        if (isinstance(bucket_counters, dict) and
+                len(bucket_counters) > self._sparse_size):
+            bucket.counts = array.array('I', [0]) * len(counters)
+            for idx, bucket_count in bucket_counters.items():
+                bucket.counts[idx] = bucket_count
+        bucket.total += 1
+        self._total += 1
+        if self._top_k:
+            self._Track(data, count)
+
+    def RecordEvent(self, ev):
+        self.RecordData(ev.data, ev.timestamp)
+
+    def CountAll(self):
+        self._RemoveExpiredEvents()
+        return self._total
+
+    def CountByData(self, data):
+        self._RemoveExpiredEvents()
+        return self._Estimate(data)
+
+    def TopData(self, k):
+        """Returns up to "k" (payload, count) pairs, highest counts first.
+
+        Only the "top_k" payloads tracked are considered.
+        """
+        self._RemoveExpiredEvents()
+        return heapq.nlargest(k, ((data, self._Estimate(data))
+                                  for data in self._top),
+                              key=operator.itemgetter(1))
+
+
+def NewQueue(max_age, bucket_width=0, clock=clock_lib.MONOTONIC):
+    """Returns an exact Queue, or a BucketedQueue if "bucket_width" is set."""
+    if bucket_width:
+        return BucketedQueue(max_age, bucket_width, clock)
+    return Queue(max_age, clock)
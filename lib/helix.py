@@ -1,8 +1,11 @@
 import logging
-import requests
-import time
 from urllib import parse as url_parse
 
+from lib import clock as clock_lib
+from lib import plugin_loader
+
+requests = plugin_loader.LazyImport('requests')
+
 class _Oauth2Token:
     """Manages an up to date Twitch OAUTH2 access token.
 
@@ -12,10 +15,11 @@ class _Oauth2Token:
         secret = None
         type = None
 
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, clock=clock_lib.MONOTONIC):
         # Cache the Twitch API client ID and associated secret.
         self._client_id = client_id
         self._client_secret = client_secret
+        self._clock = clock
         # Set initial values for the cached token properties.
         self._access_token = None
         self._access_type = None
@@ -36,7 +40,7 @@ class _Oauth2Token:
     def _RefreshToken(self):
         # If we already have a valid token, don't do anything.
         if (self._access_expire is not None and
-            self._access_expire < time.time()):
+            self._clock() < self._access_expire):
             return
 
         self._access_token = None
@@ -66,16 +70,17 @@ class _Oauth2Token:
         # Compute the time for the token to expire taking a small margin of
         # error to account for the processing time after getting the new token
         # and for the time it would take to refresh the token.
-        self._access_expire = time.time() + result['expires_in'] - 60
+        self._access_expire = self._clock() + result['expires_in'] - 60
 
 
 class Helix:
     """Provides access to Twitch's Helix API."""
 
-    def __init__(self, config):
+    def __init__(self, config, clock=clock_lib.MONOTONIC):
         self._client_id = config['HELIX']['client_id']
         self._oauth2_token = _Oauth2Token(self._client_id,
-                                          config['HELIX']['client_secret'])
+                                          config['HELIX']['client_secret'],
+                                          clock)
 
     def _GetAuthorization(self):
         """Return the value that should be used for the Authorizatin header."""
@@ -1,9 +1,154 @@
+import asyncio
+import collections
 import errno
+import heapq
+import inspect
+import itertools
+import json
 import logging
+import os
+import random
+import re
 import selectors
 import socket
+import sys
 import time
 
+from lib import clock as clock_lib
+
+# Marks the lazily parsed Message fields not parsed yet.
+_UNPARSED = object()
+
+# Tag value escape sequences, see https://ircv3.net/specs/extensions/message-tags
+_TAG_ESCAPE_RE = re.compile(r'\\(.?)', flags=re.DOTALL)
+_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def _UnescapeTagValue(value):
+    # Unknown escapes lose the backslash, a trailing backslash is dropped.
+    return _TAG_ESCAPE_RE.sub(
+        lambda match: _TAG_ESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def _DecodeBool(value):
+    return value == '1'
+
+
+def _DecodeInt(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _DecodeBadges(value):
+    """Returns the badge names from a "name/version,..." badges tag."""
+    if not value:
+        return frozenset()
+    return frozenset(badge.partition('/')[0] for badge in value.split(','))
+
+
+def _DecodeEmotes(value):
+    """Returns {emote id: tuple of character index ranges} from an emotes tag.
+
+    The tag format is "id:start-end,start-end/id:start-end", with inclusive
+    ends.
+    """
+    emotes = {}
+    if not value:
+        return emotes
+    for emote in value.split('/'):
+        emote_id, _, positions = emote.partition(':')
+        ranges = []
+        for position in positions.split(','):
+            start, _, end = position.partition('-')
+            try:
+                ranges.append(range(int(start), int(end) + 1))
+            except ValueError:
+                logging.warning('Invalid emotes tag: %r', value)
+        emotes[emote_id] = tuple(ranges)
+    return emotes
+
+
+class Tags(dict):
+    """IRCv3 message tags, mapping tag names to their unescaped values.
+
+    The typed accessors decode the Twitch tags once and cache the result
+    until the tags are modified, see https://dev.twitch.tv/docs/irc/tags/.
+    """
+
+    __slots__ = ('_decoded',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._decoded = {}
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self._decoded.clear()
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self._decoded.clear()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._decoded.clear()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._decoded.clear()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._decoded.clear()
+        return item
+
+    def setdefault(self, name, default=None):
+        value = super().setdefault(name, default)
+        self._decoded.clear()
+        return value
+
+    def clear(self):
+        super().clear()
+        self._decoded.clear()
+
+    def _Decode(self, name, decoder):
+        try:
+            return self._decoded[name]
+        except KeyError:
+            value = self._decoded[name] = decoder(self.get(name))
+            return value
+
+    @property
+    def badges(self):
+        """frozenset of the badge names, ex. "moderator", "subscriber"."""
+        return self._Decode('badges', _DecodeBadges)
+
+    @property
+    def mod(self):
+        return self._Decode('mod', _DecodeBool)
+
+    @property
+    def subscriber(self):
+        return self._Decode('subscriber', _DecodeBool)
+
+    @property
+    def tmi_sent_ts(self):
+        """Server side message timestamp in milliseconds, None if unknown."""
+        return self._Decode('tmi-sent-ts', _DecodeInt)
+
+    @property
+    def emotes(self):
+        """Dictionary of emote id to tuple of message index ranges."""
+        return self._Decode('emotes', _DecodeEmotes)
+
+
 class Message:
     """Encapsulates the various IRC message fields, per the spec.
 
@@ -12,69 +157,174 @@ class Message:
     - prefix (optional), must start with ':' as first character
     - command, either one of the defined IRC commands or a 3 digit code
     - command parameters
+
+    Parse() only extracts the command and its parameters, the raw line is kept
+    and the tags, prefix and sender are parsed out of it when first read.
     """
+
+    __slots__ = ('_raw', '_tags_end', '_prefix_start', '_prefix_end', '_tags',
+                 '_prefix', '_sender', 'command', 'command_args')
+
     def __init__(self, raw_msg=None):
-        # Store list of tags, if any.
-        self.tags = {}
-        # Store the prefix with no leading ':'. Can be None if no prefix was
-        # present.
-        self.prefix = None
+        # The raw message line, and the offsets of the tags (after the '@')
+        # and prefix (after the ':') within it.
+        self._raw = ''
+        self._tags_end = 0
+        self._prefix_start = 0
+        self._prefix_end = 0
+        # Lazily parsed tags, prefix and sender.
+        self._tags = _UNPARSED
+        self._prefix = _UNPARSED
+        self._sender = _UNPARSED
         # IRC command string.
         self.command = None
         # IRC command arguments.
         self.command_args = None
-        # IRC command sender.
-        self.sender = None
         if raw_msg is not None:
             self.Parse(raw_msg)
 
     def Parse(self, raw_msg):
-        parts = raw_msg.split(' ', maxsplit=1)
-        tags = None
-        prefix = None
-        if len(parts) >= 2 and parts[0][0] == '@':
-            # Extract the tags.
-            tags = parts[0][1:]
-            parts = parts[1].split(' ', maxsplit=1)
-
-        if len(parts) >= 2 and parts[0][0] == ':':
-            prefix = parts[0][1:]
-            parts = parts[1].split(' ', maxsplit=1)
-            if len(parts) < 2:
-                parts.append('')
-
-        if len(parts) < 2:
+        start = 0
+        tags_end = 0
+        prefix_start = prefix_end = 0
+        end = raw_msg.find(' ')
+        if end > 0 and raw_msg[0] == '@':
+            tags_end = end
+            start = end + 1
+            end = raw_msg.find(' ', start)
+
+        if end > start and raw_msg[start] == ':':
+            prefix_start = start + 1
+            prefix_end = end
+            start = end + 1
+            end = raw_msg.find(' ', start)
+            if end < 0:
+                # Command with no parameters.
+                end = len(raw_msg)
+
+        if end <= start:
             logging.error('Invalid IRC message "%s"' % raw_msg)
             return False
 
-        if tags:
-            # Tags are semicolon separated name=value pairs.
-            for tag in tags.split(';'):
-                tag_parts = tag.split('=', maxsplit=1)
-                self.tags[tag_parts[0]] = (
-                    tag_parts[1] if len(tag_parts) >= 2 else '')
-
-        if prefix:
-            sender = prefix.split('!', maxsplit=1)[0].strip()
-            if sender:
-                self.sender = sender
-        self.prefix = prefix
-        self.command = parts[0]
-        self.command_args = parts[1]
+        self._raw = raw_msg
+        self._tags_end = tags_end
+        self._prefix_start = prefix_start
+        self._prefix_end = prefix_end
+        self._tags = self._prefix = self._sender = _UNPARSED
+        self.command = raw_msg[start:end]
+        self.command_args = raw_msg[end + 1:]
         return True
 
+    @property
+    def tags(self):
+        """Tags of the message, empty if there were none."""
+        tags = self._tags
+        if tags is _UNPARSED:
+            items = {}
+            if self._tags_end:
+                # Tags are semicolon separated name=value pairs. The names
+                # repeat on every message, intern them to share the strings.
+                for tag in self._raw[1:self._tags_end].split(';'):
+                    name, _, value = tag.partition('=')
+                    if '\\' in value:
+                        value = _UnescapeTagValue(value)
+                    items[sys.intern(name)] = value
+            tags = self._tags = Tags(items)
+        return tags
+
+    @property
+    def prefix(self):
+        """The prefix with no leading ':', None if no prefix was present."""
+        prefix = self._prefix
+        if prefix is _UNPARSED:
+            prefix = self._prefix = (
+                self._raw[self._prefix_start:self._prefix_end]
+                if self._prefix_start else None)
+        return prefix
+
+    @property
+    def sender(self):
+        """Nickname of the message sender, None if unknown."""
+        sender = self._sender
+        if sender is _UNPARSED:
+            sender = None
+            if self._prefix_end > self._prefix_start:
+                end = self._raw.find('!', self._prefix_start,
+                                     self._prefix_end)
+                if end < 0:
+                    end = self._prefix_end
+                sender = self._raw[self._prefix_start:end].strip() or None
+            self._sender = sender
+        return sender
+
     def __repr__(self):
         return 'Message(prefix=%r, command=%r, command_args=%r, sender=%r)' % (
                 self.prefix, self.command, self.command_args, self.sender)
 
 
+# User privilege bits, see User.HasPrivilege().
+PRIV_BROADCASTER = 1 << 0
+PRIV_MODERATOR = 1 << 1
+PRIV_VIP = 1 << 2
+PRIV_SUBSCRIBER = 1 << 3
+PRIV_ADMIN = 1 << 4
+# Privileges allowing to moderate a channel.
+PRIV_ELEVATED = PRIV_BROADCASTER | PRIV_MODERATOR | PRIV_ADMIN
+
+# Privileges given by badges.
+# See https://dev.twitch.tv/docs/irc/tags/#userstate-twitch-tags
+_BADGE_PRIVILEGES = {
+    'broadcaster': PRIV_BROADCASTER,
+    'moderator': PRIV_MODERATOR,
+    'vip': PRIV_VIP,
+    'subscriber': PRIV_SUBSCRIBER,
+    'founder': PRIV_SUBSCRIBER,
+    'admin': PRIV_ADMIN,
+    'staff': PRIV_ADMIN,
+    'global_mod': PRIV_ADMIN,
+}
+
+
+def _BadgesPrivileges(badges):
+    privileges = 0
+    for badge in badges:
+        privileges |= _BADGE_PRIVILEGES.get(badge, 0)
+    return privileges
+
+
+# Badge sets shared by all users having the same badges, with the privileges
+# they give.
+_SHARED_BADGES = {frozenset(): (frozenset(), 0)}
+
+
 class User:
-    """Information used to track the status of a chat user."""
+    """Information used to track the status of a chat user.
+
+    Out of the many tags of a user's messages, only the few used are kept.
+    The user privileges are computed from them, and from the user mode, each
+    time they change.
+    """
+
+    __slots__ = ('name', 'mode', 'badges', 'mod', 'display_name',
+                 'privileges')
 
     def __init__(self, username):
-        self.name = username
+        self.name = sys.intern(username)
         self.mode = ''
-        self.tags = {}
+        # Badge names (without versions), from the "badges" tag.
+        self.badges = _SHARED_BADGES[frozenset()][0]
+        # The "mod" tag.
+        self.mod = False
+        # The "display-name" tag, None if unknown.
+        self.display_name = None
+        # PRIV_* bits.
+        self.privileges = 0
+
+    def _UpdatePrivileges(self):
+        privileges = _SHARED_BADGES[self.badges][1]
+        if self.mod or 'o' in self.mode:
+            privileges |= PRIV_MODERATOR
+        self.privileges = privileges
 
     def UpdateMode(self, mode_str):
         # We're fairly limited in what user MODE updates we can process.
@@ -86,84 +336,869 @@ class User:
         if plus:
             if mode in self.mode:
                 logging.warning('We already have mode %c set for %r.',
-                                mode, self.username)
+                                mode, self.name)
                 return
             self.mode += mode
         else:
             if mode not in self.mode:
-                logging.warning('Mode %c missing for %r.', mode, self.username)
+                logging.warning('Mode %c missing for %r.', mode, self.name)
                 return
-            self.mode = [c for c in self.mode if c != mode]
+            self.mode = self.mode.replace(mode, '')
+        self._UpdatePrivileges()
+
+    @staticmethod
+    def _ShareBadges(badges):
+        shared = _SHARED_BADGES.get(badges)
+        if shared is None:
+            shared = _SHARED_BADGES[badges] = (badges,
+                                               _BadgesPrivileges(badges))
+        return shared[0]
 
     def UpdateTags(self, tags):
-        self.tags.update(tags)
+        """Update from the Tags of a message, tags not present are kept."""
+        if 'badges' in tags:
+            self.badges = self._ShareBadges(tags.badges)
+        if 'mod' in tags:
+            self.mod = tags.mod
+        display_name = tags.get('display-name')
+        if display_name:
+            self.display_name = display_name
+        self._UpdatePrivileges()
+
+    def Dump(self):
+        """Returns the user as compact JSON serializable data, see Load()."""
+        if (not self.mode and not self.badges and not self.mod and
+                self.display_name is None):
+            return self.name
+        return [self.name, self.mode, sorted(self.badges), self.mod,
+                self.display_name]
+
+    @classmethod
+    def Load(cls, data):
+        """Returns a User from the "data" returned by Dump()."""
+        if isinstance(data, str):
+            return cls(data)
+        name, mode, badges, mod, display_name = data
+        user = cls(name)
+        user.mode = mode
+        user.badges = cls._ShareBadges(frozenset(badges))
+        user.mod = bool(mod)
+        user.display_name = display_name
+        user._UpdatePrivileges()
+        return user
+
+    def HasPrivilege(self, privileges):
+        """Returns True if the user has any of the PRIV_* bits "privileges".
+        """
+        return bool(self.privileges & privileges)
 
     def IsModerator(self):
-        return ('o' in self.mode or self.tags.get('mod', 0) == 1 or
-                # See https://dev.twitch.tv/docs/irc/tags/#userstate-twitch-tags
-                any(badge.split('/', maxsplit=1)[0] in ('broadcaster',
-                                                        'moderator', 'admin')
-                    for badge in self.tags.get('badges', '').split(',')))
+        return bool(self.privileges & PRIV_ELEVATED)
+
+    def __repr__(self):
+        return 'User(name=%r, mode=%r, badges=%r, privileges=%#x)' % (
+            self.name, self.mode, sorted(self.badges), self.privileges)
+
+
+class UserListFootprint:
+    """Memory used by one or more UserLists."""
+
+    def __init__(self, users, chatters, size):
+        # Number of users listed by NAMES or seen joining.
+        self.users = users
+        # Number of users only seen chatting.
+        self.chatters = chatters
+        # Approximate bytes used.
+        self.size = size
+
+    def __add__(self, other):
+        return UserListFootprint(self.users + other.users,
+                                 self.chatters + other.chatters,
+                                 self.size + other.size)
+
+    def __repr__(self):
+        return 'UserListFootprint(users=%r, chatters=%r, size=%.1fKiB)' % (
+            self.users, self.chatters, self.size / 1024)
+
+
+class UserList(dict):
+    """The users of a channel, by name.
+
+    Holds the users listed by NAMES or seen joining the channel. Twitch only
+    lists the moderators of large channels, the users only seen through their
+    messages are kept apart in a cache evicting the least recently seen ones
+    once "max_chatters" are cached.
+
+    The names of the users (listed or cached) who can moderate the channel
+    are kept up to date as long as their tags and mode are updated through
+    UpdateTags() and UpdateMode().
+    """
+
+    __slots__ = ('_chatters', '_max_chatters', '_moderators')
+
+    _MAX_CHATTERS = 10000
+
+    def __init__(self, max_chatters=_MAX_CHATTERS):
+        super().__init__()
+        self._chatters = collections.OrderedDict()
+        self._max_chatters = max_chatters
+        self._moderators = set()
+
+    def _TrackModerator(self, user):
+        if user.IsModerator():
+            self._moderators.add(user.name)
+        else:
+            self._moderators.discard(user.name)
+
+    def GetModerators(self):
+        """Returns the names of the users who can moderate the channel."""
+        return frozenset(self._moderators)
+
+    def GetUser(self, name):
+        """Returns the User "name", listed or chatting, None if unknown."""
+        user = self.get(name)
+        if user is None:
+            user = self._chatters.get(name)
+        return user
+
+    def GetChatter(self, name):
+        """Returns the User "name" who sent a message, cached if not listed.
+        """
+        user = self.get(name)
+        if user is not None:
+            return user
+        chatters = self._chatters
+        user = chatters.get(name)
+        if user is not None:
+            chatters.move_to_end(name)
+            return user
+        user = chatters[name] = User(name)
+        if len(chatters) > self._max_chatters:
+            evicted = chatters.popitem(last=False)[0]
+            self._moderators.discard(evicted)
+        return user
+
+    def UpdateTags(self, name, tags):
+        """Update the User "name" who sent a message with "tags"."""
+        user = self.GetChatter(name)
+        user.UpdateTags(tags)
+        self._TrackModerator(user)
+        return user
+
+    def UpdateMode(self, name, mode_str):
+        """Update the mode of the User "name", returns None if unknown."""
+        user = self.GetUser(name)
+        if user is not None:
+            user.UpdateMode(mode_str)
+            self._TrackModerator(user)
+        return user
+
+    def AddUser(self, name):
+        """Adds the User "name" to the list, returns it."""
+        user = self.get(name)
+        if user is None:
+            # Keep what we know of a user already seen chatting.
+            user = self._chatters.pop(name, None) or User(name)
+            self[user.name] = user
+        return user
+
+    def RemoveUser(self, name):
+        """Removes the User "name", returns False if it wasn't listed."""
+        self._chatters.pop(name, None)
+        self._moderators.discard(name)
+        return self.pop(name, None) is not None
+
+    def Replace(self, names):
+        """Set the list to contain only the users "names"."""
+        users = [self.AddUser(name) for name in names]
+        self.clear()
+        for user in users:
+            self[user.name] = user
+        self._moderators = {
+            user.name for users in (self.values(), self._chatters.values())
+            for user in users if user.IsModerator()}
+
+    def Dump(self):
+        """Returns the listed users and the elevated chatters as JSON
+        serializable data, see Load()."""
+        return {
+            'users': [user.Dump() for user in self.values()],
+            'chatters': [user.Dump() for user in self._chatters.values()
+                         if user.IsModerator()],
+        }
+
+    def Load(self, data):
+        """Adds the users from "data" returned by Dump(), the users already
+        known are kept as they are."""
+        for dump in data['users']:
+            user = User.Load(dump)
+            if self.GetUser(user.name) is None:
+                self[user.name] = user
+                self._TrackModerator(user)
+        for dump in data['chatters']:
+            user = User.Load(dump)
+            if self.GetUser(user.name) is None:
+                self._chatters[user.name] = user
+                self._TrackModerator(user)
+        while len(self._chatters) > self._max_chatters:
+            self._moderators.discard(self._chatters.popitem(last=False)[0])
+
+    def GetFootprint(self):
+        """Returns the UserListFootprint of this list."""
+        size = (sys.getsizeof(self) + sys.getsizeof(self._chatters) +
+                sys.getsizeof(self._moderators))
+        for users in (self.values(), self._chatters.values()):
+            for user in users:
+                size += sys.getsizeof(user) + sys.getsizeof(user.name)
+                if user.display_name is not None:
+                    size += sys.getsizeof(user.display_name)
+        return UserListFootprint(len(self), len(self._chatters), size)
+
+
+# Version of the SaveUserLists() file format.
+_USERLISTS_VERSION = 1
+
+
+def SaveUserLists(conn, path):
+    """Writes the userlists of the channels joined by "conn" to "path".
+
+    The file is written next to "path" first then renamed, so that a crash
+    never leaves a truncated snapshot behind. Returns False on failure.
+    """
+    snapshot = {
+        'version': _USERLISTS_VERSION,
+        # Wall clock time, compared to the time the bot restarts at.
+        'time': time.time(),
+        'channels': {chan: conn.GetUserList(chan).Dump()
+                     for chan in conn.channels},
+    }
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError as err:
+        logging.error('Failed to save userlists to %r: %s', path, err)
+        return False
+    logging.debug('Saved userlists of %d channels to %r',
+                  len(snapshot['channels']), path)
+    return True
+
+
+def LoadUserLists(conn, path, max_age):
+    """Fills the userlists of the channels joined by "conn" from "path".
+
+    Twitch takes minutes to send the NAMES of a channel after joining it,
+    loading the userlists saved by SaveUserLists() before shutting down (or
+    losing the connection) lets privileged commands work right away. The
+    saved data is ignored if older than "max_age" seconds, otherwise live
+    traffic (NAMES, JOIN, PART, MODE) corrects it as it comes. Returns the
+    number of channels loaded.
+    """
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except FileNotFoundError:
+        logging.info('No userlists saved in %r', path)
+        return 0
+    except (OSError, ValueError) as err:
+        logging.warning('Failed to load userlists from %r: %s', path, err)
+        return 0
+
+    try:
+        if snapshot['version'] != _USERLISTS_VERSION:
+            logging.warning('Ignoring userlists of unknown version %r in %r',
+                            snapshot['version'], path)
+            return 0
+        age = time.time() - snapshot['time']
+        if age > max_age:
+            logging.info('Ignoring userlists saved %ds ago in %r', age, path)
+            return 0
+        loaded = 0
+        for chan, data in snapshot['channels'].items():
+            userlist = conn.GetUserList(chan)
+            if userlist is not None:
+                userlist.Load(data)
+                loaded += 1
+    except (KeyError, TypeError, ValueError, AttributeError) as err:
+        logging.warning('Invalid userlists in %r: %r', path, err)
+        return 0
+    logging.info('Loaded userlists of %d channels, saved %ds ago',
+                 loaded, age)
+    return loaded
+
+
+class _LineBuffer:
+    """Frames raw socket input into IRC lines.
+
+    Received bytes are stored in one preallocated bytearray (filled through
+    recv_into()) and lines are sliced out of it in place. "_start" marks the
+    first byte not yet returned as a line and "_scan" the offset from where to
+    resume looking for the next line terminator, so each received byte is only
+    ever scanned once, no matter how many lines arrive in one burst.
+    """
+
+    def __init__(self, size, max_line):
+        """The "max_line" is in characters, "size" in bytes."""
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._max_line = max_line
+        self._start = 0
+        self._scan = 0
+        self._end = 0
+        # Set while dropping the rest of a line that overflowed the buffer.
+        self._discarding = False
+
+    def Clear(self):
+        """Drop all the buffered data."""
+        self._start = 0
+        self._scan = 0
+        self._end = 0
+        self._discarding = False
+
+    def _MakeRoom(self):
+        """Make sure there's free space at the end of the buffer.
+
+        Returns False if the buffer is full of lines not yet consumed.
+        """
+        if self._end < len(self._buffer):
+            return True
+        if self._start == 0:
+            if self._buffer.find(b'\r\n', self._scan, self._end) >= 0:
+                return False
+            # The whole buffer is a single unterminated line, drop it and
+            # everything that follows until the next line terminator.
+            logging.error('IRC line too long %d > %d' %
+                          (self._end, self._max_line))
+            self._discarding = True
+            # Keep the last byte, it might be the '\r' of a '\r\n' pair.
+            self._buffer[0] = self._buffer[self._end - 1]
+            self._scan = 0
+            self._end = 1
+            return True
+        # Move the pending bytes to the start of the buffer.
+        pending = self._end - self._start
+        self._buffer[:pending] = self._view[self._start:self._end]
+        self._scan -= self._start
+        self._start = 0
+        self._end = pending
+        return True
+
+    def GetFreeSpace(self):
+        """Returns a writable view of the free space at the end of the buffer.
+
+        Returns None if there's no room left, the buffered lines need to be
+        consumed first. Call Commit() with the number of bytes written to it.
+        """
+        if not self._MakeRoom():
+            return None
+        return self._view[self._end:]
+
+    def Commit(self, count):
+        """Appends "count" bytes written to the GetFreeSpace() view."""
+        self._end += count
+
+    def RecvInto(self, sock):
+        """Read available bytes from "sock", returns the number of bytes.
+
+        Returns None without reading if there's no room left in the buffer.
+        """
+        free = self.GetFreeSpace()
+        if free is None:
+            return None
+        count = sock.recv_into(free)
+        self.Commit(count)
+        return count
+
+    def NextLine(self):
+        """Returns the next complete line, or None if there's none buffered."""
+        while True:
+            pos = self._buffer.find(b'\r\n', self._scan, self._end)
+            if pos < 0:
+                # Resume the next search from the last byte as it might be
+                # the '\r' of a '\r\n' split across reads.
+                self._scan = max(self._start, self._end - 1)
+                return None
+
+            start = self._start
+            self._start = self._scan = pos + 2
+            if self._start == self._end:
+                # Everything consumed, rewind to avoid compacting later.
+                self._start = self._scan = self._end = 0
+
+            if self._discarding:
+                self._discarding = False
+                continue
+            # Decode each line on its own so that a multibyte character split
+            # across reads is never broken and an invalid byte only affects
+            # the line it is part of.
+            line = str(self._view[start:pos], encoding='utf-8',
+                       errors='replace')
+            # The limit counts characters, a line can only be over it if it
+            # has more bytes than that.
+            if pos - start > self._max_line and len(line) > self._max_line:
+                logging.error('IRC line too long %d > %d' %
+                              (len(line), self._max_line))
+                continue
+            return line
+
+
+class _TokenBucket:
+    """Token bucket rate limiter.
+
+    Allows bursts of up to "burst" events and "rate" events per second on
+    average after that.
+    """
+
+    def __init__(self, burst, rate, now):
+        self._burst = burst
+        self._rate = rate
+        self._tokens = burst
+        self._last_refill = now
+
+    def _Refill(self, now):
+        refill = (now - self._last_refill) * self._rate
+        self._tokens = min(self._burst, self._tokens + refill)
+        self._last_refill = now
+
+    def TryTake(self, now):
+        """Take one token if available, returns True on success."""
+        self._Refill(now)
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def GetDelay(self, now):
+        """Returns the number of seconds until a token is available."""
+        self._Refill(now)
+        return max(0, (1 - self._tokens) / self._rate)
+
+
+class SendQueueStats:
+    """Snapshot of the outbound message queue state."""
+
+    def __init__(self, depth, oldest_wait, last_wait):
+        # Number of lines queued and not yet sent.
+        self.depth = depth
+        # Seconds the oldest queued line has been waiting so far.
+        self.oldest_wait = oldest_wait
+        # Seconds the last sent chat message had to wait in the queue.
+        self.last_wait = last_wait
+
+    def __repr__(self):
+        return 'SendQueueStats(depth=%r, oldest_wait=%.3f, last_wait=%.3f)' % (
+                self.depth, self.oldest_wait, self.last_wait)
+
+
+def _MakeBucket(rate, period, now):
+    """Returns a _TokenBucket allowing at most "rate" events per "period"."""
+    # Split the allowed count between the burst and the sustained rate so that
+    # no "period" window ever exceeds "rate".
+    if rate == 1:
+        # Nothing to split: a single token, taking a whole "period" to come
+        # back after each event.
+        return _TokenBucket(1, 1 / period, now)
+    burst = rate // 2
+    return _TokenBucket(burst, (rate - burst) / period, now)
 
 
-class Connection:
-    """Code logic for formatting and parsing IRC messages."""
+class RateLimits:
+    """Twitch rate limits for sending chat messages and joining channels.
+
+    The limits apply to the account, connections logged in with the same
+    account must share the same instance, and the same clock.
+    """
+
+    def __init__(self, message_rate=20, message_period=30, join_rate=20,
+                 join_period=10, clock=clock_lib.MONOTONIC):
+        self.clock = clock
+        now = clock()
+        self.chat = _MakeBucket(message_rate, message_period, now)
+        self.join = _MakeBucket(join_rate, join_period, now)
+
+
+class _OutputQueue:
+    """Outbound IRC lines waiting to be written to the connection.
+
+    PONGs go out before anything else, channel joins and chat messages
+    (PRIVMSG, including whispers) are paced to stay within the Twitch rate
+    limits and any other command is sent as soon as possible. Everything that
+    can be sent right away is concatenated so it can be written with a single
+    send().
+    """
+
+    _PRIORITY, _NORMAL, _JOIN, _CHAT = range(4)
+    # Commands going to the paced queues. The empty MODE sent after each JOIN
+    # must stay after it but doesn't count against the JOIN limit.
+    _PACED_COMMANDS = {'JOIN': _JOIN, 'MODE': _JOIN, 'PRIVMSG': _CHAT}
+
+    def __init__(self, rate_limits):
+        self._clock = rate_limits.clock
+        # Bytes taken out of the queues but not yet written, a partially sent
+        # line must be completed before anything else.
+        self._pending = bytearray()
+        # Queues of (enqueue time, command, line bytes), by priority.
+        self._queues = tuple(collections.deque() for _ in range(4))
+        self._buckets = {
+            self._JOIN: rate_limits.join,
+            self._CHAT: rate_limits.chat,
+        }
+        self._last_wait = 0.0
+
+    def Push(self, command, data):
+        if command == 'PONG':
+            queue = self._queues[self._PRIORITY]
+        else:
+            queue = self._queues[self._PACED_COMMANDS.get(command,
+                                                          self._NORMAL)]
+        queue.append((self._clock(), command, data))
+
+    def Take(self):
+        """Returns the bytes that are allowed to be sent now.
+
+        Call Sent() with the number of bytes actually written.
+        """
+        for queue in self._queues[:self._JOIN]:
+            while queue:
+                self._pending += queue.popleft()[2]
+        now = self._clock()
+        for idx, bucket in self._buckets.items():
+            queue = self._queues[idx]
+            while queue and (queue[0][1] == 'MODE' or bucket.TryTake(now)):
+                queued_time, _, data = queue.popleft()
+                if idx == self._CHAT:
+                    self._last_wait = now - queued_time
+                self._pending += data
+        return self._pending
+
+    def Sent(self, count):
+        del self._pending[:count]
+
+    def DropConnectionLines(self):
+        """Drop what only makes sense on the current connection.
+
+        That is the bytes not fully written, PONGs, other commands and the
+        JOINs, which the login of a new connection sends again. Only the chat
+        messages are kept. Returns the number of lines dropped.
+        """
+        dropped = self._pending.count(b'\n')
+        self._pending.clear()
+        for queue in self._queues[:self._CHAT]:
+            dropped += len(queue)
+            queue.clear()
+        return dropped
+
+    def HasPendingBytes(self):
+        return bool(self._pending)
+
+    def GetDelay(self):
+        """Returns seconds until more paced lines may be sent, or None."""
+        now = self._clock()
+        return min((bucket.GetDelay(now)
+                    for idx, bucket in self._buckets.items()
+                    if self._queues[idx]), default=None)
+
+    def GetStats(self):
+        now = self._clock()
+        oldest = min((queue[0][0] for queue in self._queues if queue),
+                     default=now)
+        return SendQueueStats(sum(len(queue) for queue in self._queues),
+                              now - oldest, self._last_wait)
+
+
+class Timer:
+    """A callback scheduled to run once or periodically, see Scheduler."""
+
+    __slots__ = ('when', 'period', 'cancelled', '_callback', '_args')
+
+    def __init__(self, when, period, callback, args):
+        # Time of the next call, on the clock of the Scheduler.
+        self.when = when
+        # Seconds between calls, None for a one shot timer.
+        self.period = period
+        self.cancelled = False
+        self._callback = callback
+        self._args = args
+
+    def Cancel(self):
+        """Stop the timer, the callback won't be called (anymore)."""
+        self.cancelled = True
+
+    def Run(self):
+        """Call the callback, returns its result."""
+        if self.cancelled:
+            return None
+        return self._callback(*self._args)
+
+    def __repr__(self):
+        return 'Timer(when=%.3f, period=%r, callback=%r, cancelled=%r)' % (
+            self.when, self.period, self._callback, self.cancelled)
+
+
+class Scheduler:
+    """Runs callbacks at given times, kept ordered by time in a heap.
+
+    The client loop calls PopDue() and runs the returned timers, then waits
+    for network input no longer than GetTimeout(), so it only wakes up when
+    there's something to do. Callbacks are called from the client loop, like
+    the Handle*() methods, and may also return awaitables.
+    """
+
+    def __init__(self, clock=clock_lib.MONOTONIC):
+        self._clock = clock
+        # Heap of (when, sequence, timer), the sequence keeps timers due at
+        # the same time in scheduling order. Cancelled timers are dropped
+        # when they reach the top.
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def _Push(self, timer):
+        heapq.heappush(self._heap, (timer.when, next(self._sequence), timer))
+
+    def CallLater(self, delay, callback, *args):
+        """Call "callback(*args)" once, after "delay" seconds."""
+        timer = Timer(self._clock() + delay, None, callback, args)
+        self._Push(timer)
+        return timer
+
+    def CallEvery(self, period, callback, *args, delay=None):
+        """Call "callback(*args)" every "period" seconds until cancelled.
+
+        The first call happens after "delay" seconds, by default "period".
+        """
+        if period <= 0:
+            raise ValueError('timer period must be positive: %r' % period)
+        if delay is None:
+            delay = period
+        timer = Timer(self._clock() + delay, period, callback, args)
+        self._Push(timer)
+        return timer
+
+    def _DropCancelled(self):
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+
+    def GetTimeout(self):
+        """Seconds until the next timer is due, None if there's none."""
+        self._DropCancelled()
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self._clock())
+
+    def PopDue(self):
+        """Returns the timers that are due, in order, to be Run().
+
+        Periodic timers are scheduled again for their next period, skipping
+        the periods that were missed rather than running them in a burst.
+        """
+        heap = self._heap
+        now = self._clock()
+        due = []
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                continue
+            due.append(timer)
+            if timer.period is not None:
+                timer.when += timer.period
+                if timer.when <= now:
+                    timer.when = now + timer.period
+                self._Push(timer)
+        return due
+
+    def __len__(self):
+        """Number of scheduled timers, including cancelled ones not dropped
+        yet."""
+        return len(self._heap)
+
+
+class Backoff:
+    """Jittered exponential backoff between reconnection attempts.
+
+    Each delay is picked at random between 0 and a maximum doubling with every
+    attempt, from "min_delay" up to "max_delay" seconds. The randomness keeps
+    bots that lost their connections at the same time from all coming back at
+    the same time too. Losing a connection that was up for "reset_after"
+    seconds or more starts over from "min_delay".
+    """
+
+    def __init__(self, min_delay=1, max_delay=120, reset_after=60):
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._reset_after = reset_after
+        self._ceiling = min_delay
+
+    def Reset(self):
+        """Start over from "min_delay", after a successful connection."""
+        self._ceiling = self._min_delay
+
+    def NextDelay(self, connected_for=None):
+        """Returns the seconds to wait before the next attempt.
+
+        "connected_for" is how long the lost connection was up, None when
+        retrying after a failed attempt.
+        """
+        if connected_for is not None and connected_for >= self._reset_after:
+            self.Reset()
+        delay = random.uniform(0, self._ceiling)
+        self._ceiling = min(self._ceiling * 2, self._max_delay)
+        return delay
+
+
+class _ConnectionBase:
+    """Code logic for formatting and parsing IRC messages.
+
+    Shared by the selectors based Connection and the asyncio based
+    AsyncConnection, which only differ in how they do network I/O.
+    """
 
     _BUFFER_SIZE = 1048576  # 1Mb.
     _MAX_IRC_LINE = 2046  # 2048 including \r\n.
 
-    def __init__(self, log_traffic=False):
+    def __init__(self, log_traffic=False, rate_limits=None, reconnect=None,
+                 clock=clock_lib.MONOTONIC):
         self._log_traffic = log_traffic
-        self._conn = None
+        self._clock = clock
         self._activity_timer = None
         self._conn_timeout = None
-        self._selector = None
-        self._input_buffer = ''
-        self.channel = None
-        # List of users, indexed by username.
-        self._userlist = {}
-
-    def GetUserList(self):
-        return self._userlist
-
-    def UpdateUserList(self, userlist):
+        self._input = _LineBuffer(self._BUFFER_SIZE, self._MAX_IRC_LINE)
+        self._output = _OutputQueue(rate_limits or RateLimits(clock=clock))
+        # Set while queuing lines to send them all at once.
+        self._hold_flush = False
+        # Backoff to reconnect with when the connection is lost, None to not
+        # reconnect.
+        self._reconnect = reconnect
+        # Connect() arguments, reused to reconnect.
+        self._address = None
+        self._nickname = None
+        self._server_pass = None
+        # Time of the last connection, None once the connection was lost.
+        self._connected_at = None
+        # Time of the next reconnection attempt.
+        self._next_reconnect = None
+        # List of users indexed by username, for each joined channel.
+        self._userlists = {}
+        self._scheduler = Scheduler(clock)
+
+    @property
+    def channels(self):
+        """The joined channels."""
+        return self._userlists.keys()
+
+    @property
+    def scheduler(self):
+        """Scheduler for timers run by the client loop."""
+        return self._scheduler
+
+    @property
+    def clock(self):
+        """Clock of the connection, its scheduler and rate limits."""
+        return self._clock
+
+    def GetUserList(self, channel):
+        """Returns the userlist of "channel", None if it wasn't joined."""
+        return self._userlists.get(channel)
+
+    def UpdateUserList(self, channel, userlist):
         """Set the user list to contain ony the users listed in "userlist"."""
+        old_list = self._userlists.get(channel)
+        if old_list is None:
+            logging.warning('[NAMES] Received for unknown channel %r', channel)
+            return
         # Drop any usernames not listed.
-        new_list = {}
-        for user in userlist:
-            logging.info('[NAMES] User %r joined %r.', user, self.channel)
-            new_list[user] = self._userlist.get(user, User(user))
-        self._userlist = new_list
+        old_list.Replace(userlist)
+        logging.info('[NAMES] %d users in %r.', len(old_list), channel)
+
+    def GetUserListFootprint(self):
+        """Returns the UserListFootprint of all the joined channels."""
+        return sum((userlist.GetFootprint()
+                    for userlist in self._userlists.values()),
+                   UserListFootprint(0, 0, 0))
+
+    def _Flush(self):
+        """Write as much of the output queue as allowed to the connection."""
+        raise NotImplementedError
 
     def SendRaw(self, text):
         """Some some raw IRC line."""
         if self._log_traffic:
             logging.debug('< %r', text)
-        self._conn.send(bytes('%s\r\n' % text, 'UTF-8'))
-
-    def Connect(self, host, port, nickname, channel=None, server_pass=None,
-                activity_timer=600):
-        """Connect to an IRC server, authenticate and join a channel."""
-        self._conn = socket.socket()
-        self._conn.connect((host, port))
-        self._conn.setblocking(False)
+        self._output.Push(text.split(' ', maxsplit=1)[0],
+                          bytes('%s\r\n' % text, 'UTF-8'))
+        if not self._hold_flush:
+            self._Flush()
+
+    def GetSendQueueStats(self):
+        """Returns a SendQueueStats with the outbound queue backlog."""
+        return self._output.GetStats()
+
+    def _Login(self, nickname, channels, server_pass):
+        """Authenticate and join channels on a freshly opened connection.
+
+        Everything is queued first then written at once, without waiting for
+        any reply in between.
+        """
+        self._hold_flush = True
+        try:
+            # Ask for the Twitch commands/membership/tags capabilities.
+            self.SendRaw('CAP REQ :twitch.tv/commands')
+            self.SendRaw('CAP REQ :twitch.tv/membership')
+            self.SendRaw('CAP REQ :twitch.tv/tags')
+            if server_pass:
+                self.SendPass(server_pass)
+            self.SendNick(nickname)
+            # The JOINs are paced by the output queue to stay within the
+            # Twitch join rate limits.
+            for channel in channels:
+                self.JoinChannel(channel)
+        finally:
+            self._hold_flush = False
+        self._Flush()
+
+    def _Connected(self, host, port, nickname, server_pass, activity_timer):
+        """Record a successful connection, see Connect()."""
+        self._address = (host, port)
+        self._nickname = nickname
+        self._server_pass = server_pass
         self._activity_timer = activity_timer
-        self._conn_timeout = time.time() + self._activity_timer
+        self._connected_at = self._clock()
+        self._next_reconnect = None
+        self._ResetActivityTimer()
         logging.debug('Connected to %s:%s' % (host, port))
-        # Initialize selector used to wait for read data.
-        self._selector = selectors.DefaultSelector()
-        self._selector.register(self._conn, selectors.EVENT_READ)
-
-        # Ask for the Twitch commands/membership/tags capabilities.
-        self.SendRaw('CAP REQ :twitch.tv/commands')
-        self.SendRaw('CAP REQ :twitch.tv/membership')
-        self.SendRaw('CAP REQ :twitch.tv/tags')
-        if server_pass:
-            self.SendPass(server_pass)
-        self.SendNick(nickname)
-        if channel:
-            self.JoinChannel(channel)
-        logging.debug('Joined %s' % channel)
+
+    def _ReconnectDelay(self):
+        """Returns the seconds left until the next reconnection attempt."""
+        now = self._clock()
+        if self._next_reconnect is None:
+            connected_for = None
+            if self._connected_at is not None:
+                connected_for = now - self._connected_at
+                self._connected_at = None
+            delay = self._reconnect.NextDelay(connected_for)
+            self._next_reconnect = now + delay
+            logging.warning('Reconnecting in %.1fs', delay)
+        return max(0.0, self._next_reconnect - now)
+
+    def _ResetForReconnect(self):
+        """Drop the state of the lost connection, except for the channels."""
+        self._next_reconnect = None
+        self._input.Clear()
+        dropped = self._output.DropConnectionLines()
+        if dropped:
+            logging.warning('Dropped %d lines not sent before the connection '
+                            'was lost', dropped)
+
+    def _HandleReconnectCommand(self):
+        """Twitch asks to reconnect, e.g. before a server restart."""
+        logging.info('Server asked to reconnect')
+        if not self.IsClosed():
+            self._CloseConnectionInput()
+        if self._reconnect:
+            # Right away, no need to back off.
+            self._connected_at = None
+            self._next_reconnect = self._clock()
 
     def SendPong(self, msg):
         self.SendRaw('PONG %s' % msg)
@@ -181,122 +1216,745 @@ class Connection:
     def SendPass(self, password):
         self.SendRaw('PASS %s' % password)
 
-    def JoinChannel(self, chan):
+    def JoinChannel(self, chan, userlist=None):
+        """Join "chan", optionally starting from a known "userlist"."""
         self.SendRaw('JOIN %s' % chan)
-        self.channel = chan
+        self._userlists.setdefault(
+            chan, UserList() if userlist is None else userlist)
         # When joining a channel also send an empty MODE command, Twitch waits
         # for this before sending the user list.
         self.SendRaw('MODE %s' % chan)
+        logging.debug('Joining %s' % chan)
 
     def PartChannel(self, chan):
         self.SendRaw('PART %s' % chan)
+        self._userlists.pop(chan, None)
+
+    def _ResetActivityTimer(self):
+        self._conn_timeout = self._clock() + self._activity_timer
+
+    def _CapTimeout(self, timeout):
+        """Returns how long to wait for input, given a wanted "timeout".
+
+        Waiting is limited by the activity timeout and by when rate limited
+        output may be sent. A None "timeout" means no limit was wanted.
+        """
+        delay = max(0.0, self._conn_timeout - self._clock())
+        output_delay = self._output.GetDelay()
+        if output_delay is not None:
+            delay = min(delay, output_delay)
+        return delay if timeout is None else min(timeout, delay)
+
+    def _TakeLines(self):
+        """Returns the list of all complete lines already buffered."""
+        lines = []
+        line = self._input.NextLine()
+        while line is not None:
+            lines.append(line)
+            if (line.endswith('RECONNECT') and
+                Message(line).command == 'RECONNECT'):
+                self._HandleReconnectCommand()
+            line = self._input.NextLine()
+        if self._log_traffic:
+            for line in lines:
+                logging.debug('> %r' % line)
+        return lines
+
+
+# send() errors meaning the connection is gone.
+_CONNECTION_LOST_ERRORS = frozenset((errno.EPIPE, errno.ECONNRESET,
+                                     errno.ECONNABORTED, errno.ENOTCONN,
+                                     errno.ETIMEDOUT))
+
+
+class Connection(_ConnectionBase):
+    """IRC connection doing blocking I/O through a selectors based loop."""
+
+    def __init__(self, log_traffic=False, rate_limits=None, selector=None,
+                 reconnect=None, clock=clock_lib.MONOTONIC):
+        """Initialize the connection.
+
+        Args:
+            log_traffic: whether to log all the lines sent and received.
+            rate_limits: RateLimits of the account, shared with any other
+                connection using the same account.
+            selector: selector to register the socket with, shared with other
+                connections, see ConnectionPool. By default the connection uses
+                its own.
+            reconnect: Backoff to reconnect with when the connection is lost,
+                None to let ReadLines() report the connection closed instead.
+            clock: clock timing the timers, rate limits and timeouts, see
+                lib/clock.py. Must be the clock of "rate_limits".
+        """
+        super().__init__(log_traffic, rate_limits, reconnect, clock)
+        self._conn = None
+        self._shared_selector = selector
+        self._selector = None
+        # Whether the selector also waits for the socket to become writable.
+        self._wait_writable = False
+
+    def _Flush(self):
+        if not self._selector:
+            # Closed, queued chat messages are sent once reconnected.
+            return
+        data = self._output.Take()
+        if data:
+            try:
+                self._output.Sent(self._conn.send(data))
+            except socket.error as err:
+                ec = err.args[0]
+                if ec in _CONNECTION_LOST_ERRORS:
+                    # Like a closed connection on read, ReadLines() reports
+                    # it or reconnects.
+                    logging.error('Connection lost while sending: %s', err)
+                    self._CloseConnectionInput()
+                    return
+                if ec != errno.EAGAIN and ec != errno.EWOULDBLOCK:
+                    raise
+        # Only wait for the socket to be writable while a write is pending,
+        # otherwise select() would return immediately.
+        wait_writable = self._output.HasPendingBytes()
+        if self._selector and wait_writable != self._wait_writable:
+            events = selectors.EVENT_READ
+            if wait_writable:
+                events |= selectors.EVENT_WRITE
+            self._selector.modify(self._conn, events, self)
+            self._wait_writable = wait_writable
+
+    def _Open(self, host, port):
+        conn = socket.socket()
+        try:
+            conn.connect((host, port))
+        except OSError:
+            conn.close()
+            raise
+        conn.setblocking(False)
+        self._conn = conn
+        # Initialize selector used to wait for read data.
+        self._selector = self._shared_selector or selectors.DefaultSelector()
+        self._selector.register(self._conn, selectors.EVENT_READ, self)
+
+    def Connect(self, host, port, nickname, channels=(), server_pass=None,
+                activity_timer=600):
+        """Connect to an IRC server, authenticate and join channels."""
+        self._Open(host, port)
+        self._Connected(host, port, nickname, server_pass, activity_timer)
+        self._Login(nickname, channels, server_pass)
+
+    def _Reconnect(self):
+        """Connect again and rejoin the channels, returns False on failure."""
+        self._ResetForReconnect()
+        self.Close()
+        try:
+            self._Open(*self._address)
+        except OSError as err:
+            logging.warning('Failed to reconnect: %s', err)
+            return False
+        self._Connected(*self._address, self._nickname, self._server_pass,
+                        self._activity_timer)
+        logging.info('Reconnected, rejoining %d channels',
+                     len(self._userlists))
+        self._Login(self._nickname, list(self._userlists), self._server_pass)
+        return True
+
+    def _WaitReconnect(self, timeout):
+        """Reconnect once due, waiting no longer than "timeout" for it."""
+        delay = self._ReconnectDelay()
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return
+        time.sleep(delay)
+        self._Reconnect()
+
+    def IsClosed(self):
+        return self._selector is None
 
     def _CloseConnectionInput(self):
         """Closes the input part of the connection."""
         self._selector.unregister(self._conn)
         self._selector = None
-        self._conn.shutdown(socket.SHUT_RD)
+        self._wait_writable = False
+        try:
+            self._conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            # Already disconnected.
+            pass
+
+    def Close(self):
+        """Closes the connection."""
+        if self._selector:
+            self._selector.unregister(self._conn)
+            self._selector = None
+            self._wait_writable = False
+        if self._conn:
+            self._conn.close()
+
+    def _ReadAvailable(self):
+        """Read all the data available on the socket.
+
+        Returns False if the connection was closed.
+        """
+        try:
+            # Exhaust all input data.
+            while True:
+                count = self._input.RecvInto(self._conn)
+                if count is None:
+                    # Buffer full, the buffered lines need to be consumed
+                    # first.
+                    return True
+                if not count:
+                    # Socket closed.
+                    self._CloseConnectionInput()
+                    return False
+                # We got some bytes, reset the activity timer.
+                self._ResetActivityTimer()
+        except socket.error as err:
+            ec = err.args[0]
+            if ec == errno.EAGAIN or ec == errno.EWOULDBLOCK:
+                return True
+            if ec == errno.ECONNRESET:
+                # Connection forcibly closed.
+                self._CloseConnectionInput()
+                return False
+            raise
+
+    def _CheckActivityTimer(self):
+        """Closes the connection if the activity timeout was reached."""
+        if self._clock() < self._conn_timeout:
+            return True
+        logging.error('Connection timed out, closing.')
+        self._CloseConnectionInput()
+        return False
 
     def _ReadMoreData(self, timeout):
+        # Wake up in time to send any rate limited messages or to notice the
+        # activity timeout.
+        timeout = self._CapTimeout(timeout)
         # Wait for data to be available.
         for key, mask in self._selector.select(timeout=timeout):
             # There's only one file descriptor registered, no need to check
             # which file descriptor received the event.
-            try:
-                # Exhaust all input data.
-                while True:
-                    data = key.fileobj.recv(self._BUFFER_SIZE)
-                    if not data:
-                        # Socket closed.
-                        self._CloseConnectionInput()
-                        return False
-                    self._input_buffer += data.decode(encoding='utf-8')
-                    # We got some bytes, reset the activity timer.
-                    self._conn_timeout = time.time() + self._activity_timer
-            except socket.error as err:
-                ec = err.args[0]
-                if ec == errno.EAGAIN or ec == errno.EWOULDBLOCK:
-                    break
-                if ec == errno.ECONNRESET:
-                    # Connection forcibly closed.
-                    self._CloseConnectionInput()
-                    return False
-                raise
+            if mask & selectors.EVENT_READ and not self._ReadAvailable():
+                return False
 
-        # Connection activity timeout reached.
-        if time.time() >= self._conn_timeout:
-            # Close connection.
-            logging.error('Connection timed out, closing.')
-            self._CloseConnectionInput()
-            return False
+        # Send whatever became writable or allowed by the rate limits.
+        self._Flush()
 
-        return True
+        # Connection activity timeout reached.
+        return self._CheckActivityTimer()
 
     def ReadNextLine(self, timeout):
         """Reads the next IRC line."""
-        now = time.time()
-        end_time = now + timeout
+        end_time = self._clock() + timeout
         while True:
+            line = self._input.NextLine()
+            if line is not None:
+                break
+
             # Timeout exit condition.
-            now = time.time()
+            now = self._clock()
             if now >= end_time:
                 raise TimeoutError('timeout waiting for new message')
 
-            if '\r\n' not in self._input_buffer:
-                if not self._selector:
-                    logging.info('connection closed')
-                    return None
-                self._ReadMoreData(end_time - now)
-
-            parts = self._input_buffer.split('\r\n', maxsplit=1)
-            if len(parts) < 2:
-                continue
-
-            line, self._input_buffer = parts
-            if len(line) > self._MAX_IRC_LINE:
-                logging.error('IRC line too long %d > %d' %
-                              (len(line), self._MAX_IRC_LINE))
-                continue
-
-            break
+            if not self._selector:
+                logging.info('connection closed')
+                return None
+            self._ReadMoreData(end_time - now)
 
         if self._log_traffic:
             logging.debug('> %r' % line)
         return line
 
+    def ReadLines(self, timeout):
+        """Reads all the IRC lines available after waiting at most once.
+
+        Lines already buffered are returned without waiting, otherwise waits
+        up to "timeout" seconds (or until the connection needs attention if
+        None) for more data. Returns a possibly empty list of lines or None if
+        the connection is closed and not reconnecting.
+        """
+        lines = self._TakeLines()
+        if not lines:
+            if self._selector:
+                self._ReadMoreData(timeout)
+            elif self._reconnect:
+                self._WaitReconnect(timeout)
+            else:
+                logging.info('connection closed')
+                return None
+            lines = self._TakeLines()
+        return lines
+
+
+class AsyncConnection(_ConnectionBase):
+    """IRC connection doing I/O through asyncio streams.
+
+    Same interface as Connection except that Connect() and ReadLines() are
+    coroutines. Sending is never blocking, so handlers can call the Send*()
+    methods in the same way with either connection type.
+    """
+
+    def __init__(self, log_traffic=False, rate_limits=None, reconnect=None,
+                 clock=clock_lib.MONOTONIC):
+        super().__init__(log_traffic, rate_limits, reconnect, clock)
+        self._reader = None
+        self._writer = None
+        # Timer handle to flush rate limited messages later.
+        self._flush_timer = None
+
+    def _Flush(self):
+        if not self._reader:
+            # Closed, queued chat messages are sent once reconnected.
+            return
+        # The stream writer buffers anything the socket doesn't take right
+        # away, so all the allowed bytes can be handed over to it.
+        data = self._output.Take()
+        if data:
+            self._writer.write(bytes(data))
+            self._output.Sent(len(data))
+        delay = self._output.GetDelay()
+        if delay is not None and self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                delay, self._OnFlushTimer)
+
+    def _OnFlushTimer(self):
+        self._flush_timer = None
+        self._Flush()
+
+    async def Connect(self, host, port, nickname, channels=(),
+                      server_pass=None, activity_timer=600):
+        """Connect to an IRC server, authenticate and join channels."""
+        self._reader, self._writer = await asyncio.open_connection(host, port)
+        self._Connected(host, port, nickname, server_pass, activity_timer)
+        self._Login(nickname, channels, server_pass)
+
+    async def _Reconnect(self):
+        """Connect again and rejoin the channels, returns False on failure."""
+        self._ResetForReconnect()
+        try:
+            self._reader, self._writer = await asyncio.open_connection(
+                *self._address)
+        except OSError as err:
+            logging.warning('Failed to reconnect: %s', err)
+            return False
+        self._Connected(*self._address, self._nickname, self._server_pass,
+                        self._activity_timer)
+        logging.info('Reconnected, rejoining %d channels',
+                     len(self._userlists))
+        self._Login(self._nickname, list(self._userlists), self._server_pass)
+        return True
+
+    async def _WaitReconnect(self, timeout):
+        """Reconnect once due, waiting no longer than "timeout" for it."""
+        delay = self._ReconnectDelay()
+        if timeout is not None and timeout < delay:
+            await asyncio.sleep(timeout)
+            return
+        await asyncio.sleep(delay)
+        await self._Reconnect()
+
+    def IsClosed(self):
+        return self._reader is None
+
+    def _CloseConnectionInput(self):
+        """Stops reading from the connection and closes it."""
+        self._reader = None
+        if self._flush_timer:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._writer.close()
+
+    async def _ReadMoreData(self, timeout):
+        free = self._input.GetFreeSpace()
+        if free is None:
+            # Buffer full, the buffered lines need to be consumed first.
+            return True
+
+        # Output is flushed by its own timer, only wake up in time to notice
+        # the activity timeout.
+        delay = max(0.0, self._conn_timeout - self._clock())
+        timeout = delay if timeout is None else min(timeout, delay)
+        try:
+            data = await asyncio.wait_for(self._reader.read(len(free)),
+                                          timeout)
+        except asyncio.TimeoutError:
+            data = None
+        except ConnectionResetError:
+            # Connection forcibly closed.
+            self._CloseConnectionInput()
+            return False
+
+        if data is not None:
+            if not data:
+                # Socket closed.
+                self._CloseConnectionInput()
+                return False
+            free[:len(data)] = data
+            self._input.Commit(len(data))
+            # We got some bytes, reset the activity timer.
+            self._ResetActivityTimer()
+
+        # Connection activity timeout reached.
+        if self._clock() >= self._conn_timeout:
+            # Close connection.
+            logging.error('Connection timed out, closing.')
+            self._CloseConnectionInput()
+            return False
+
+        return True
+
+    async def ReadLines(self, timeout):
+        """Reads all the IRC lines available after waiting at most once.
+
+        See Connection.ReadLines().
+        """
+        lines = self._TakeLines()
+        if not lines:
+            if self._reader:
+                await self._ReadMoreData(timeout)
+            elif self._reconnect:
+                await self._WaitReconnect(timeout)
+            else:
+                logging.info('connection closed')
+                return None
+            lines = self._TakeLines()
+        return lines
+
+
+class ConnectionPool:
+    """Spreads the joined channels over a pool of Connections.
+
+    All the connections share one selector and the account rate limits. The
+    pool has the same interface as Connection so handlers use it in the same
+    way, messages for a channel being sent on the connection that joined it.
+    The pool answers the PINGs of each connection itself as handlers can't
+    tell on which connection a message arrived.
+    """
+
+    def __init__(self, channels_per_connection, log_traffic=False,
+                 rate_limits=None, reconnect=None, clock=clock_lib.MONOTONIC):
+        self._channels_per_connection = channels_per_connection
+        self._log_traffic = log_traffic
+        self._clock = clock
+        self._rate_limits = rate_limits or RateLimits(clock=clock)
+        # Backoff to retry opening connections with, None to fail instead.
+        self._reconnect = reconnect
+        self._selector = selectors.DefaultSelector()
+        self._scheduler = Scheduler(clock)
+        # Connect() arguments, reused for every connection opened.
+        self._connect_args = None
+        self._shards = []
+        # The connection that joined each channel, by channel.
+        self._channel_shards = {}
+        # Userlists of the channels of lost connections not joined again yet,
+        # by channel.
+        self._lost_channels = {}
+        # Time of the next attempt to join the lost channels.
+        self._next_reconnect = None
+
+    def Connect(self, host, port, nickname, channels=(), server_pass=None,
+                activity_timer=600):
+        """Connect to an IRC server and join channels, as many times as needed.
+        """
+        self._connect_args = {
+            'host': host,
+            'port': port,
+            'nickname': nickname,
+            'server_pass': server_pass,
+            'activity_timer': activity_timer,
+        }
+        for channel in channels:
+            self.JoinChannel(channel)
+
+    def _AddShard(self):
+        shard = Connection(self._log_traffic, self._rate_limits,
+                           selector=self._selector, clock=self._clock)
+        shard.Connect(**self._connect_args)
+        self._shards.append(shard)
+        logging.info('Opened pool connection #%d', len(self._shards))
+        return shard
+
+    def _PickShard(self):
+        """Returns the least loaded connection, opens one if all are full."""
+        shard = min(self._shards, key=lambda shard: len(shard.channels),
+                    default=None)
+        if (shard is None or
+            len(shard.channels) >= self._channels_per_connection):
+            shard = self._AddShard()
+        return shard
+
+    def _ReplaceClosedShards(self):
+        """Move the channels of closed connections to other connections."""
+        closed = [shard for shard in self._shards if shard.IsClosed()]
+        for shard in closed:
+            self._shards.remove(shard)
+            shard.Close()
+            logging.warning('Pool connection lost, moving its %d channels',
+                            len(shard.channels))
+        for shard in closed:
+            for chan in list(shard.channels):
+                del self._channel_shards[chan]
+                # Keep the known userlist, the connection taking over the
+                # channel gets the NAMES only minutes after joining.
+                self._lost_channels[chan] = shard.GetUserList(chan)
+        self._JoinLostChannels()
+
+    def _JoinLostChannels(self):
+        """Join the channels of lost connections, backing off on failure."""
+        if not self._lost_channels or (
+                self._next_reconnect is not None and
+                self._clock() < self._next_reconnect):
+            return
+        try:
+            while self._lost_channels:
+                chan = next(iter(self._lost_channels))
+                self.JoinChannel(chan, self._lost_channels[chan])
+                del self._lost_channels[chan]
+        except OSError as err:
+            if not self._reconnect:
+                raise
+            delay = self._reconnect.NextDelay()
+            self._next_reconnect = self._clock() + delay
+            logging.warning('Failed to open pool connection: %s, retrying '
+                            'in %.1fs', err, delay)
+            return
+        if self._next_reconnect is not None:
+            self._next_reconnect = None
+            self._reconnect.Reset()
+
+    @property
+    def channels(self):
+        """The joined channels."""
+        if self._lost_channels:
+            return self._channel_shards.keys() | self._lost_channels.keys()
+        return self._channel_shards.keys()
+
+    @property
+    def scheduler(self):
+        """Scheduler for timers run by the client loop."""
+        return self._scheduler
+
+    @property
+    def clock(self):
+        """Clock of the connections, the scheduler and the rate limits."""
+        return self._clock
+
+    def GetUserList(self, channel):
+        """Returns the userlist of "channel", None if it wasn't joined."""
+        shard = self._channel_shards.get(channel)
+        if not shard:
+            return self._lost_channels.get(channel)
+        return shard.GetUserList(channel)
+
+    def UpdateUserList(self, channel, userlist):
+        shard = self._channel_shards.get(channel)
+        if not shard:
+            logging.warning('[NAMES] Received for unknown channel %r', channel)
+            return
+        shard.UpdateUserList(channel, userlist)
+
+    def GetUserListFootprint(self):
+        return sum((shard.GetUserListFootprint() for shard in self._shards),
+                   UserListFootprint(0, 0, 0))
+
+    def GetSendQueueStats(self):
+        stats = [shard.GetSendQueueStats() for shard in self._shards]
+        return SendQueueStats(sum(stat.depth for stat in stats),
+                              max((stat.oldest_wait for stat in stats),
+                                  default=0.0),
+                              max((stat.last_wait for stat in stats),
+                                  default=0.0))
+
+    def _AnyShard(self):
+        """Connection for traffic not related to a channel.
+
+        Returns None while all the connections are lost.
+        """
+        if self._shards:
+            return self._shards[0]
+        if self._lost_channels:
+            logging.warning('Dropping message, all pool connections are lost')
+            return None
+        return self._AddShard()
+
+    def SendRaw(self, text):
+        shard = self._AnyShard()
+        if shard:
+            shard.SendRaw(text)
+
+    def SendPong(self, msg):
+        shard = self._AnyShard()
+        if shard:
+            shard.SendPong(msg)
+
+    def SendMessage(self, chan, msg):
+        shard = self._channel_shards.get(chan)
+        if not shard:
+            logging.warning('Dropping message for unknown channel %r', chan)
+            return
+        shard.SendMessage(chan, msg)
+
+    def SendWhisper(self, recipient, msg):
+        shard = self._AnyShard()
+        if shard:
+            shard.SendWhisper(recipient, msg)
+
+    def JoinChannel(self, chan, userlist=None):
+        """Join "chan" on the least loaded connection."""
+        if chan in self._channel_shards:
+            return
+        if userlist is None:
+            userlist = self._lost_channels.pop(chan, None)
+        shard = self._PickShard()
+        shard.JoinChannel(chan, userlist)
+        self._channel_shards[chan] = shard
+
+    def PartChannel(self, chan):
+        self._lost_channels.pop(chan, None)
+        shard = self._channel_shards.pop(chan, None)
+        if shard:
+            shard.PartChannel(chan)
+
+    def _TakeLines(self):
+        lines = []
+        for shard in self._shards:
+            for line in shard._TakeLines():
+                if line.startswith('PING '):
+                    shard.SendPong(line[5:])
+                    continue
+                lines.append(line)
+        return lines
+
+    def ReadLines(self, timeout):
+        """Reads all the IRC lines available after waiting at most once.
+
+        See Connection.ReadLines(), never returns None as the channels of
+        closed connections are moved to other connections.
+        """
+        lines = self._TakeLines()
+        if not lines:
+            # Wake up in time to send any rate limited messages, to notice
+            # an activity timeout or to join the lost channels again.
+            for shard in self._shards:
+                timeout = shard._CapTimeout(timeout)
+            if self._next_reconnect is not None:
+                delay = max(0.0, self._next_reconnect - self._clock())
+                timeout = delay if timeout is None else min(timeout, delay)
+            for key, mask in self._selector.select(timeout=timeout):
+                if mask & selectors.EVENT_READ:
+                    key.data._ReadAvailable()
+            for shard in self._shards:
+                if not shard.IsClosed() and shard._CheckActivityTimer():
+                    # Send whatever became writable or allowed by the rate
+                    # limits.
+                    shard._Flush()
+            lines = self._TakeLines()
+        self._ReplaceClosedShards()
+        return lines
+
 
 class Client:
-    _TICK_INTERVAL = 1  # Call HandleTick() every 1 second.
+    # Call HandleTick() every 1 second, if the handler has one.
+    _TICK_INTERVAL = 1
 
     def __init__(self, handler):
         self._handler = handler
+        # Event loop used to run the coroutines returned by async handlers.
+        self._loop = None
+
+    def _Complete(self, result):
+        """Wait for a handler result which might be a coroutine."""
+        if not inspect.isawaitable(result):
+            return result
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(result)
 
     def Run(self):
         """Runs the IRC client, reads any network packets then answers them."""
-        next_tick = time.time() + self._TICK_INTERVAL
+        conn = self._handler.GetConnection()
+        self._handler.Start()
+        scheduler = conn.scheduler
+        if self._handler.HandlesTick():
+            scheduler.CallEvery(self._TICK_INTERVAL, self._handler.HandleTick)
         while True:
-            now = time.time()
-            if now >= next_tick:
-                self._handler.HandleTick()
-                next_tick += self._TICK_INTERVAL
-                continue
+            for timer in scheduler.PopDue():
+                self._Complete(timer.Run())
 
-            try:
-                line = self._handler.GetConnection().ReadNextLine(
-                        next_tick - now)
-            except TimeoutError:
-                continue
-
-            if line is None:
+            # Sleep until the next timer is due unless network input comes.
+            lines = conn.ReadLines(scheduler.GetTimeout())
+            if lines is None:
                 # Connection closed.
                 break
 
-            msg = Message()
-            if not msg.Parse(line):
-                # Invalid formatted message, skip.
-                continue
+            # Handle the whole batch before checking the tick again.
+            for line in lines:
+                msg = Message()
+                if not msg.Parse(line):
+                    # Invalid formatted message, skip.
+                    continue
+
+                self._Complete(self._handler.HandleMessage(msg))
+
+
+class AsyncClient:
+    """Client variant running over an AsyncConnection.
+
+    Coroutines returned by async handlers are run as separate tasks, so slow
+    handlers don't hold back reading and handling the following messages.
+    """
+    # Call HandleTick() every 1 second, if the handler has one.
+    _TICK_INTERVAL = 1
+
+    def __init__(self, handler):
+        self._handler = handler
+        # Tasks running async handlers, referenced until done.
+        self._tasks = set()
+
+    def _Complete(self, result):
+        """Start running a handler result if it's a coroutine."""
+        if not inspect.isawaitable(result):
+            return
+        task = asyncio.ensure_future(result)
+        self._tasks.add(task)
+        task.add_done_callback(self._TaskDone)
+
+    def _TaskDone(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error('Async handler failed: %r', task.exception(),
+                          exc_info=task.exception())
+
+    async def Run(self):
+        """Runs the IRC client, reads any network packets then answers them."""
+        conn = self._handler.GetConnection()
+        self._handler.Start()
+        scheduler = conn.scheduler
+        if self._handler.HandlesTick():
+            scheduler.CallEvery(self._TICK_INTERVAL, self._handler.HandleTick)
+        try:
+            while True:
+                for timer in scheduler.PopDue():
+                    self._Complete(timer.Run())
+
+                # Sleep until the next timer is due unless network input
+                # comes.
+                lines = await conn.ReadLines(scheduler.GetTimeout())
+                if lines is None:
+                    # Connection closed.
+                    break
 
-            self._handler.HandleMessage(msg)
+                # Handle the whole batch before checking the tick again.
+                for line in lines:
+                    msg = Message()
+                    if not msg.Parse(line):
+                        # Invalid formatted message, skip.
+                        continue
+
+                    self._Complete(self._handler.HandleMessage(msg))
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
 
 
 class _PingHandlerMixin:
@@ -314,37 +1972,35 @@ class _JoinPartHandlerMixin:
         if not msg.sender:
             logging.warning('[JOIN] Unexpected message format: %r', msg)
             return False
-        if msg.command_args != self._conn.channel:
-            logging.warning('[JOIN] Received for another channel: %r',
-                            msg.command_args)
+        chan = msg.command_args
+        userlist = self._conn.GetUserList(chan)
+        if userlist is None:
+            logging.warning('[JOIN] Received for another channel: %r', chan)
             return False
         # Process the JOIN by adding the user to the userlist.
-        userlist = self._conn.GetUserList()
         if msg.sender in userlist:
             logging.warning('[JOIN] User %r already part of channel %r',
-                            msg.sender, self._conn.channel)
+                            msg.sender, chan)
             return False
-        userlist[msg.sender] = User(msg.sender)
-        logging.info('[JOIN] User %r joined %r.', msg.sender,
-                     self._conn.channel)
+        userlist.AddUser(msg.sender)
+        logging.info('[JOIN] User %r joined %r.', msg.sender, chan)
         return True
 
     def HandlePART(self, msg):
         if not msg.sender:
             logging.warning('[PART] Unexpected message format: %r', msg)
             return False
-        if msg.command_args != self._conn.channel:
-            logging.warning('[PART] Received for another channel: %r',
-                            msg.command_args)
+        chan = msg.command_args
+        userlist = self._conn.GetUserList(chan)
+        if userlist is None:
+            logging.warning('[PART] Received for another channel: %r', chan)
             return False
         # Process the PART by removing the user from the userlist.
-        userlist = self._conn.GetUserList()
-        if msg.sender not in userlist:
+        if not userlist.RemoveUser(msg.sender):
             logging.warning('[PART] User %r not part of channel %r',
-                            msg.sender, self._conn.channel)
+                            msg.sender, chan)
             return False
-        del userlist[msg.sender]
-        logging.info('[PART] User %r left %r.', msg.sender, self._conn.channel)
+        logging.info('[PART] User %r left %r.', msg.sender, chan)
         return True
 
 
@@ -357,19 +2013,19 @@ class _ModeHandlerMixin:
             logging.warning('[MODE] Unexpected message format: %r', msg)
             return False
         chan, mode, target = parts
-        if chan != self._conn.channel:
+        userlist = self._conn.GetUserList(chan)
+        if userlist is None:
             logging.warning('[MODE] Received for another channel: %r', chan)
             return False
 
         # Apply the mode change to the target user.
-        user = self._conn.GetUserList().get(target)
+        user = userlist.UpdateMode(target, mode)
         if not user:
             logging.warning('[MODE] User %r not part of channel %r',
-                            target, self._conn.channel)
+                            target, chan)
             return False
-        user.UpdateMode(mode)
         logging.info('[MODE] User %r updated %r to mode %r on %r.', msg.sender,
-                     target, user.mode, self._conn.channel)
+                     target, user.mode, chan)
         return True
 
 
@@ -378,35 +2034,38 @@ class _UserListHandlerMixin:
 
     def __init__(self, conn):
         super().__init__(conn)
-        # The temporary userlist being built while receiving a stream of
-        # type 353 messages.
-        self._tmp_list = None
+        # The temporary userlists being built while receiving a stream of
+        # type 353 messages, by channel.
+        self._tmp_lists = {}
 
     def Handle353(self, msg):
-        # First 353 message, starts a new sequence.
-        if self._tmp_list is None:
-            self._tmp_list = []
         parts = msg.command_args.split(':', maxsplit=1)
-        if len(parts) != 2 or not parts[0].endswith('%s ' % self._conn.channel):
+        if len(parts) != 2 or not parts[0].strip():
             logging.error('Invalid 353 type message format: %r', msg)
             return False
+        # The channel is the last parameter before the ':'.
+        chan = parts[0].split()[-1]
+        if self._conn.GetUserList(chan) is None:
+            logging.error('353 type message for another channel: %r', msg)
+            return False
         # Everything after the first ':' should be a space delimited list of
         # nicknames. We drop any @+ status from the listed usernames, twitch
-        # doesn't use this feature anyways.
-        self._tmp_list.extend(name.lstrip('@+')
-                              for name in parts[1].split(' ')
-                              if name)
+        # doesn't use this feature anyways. The first 353 message for a
+        # channel starts a new sequence.
+        self._tmp_lists.setdefault(chan, []).extend(
+            name.lstrip('@+') for name in parts[1].split(' ') if name)
         return True
 
     def Handle366(self, msg):
-        if self._tmp_list is None:
+        parts = msg.command_args.split()
+        chan = parts[1] if len(parts) >= 2 else None
+        tmp_list = self._tmp_lists.pop(chan, None)
+        if tmp_list is None:
             logging.error('Unexpected 366/RPL_ENDOFNAMES without a preceeding '
                           '353/RPL_NAMREPLY')
             return False
         # End of user list, update the known channel userlist.
-        self._conn.UpdateUserList(self._tmp_list)
-        # Reset the list to prepare for the next sequence.
-        self._tmp_list = None
+        self._conn.UpdateUserList(chan, tmp_list)
         return True
 
 
@@ -422,12 +2081,14 @@ class _UserTagsHandlerMixin:
             # Nothing to do.
             return False
 
-        userlist = self._conn.GetUserList()
-        if msg.sender not in userlist:
-            logging.warning('[PRIVMSG] User %r not part of channel %r',
-                            msg.sender, self._conn.channel)
-            userlist[msg.sender] = User(msg.sender)
-        userlist[msg.sender].UpdateTags(msg.tags)
+        chan = msg.command_args.split(' ', maxsplit=1)[0]
+        userlist = self._conn.GetUserList(chan)
+        if userlist is None:
+            logging.warning('[PRIVMSG] Received for another channel: %r', chan)
+            return False
+        # Users not listed are common in large channels, they are only
+        # cached.
+        userlist.UpdateTags(msg.sender, msg.tags)
 
         # Let other handlers fully handle PRIVMSG.
         return False
@@ -443,25 +2104,148 @@ class HandlerBase:
     HandleDefault() is used to handle any messages types that have no specific
     handler. Every Handle*() function should return True/False, True meaning
     that the message has been successfully handled.
+
+    Handle*() functions may also be coroutines (async def) or return an
+    awaitable, in which case the awaited result is the True/False value.
+    Client waits for them before handling the next message while AsyncClient
+    runs them concurrently with the handling of the following messages.
+
+    The command to handler table is computed once per class, when the class
+    is created, and bound once per instance, so dispatching a message is a
+    single dictionary lookup.
     """
+    # Maps IRC commands to the name of the method handling them.
+    _COMMAND_HANDLERS = {}
+    # Whether the class overrides HandleDefault() and so may handle messages
+    # of any type.
+    _HANDLES_DEFAULT = False
+    # Whether the class overrides HandleTick().
+    _HANDLES_TICK = False
+    # The config.Schema of the config section used by the handler, if any.
+    CONFIG_SCHEMA = None
+    # Whether the handler is independent of the other chained handlers: the
+    # chain never lets its result stop the handlers after it, so it may run
+    # it on a worker thread, concurrently with them and with the next
+    # messages. Its connection then buffers what it sends, which goes out in
+    # message order. From the worker thread it only allows the clock,
+    # GetUserList() and GetSendQueueStats() besides, anything else (e.g. the
+    # scheduler) raises RuntimeError. Its other hooks (e.g. Start() and
+    # ApplyConfig()) still get called from the client loop.
+    INDEPENDENT = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        handlers = {}
+        for name in dir(cls):
+            command = name[len('Handle'):]
+            # Only Handle<COMMAND> methods, this skips HandleTick(),
+            # HandleMessage(), HandleDefault() and helpers like
+            # HandleCommand().
+            if (not name.startswith('Handle') or not command or
+                    command != command.upper()):
+                continue
+            if callable(getattr(cls, name)):
+                handlers[command] = name
+        cls._COMMAND_HANDLERS = handlers
+        cls._HANDLES_DEFAULT = (
+            cls.HandleDefault is not HandlerBase.HandleDefault)
+        cls._HANDLES_TICK = cls.HandleTick is not HandlerBase.HandleTick
+
     def __init__(self, conn):
         self._conn = conn
+        self._dispatch = {command: getattr(self, name)
+                          for command, name in self._COMMAND_HANDLERS.items()}
 
     def GetConnection(self):
         return self._conn
 
+    def HandledCommands(self):
+        """Returns the set of IRC commands with a specific handler."""
+        return frozenset(self._dispatch)
+
+    def Handles(self, command):
+        """Returns True if messages of type "command" may be handled.
+
+        False means that passing such a message to HandleMessage() is
+        guaranteed to do nothing and return False.
+        """
+        return self._HANDLES_DEFAULT or command in self._dispatch
+
+    def HandlesTick(self):
+        """Returns True if HandleTick() needs to be called every second.
+
+        Handlers needing other timings should use the connection scheduler
+        instead.
+        """
+        return self._HANDLES_TICK
+
     def HandleTick(self):
         """Handle the time tick."""
         return False
 
     def HandleMessage(self, msg):
-        handler = getattr(self, 'Handle%s' % msg.command.upper(),
-                          self.HandleDefault)
+        # IRC servers send commands in capital letters.
+        handler = self._dispatch.get(msg.command)
+        if handler is None:
+            return self.HandleDefault(msg)
         return handler(msg)
 
     def HandleDefault(self, msg):
         return False
 
+    def ChatCommands(self):
+        """Returns the chat commands (e.g. "!quote") this handler owns.
+
+        A chained handler without a HandlePRIVMSG() (or HandleDefault())
+        only receives, through HandleChat(), the chat messages whose first
+        word is the first word of one of these, compared ignoring case and
+        any '@' or ':' around it (as in "@nickname:"). The handler checks
+        the rest of multi-word commands itself.
+        """
+        return ()
+
+    def HandleChat(self, chat):
+        """Handle a chat message, "chat" is a ChatMessage instance.
+
+        By default this handles the underlying PRIVMSG with HandleMessage().
+        """
+        return self.HandleMessage(chat.msg)
+
+    def Start(self):
+        """Called from the client loop before the handler gets any message.
+
+        Constructors may run on other threads, concurrently with each other,
+        so this is where to set up timers on the connection scheduler, which
+        isn't thread safe. Unload() is where to cancel them.
+        """
+        pass
+
+    def GetReloadState(self):
+        """Returns the state to hand over when the plugin is reloaded.
+
+        Called once this instance is done with the messages it got. The new
+        instance receives the state through SetReloadState() before its
+        first message, both possibly on a worker thread for independent
+        handlers.
+        """
+        return None
+
+    def SetReloadState(self, state):
+        """Take over the state returned by the replaced GetReloadState()."""
+        pass
+
+    def Unload(self):
+        """Called when the handler is dropped, e.g. to cancel its timers."""
+        pass
+
+    def ApplyConfig(self, conf):
+        """Apply a changed CONFIG_SCHEMA section to the running handler.
+
+        Only called on handlers overriding it, the others are reloaded when
+        their config section changes.
+        """
+        pass
+
 
 class CoreHandler(_PingHandlerMixin,
                   _JoinPartHandlerMixin,
@@ -479,6 +2263,38 @@ def SplitPRIVMSG(msg):
     if len(parts) < 2:
         logging.error('invalid PRIVMSG message: "%s"' % msg.command_args)
         return None
-    if parts[1][0] == ':':
+    if parts[1][:1] == ':':
         parts[1] = parts[1][1:]
     return tuple(parts)
+
+
+class ChatMessage:
+    """A PRIVMSG split into its channel, text and first word (the command)."""
+
+    __slots__ = ('msg', 'channel', 'text', 'command', 'args')
+
+    def __init__(self, msg, channel, text):
+        self.msg = msg
+        self.channel = channel
+        # The text stripped of surrounding whitespace.
+        self.text = text.strip()
+        # The first word of the text, as typed, and the rest of the text.
+        parts = self.text.split(' ', maxsplit=1)
+        self.command = parts[0]
+        self.args = parts[1].lstrip(' ') if len(parts) > 1 else ''
+
+    @property
+    def sender(self):
+        return self.msg.sender
+
+    def __repr__(self):
+        return 'ChatMessage(channel=%r, text=%r, sender=%r)' % (
+            self.channel, self.text, self.sender)
+
+
+def ParseChatMessage(msg):
+    """Returns a ChatMessage for the PRIVMSG "msg", or None if invalid."""
+    parts = SplitPRIVMSG(msg)
+    if not parts:
+        return None
+    return ChatMessage(msg, parts[0], parts[1])
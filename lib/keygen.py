@@ -6,10 +6,9 @@ Based on various stockexchange answers on "python generate keyboard events".
 """
 import ctypes
 from ctypes import wintypes
+import functools
 import time
 
-user32 = ctypes.WinDLL('user32', use_last_error=True)
-
 INPUT_MOUSE    = 0
 INPUT_KEYBOARD = 1
 INPUT_HARDWARE = 2
@@ -266,8 +265,8 @@ class _KEYBDINPUT(ctypes.Structure):
         # some programs use the scan code even if KEYEVENTF_SCANCODE
         # isn't set in dwFflags, so attempt to map the correct code.
         if not self.dwFlags & (KEYEVENTF_UNICODE | KEYEVENTF_SCANCODE):
-            self.wScan = user32.MapVirtualKeyExW(self.wVk,
-                                                 MAPVK_VK_TO_VSC, 0)
+            self.wScan = _User32().MapVirtualKeyExW(self.wVk,
+                                                    MAPVK_VK_TO_VSC, 0)
 
 class _HARDWAREINPUT(ctypes.Structure):
     _fields_ = (("uMsg",    wintypes.DWORD),
@@ -290,10 +289,15 @@ def _check_count(result, func, args):
         raise ctypes.WinError(ctypes.get_last_error())
     return args
 
-user32.SendInput.errcheck = _check_count
-user32.SendInput.argtypes = (wintypes.UINT, # nInputs
-                             _LPINPUT,      # pInputs
-                             ctypes.c_int)  # cbSize
+@functools.cache
+def _User32():
+    """Load user32.dll on first use, so importing works on any host."""
+    user32 = ctypes.WinDLL('user32', use_last_error=True)
+    user32.SendInput.errcheck = _check_count
+    user32.SendInput.argtypes = (wintypes.UINT, # nInputs
+                                 _LPINPUT,      # pInputs
+                                 ctypes.c_int)  # cbSize
+    return user32
 
 def _GetKeyboardInput(key_code):
     if key_code.vk is None:
@@ -304,7 +308,7 @@ def _GetKeyboardInput(key_code):
 
 def _SendKeyboardInput(kbd_input):
     x = _INPUT(type=INPUT_KEYBOARD, ki=kbd_input)
-    user32.SendInput(1, ctypes.byref(x), ctypes.sizeof(x))
+    _User32().SendInput(1, ctypes.byref(x), ctypes.sizeof(x))
 
 # Public API
 
@@ -1,4 +1,9 @@
 import importlib
+import importlib.util
+import logging
+import os
+import sys
+import time
 
 # Plugins package.
 _PACKAGE = 'plugins'
@@ -6,11 +11,134 @@ _PACKAGE = 'plugins'
 # Map of plugin name -> imported python module object for that plugin.
 _PLUGINS = {}
 
+# Map of plugin name -> modification time of its source when imported.
+_MTIMES = {}
+
+# Map of plugin name -> (module, modification time of its source) imported
+# again by ReloadPlugin(), until passed to InstallPlugin().
+_RELOADED = {}
+
+# Map of plugin or lazily imported module name -> seconds its import took,
+# in import order. Like the cumulative column of "python -X importtime", the
+# time of a plugin includes the modules it imported eagerly.
+_IMPORT_TIMES = {}
+
+def _Import(label, load, *args):
+    """Returns "load(*args)", recording the time it took under "label".
+
+    The only place import times are recorded, "load" being
+    importlib.import_module or _LoadFresh().
+    """
+    start = time.perf_counter()
+    module = load(*args)
+    _IMPORT_TIMES[label] = time.perf_counter() - start
+    return module
+
+def _GetMtime(module):
+    try:
+        return os.stat(module.__file__).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
 def GetPlugin(name):
     module = _PLUGINS.get(name, None)
     if module is None:
-        module = importlib.import_module('%s.%s' % (_PACKAGE, name))
-        if not getattr(module, 'Handler'):
-            raise Exeption('plugin "%s" missing "Handler" class' % name)
+        module = _Import(name, importlib.import_module,
+                         '%s.%s' % (_PACKAGE, name))
+        if not hasattr(module, 'Handler'):
+            raise Exception('plugin "%s" missing "Handler" class' % name)
+        _MTIMES[name] = _GetMtime(module)
         _PLUGINS[name] = module
     return module
+
+def HasChanged(name):
+    """Returns True if the source of an imported plugin changed since."""
+    module = _PLUGINS.get(name, None)
+    return module is not None and _GetMtime(module) != _MTIMES.get(name)
+
+def _LoadFresh(module):
+    """Returns a new module object running the current source of "module".
+
+    Unlike importlib.reload(), which runs it again in the namespace of
+    "module", this leaves "module" alone for the code still using it.
+    """
+    spec = importlib.util.spec_from_file_location(module.__name__,
+                                                  module.__file__)
+    fresh = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fresh)
+    return fresh
+
+def ReloadPlugin(name):
+    """Returns the plugin module, imported again if its source changed.
+
+    The new version goes into a fresh module object, leaving the current
+    one and sys.modules untouched, so this may run on a background thread:
+    the plugin instances created before keep running the old code, whole.
+    InstallPlugin() then makes it the module GetPlugin() returns. Only the
+    plugin module itself is imported again, not the lib modules it uses.
+    """
+    module = GetPlugin(name)
+    if not HasChanged(name):
+        return module
+    mtime = _GetMtime(module)
+    module = _Import(name, _LoadFresh, module)
+    if not hasattr(module, 'Handler'):
+        raise Exception('plugin "%s" missing "Handler" class' % name)
+    _RELOADED[name] = (module, mtime)
+    return module
+
+def InstallPlugin(name, module):
+    """Makes "module", returned by ReloadPlugin(), the plugin module.
+
+    Called once its instances replaced the old ones, from the thread running
+    the plugins.
+    """
+    reloaded, mtime = _RELOADED.pop(name, (None, None))
+    if module is not reloaded:
+        return
+    sys.modules[module.__name__] = module
+    setattr(sys.modules[_PACKAGE], name, module)
+    _PLUGINS[name] = module
+    _MTIMES[name] = mtime
+
+def GetImportTimes():
+    """Returns (name, seconds) pairs for the plugins and lazy imports."""
+    return list(_IMPORT_TIMES.items())
+
+
+class _LazyModule:
+    """Stands in for a module until one of its attributes is first used."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for the attributes not found on the instance itself.
+        module = self._module
+        if module is None:
+            module = _Import(self._name, importlib.import_module,
+                             self._name)
+            logging.info('Imported "%s" on first use in %.3fs', self._name,
+                         _IMPORT_TIMES[self._name])
+            self._module = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
+
+
+def LazyImport(name):
+    """Declares a heavy dependency, to be imported when first used.
+
+    Use it at module level in place of an import statement:
+
+        requests = plugin_loader.LazyImport('requests')
+
+    Only checks that the module is installed, raising ImportError otherwise,
+    so that a plugin which can never run on this host fails to load instead
+    of failing on its first use.
+    """
+    if importlib.util.find_spec(name) is None:
+        raise ImportError('No module named %r' % name, name=name)
+    return _LazyModule(name)
@@ -4,9 +4,11 @@ Twitch Plays IRC command handler.
 See docs/TwitchPlays_*.txt.
 """
 
+import asyncio
 import logging
 import time
 
+from lib import config as config_lib
 from lib import irc
 from lib import keygen
 from lib import win_mgt
@@ -14,6 +16,15 @@ from lib import win_mgt
 class Handler(irc.HandlerBase):
     """Handles chat commands by passing simulated input to applications."""
 
+    CONFIG_SCHEMA = config_lib.Schema('TWITCH_PLAYS', {
+        'require_nickname': config_lib.Option(bool, False),
+        'focus_window': config_lib.Option(str, ''),
+        # Seconds of commands counted together when tallying votes, 0 to
+        # count them exactly. Only the Gwent plugin votes, but the section
+        # is shared by all the Twitch Plays plugins.
+        'vote_bucket_width': config_lib.Option(float, 0, minimum=0),
+    })
+
     def __init__(self, conn, config, commands):
         """Initialize this instance.
 
@@ -25,13 +36,23 @@ class Handler(irc.HandlerBase):
         """
         super().__init__(conn)
         self._nickname = config['CONNECTION']['nickname'].lower()
-        self._channel = config['CONNECTION']['channel'].lower()
-        self._cfg = config['TWITCH_PLAYS'] if 'TWITCH_PLAYS' in config.sections() else {}
+        self._cfg = config_lib.GetSection(config, self.CONFIG_SCHEMA)
+        self._require_nickname = self._cfg['require_nickname']
         self._FocusWindow()
         self._commands = commands
+        # The chat commands that may be typed, either on their own or after
+        # our nickname.
+        nicknames = (self._nickname, '@' + self._nickname,
+                     self._nickname + ':', '@' + self._nickname + ':')
+        if self._require_nickname:
+            self._chat_commands = nicknames
+        else:
+            self._chat_commands = nicknames + ('help',) + tuple(commands)
+        # Serializes the simulated input so that key presses never overlap.
+        self._input_lock = asyncio.Lock()
 
     def _FocusWindow(self):
-        focus_window = self._cfg.get('focus_window')
+        focus_window = self._cfg['focus_window']
         if not focus_window:
             return
 
@@ -48,7 +69,7 @@ class Handler(irc.HandlerBase):
         window.SetForeground()
 
     def _SkipNickname(self, line):
-        require_nickname = self._cfg.getboolean('require_nickname')
+        require_nickname = self._require_nickname
 
         # Split the message into 2 parts, first one should be our nickname
         # if we are to consider it as a command.
@@ -68,32 +89,35 @@ class Handler(irc.HandlerBase):
         # otherwise return the original line.strip
         return None if require_nickname else line
 
-    def _HandleHelp(self, command):
+    def _HandleHelp(self, channel, command):
         if command == 'help':
             self._conn.SendMessage(
-                self._channel,
+                channel,
                 'Command list: ' + ', '.join(sorted(self._commands)))
             return True
 
-    def HandlePRIVMSG(self, msg):
-        parts = irc.SplitPRIVMSG(msg)
-        if len(parts) < 2 or not parts[1]:
-            logging.warning('Got invalid PRIVMSG: %r', msg)
-            return False
+    def ChatCommands(self):
+        return self._chat_commands
 
-        command = self._SkipNickname(parts[1])
+    def HandleChat(self, chat):
+        command = self._SkipNickname(chat.text)
         if not command:
             return False
 
-        return self.HandleCommand(command.lower())
+        return self.HandleCommand(chat.channel, command.lower())
 
-    def HandleCommand(self, command):
-        if self._HandleHelp(command):
+    def HandleCommand(self, channel, command):
+        if self._HandleHelp(channel, command):
             return True
 
         key_func = self._commands.get(command)
         if key_func:
-            key_func()
-            return True
+            return self._SendInput(key_func)
 
         return False
+
+    async def _SendInput(self, key_func):
+        """Run "key_func" in a worker thread, it sleeps while keys are held."""
+        async with self._input_lock:
+            await asyncio.to_thread(key_func)
+        return True
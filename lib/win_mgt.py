@@ -5,9 +5,12 @@ page on "python windows focus window". Requires pywin32.
 TODO: Rewrite this using ctypes to not require pywin32.
 """
 
-import pywintypes
 import re
-import win32gui
+
+from lib import plugin_loader
+
+pywintypes = plugin_loader.LazyImport('pywintypes')
+win32gui = plugin_loader.LazyImport('win32gui')
 
 class _Window:
     """Encapsulates some calls to the winapi for window management"""
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
-import configparser
+import asyncio
+import concurrent.futures
 import logging
 import os
+import signal
 import sys
+import time
 
+from lib import config as config_lib
 from lib import irc
 from lib import plugin_loader
 
@@ -13,34 +17,174 @@ def _ParseArguments():
     parser = argparse.ArgumentParser(description='GOG Twitch bot.')
     parser.add_argument('--config', type=str, required=True,
                         help='path to config file')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='use the asyncio based IRC engine, allows slow '
+                        'plugins to run concurrently')
 
     return parser.parse_args()
 
+def _ConnectArgs(conn_config):
+    """Returns the Connect() arguments from the CONNECTION config section."""
+    return {
+        'host': conn_config['host'],
+        'port': int(conn_config['port']),
+        'nickname': conn_config['nickname'],
+        'channels': conn_config.get('channel', '').split(),
+        'server_pass': conn_config.get('password', None),
+        'activity_timer': int(conn_config.get('activity_timer', 600)),
+    }
+
+def _ConnectionArgs(conn_config):
+    """Returns the connection constructor arguments from the config section."""
+    reconnect = None
+    if conn_config.getboolean('reconnect', True):
+        reconnect = irc.Backoff(
+            min_delay=conn_config.getfloat('reconnect_min_delay', 1),
+            max_delay=conn_config.getfloat('reconnect_max_delay', 120),
+            reset_after=conn_config.getfloat('reconnect_reset_after', 60))
+    return {
+        'log_traffic': conn_config.getboolean('log_traffic', False),
+        'reconnect': reconnect,
+        'rate_limits': irc.RateLimits(
+            message_rate=conn_config.getint('message_rate', 20),
+            message_period=conn_config.getint('message_period', 30),
+            join_rate=conn_config.getint('join_rate', 20),
+            join_period=conn_config.getint('join_period', 10)),
+    }
+
+def _SetupUserListsSnapshot(con, conn_config):
+    """Loads the saved userlists and keeps saving them periodically.
+
+    Returns the path of the snapshot file, None if not configured.
+    """
+    path = conn_config.get('userlist_snapshot')
+    if not path:
+        return None
+    irc.LoadUserLists(con, path,
+                      conn_config.getint('userlist_snapshot_max_age', 900))
+    con.scheduler.CallEvery(
+        conn_config.getint('userlist_snapshot_interval', 60),
+        irc.SaveUserLists, con, path)
+    return path
+
+def _Timed(phases, phase, func, *args, **kwargs):
+    """Calls func(*args, **kwargs) recording its duration in "phases"."""
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        phases[phase] = time.perf_counter() - start
+
+async def _TimedAsync(phases, phase, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        phases[phase] = time.perf_counter() - start
+
+def _LogStartupReport(start, phases, chain_handler):
+    """Logs where the startup time went, by phase and by plugin.
+
+    Plugin import times include the modules they import eagerly, the heavy
+    ones they declared lazy are listed on their own if used by then.
+
+    Connecting and constructing the plugins run concurrently so their
+    durations add up to more than the total.
+    """
+    logging.info('Startup took %.3fs: %s', time.perf_counter() - start,
+                 ', '.join('%s %.3fs' % item for item in phases.items()))
+    logging.info('Plugin imports: %s', ', '.join(
+        '%s %.3fs' % item for item in plugin_loader.GetImportTimes()))
+    logging.info('Plugin construction: %s', ', '.join(
+        '%s %.3fs' % item for item in chain_handler.GetPluginLoadTimes()))
+
+def _InstallReloadSignal(chain_handler, loop=None):
+    """Reloads the changed plugins on SIGHUP, where there is one."""
+    if not hasattr(signal, 'SIGHUP'):
+        return
+    if loop is not None:
+        loop.add_signal_handler(signal.SIGHUP, chain_handler.Reload)
+    else:
+        # Takes effect the next time the client loop wakes up.
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: chain_handler.Reload())
+
+def _Run(config, start, phases):
+    conn_config = config['CONNECTION']
+    channels_per_connection = conn_config.getint('channels_per_connection', 0)
+    if channels_per_connection:
+        con = irc.ConnectionPool(channels_per_connection,
+                                 **_ConnectionArgs(conn_config))
+    else:
+        con = irc.Connection(**_ConnectionArgs(conn_config))
+
+    # Construct the plugins while the login handshake is in flight.
+    chain_plugin = plugin_loader.GetPlugin('chain')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        chain_future = executor.submit(_Timed, phases, 'plugins',
+                                       chain_plugin.Handler, con, config)
+        _Timed(phases, 'connect', con.Connect, **_ConnectArgs(conn_config))
+        chain_handler = chain_future.result()
+    snapshot = _Timed(phases, 'userlists', _SetupUserListsSnapshot, con,
+                      conn_config)
+    _LogStartupReport(start, phases, chain_handler)
+    _InstallReloadSignal(chain_handler)
+
+    try:
+        irc.Client(chain_handler).Run()
+    finally:
+        if snapshot:
+            irc.SaveUserLists(con, snapshot)
+
+async def _RunAsync(config, start, phases):
+    conn_config = config['CONNECTION']
+    con = irc.AsyncConnection(**_ConnectionArgs(conn_config))
+
+    # Construct the plugins while the login handshake is in flight.
+    chain_plugin = plugin_loader.GetPlugin('chain')
+    chain_handler, _ = await asyncio.gather(
+        _TimedAsync(phases, 'plugins', asyncio.to_thread(
+            chain_plugin.Handler, con, config)),
+        _TimedAsync(phases, 'connect', con.Connect(
+            **_ConnectArgs(conn_config))))
+    snapshot = _Timed(phases, 'userlists', _SetupUserListsSnapshot, con,
+                      conn_config)
+    _LogStartupReport(start, phases, chain_handler)
+    _InstallReloadSignal(chain_handler, asyncio.get_running_loop())
+
+    try:
+        await irc.AsyncClient(chain_handler).Run()
+    finally:
+        if snapshot:
+            irc.SaveUserLists(con, snapshot)
+
 def main(args):
     logging.basicConfig(
         level=logging.DEBUG,
         format='%(asctime)s:%(levelname).4s:%(module)s: %(message)s',
         datefmt='%Y%m%d_%H%M%S')
 
-    config = configparser.ConfigParser()
-    if list(config.read(args.config)) != [args.config]:
-        logging.error('failed to parse config: ', args.config)
+    start = time.perf_counter()
+    phases = {}
+    try:
+        config = _Timed(phases, 'config', config_lib.Snapshot.Load,
+                        args.config)
+    except config_lib.ConfigError as err:
+        logging.error('%s', err)
         return False
     if 'CONNECTION' not in config.sections():
         logging.error('CONNECTION section missing in config')
         return False
-    conn_config = config['CONNECTION']
-    con = irc.Connection(conn_config.getboolean('log_traffic', False))
-    con.Connect(conn_config['host'], int(conn_config['port']),
-                conn_config['nickname'],
-                channel=conn_config.get('channel', None),
-                server_pass=conn_config.get('password', None),
-                activity_timer=int(conn_config.get('activity_timer', 600)))
-
-    chain_plugin = plugin_loader.GetPlugin('chain')
-    client = irc.Client(chain_plugin.Handler(con, config))
+    if args.use_async and config['CONNECTION'].getint(
+            'channels_per_connection', 0):
+        logging.error('channels_per_connection is not supported by the '
+                      '--async engine, set it to 0')
+        return False
     try:
-        client.Run()
+        if args.use_async:
+            asyncio.run(_RunAsync(config, start, phases))
+        else:
+            _Run(config, start, phases)
     except KeyboardInterrupt:
         logging.info('CTRL-C caught, exiting...')
     return True
@@ -1,44 +1,666 @@
+import asyncio
+import collections
+import concurrent.futures
+import inspect
 import logging
+import os
+import threading
+import time
 
 from lib import config
 from lib import irc
 from lib import plugin_loader
 
+# Replies of the independent handler call running on the current thread.
+_worker_state = threading.local()
+
+
+class _OrderedConnection:
+    """Connection given to independent handlers.
+
+    Calls changing the connection (sending, joining) made while the handler
+    runs on its worker thread are recorded, to be replayed from the client
+    loop in message then chain order. Only the lookups in _SHARED may be
+    used as is from the worker thread, anything else (e.g. the scheduler,
+    which isn't thread safe) raises RuntimeError there. Hooks called from
+    the client loop, like Start() and ApplyConfig(), get the whole
+    connection, Start() being where independent handlers set up timers.
+    """
+
+    _BUFFERED = frozenset(('SendRaw', 'SendPong', 'SendMessage', 'SendWhisper',
+                           'JoinChannel', 'PartChannel'))
+    _SHARED = frozenset(('clock', 'GetUserList', 'GetSendQueueStats'))
+    _ALLOWED = _BUFFERED | _SHARED
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        on_worker = getattr(_worker_state, 'replies', None) is not None
+        if on_worker and name not in self._ALLOWED:
+            raise RuntimeError('independent handlers can\'t use %r of the '
+                               'connection from their worker thread' % name)
+        attr = getattr(self._conn, name)
+        if name not in self._BUFFERED:
+            return attr
+
+        def Call(*args, **kwargs):
+            replies = getattr(_worker_state, 'replies', None)
+            if replies is None:
+                return attr(*args, **kwargs)
+            replies.append((attr, args, kwargs))
+        return Call
+
+
+class _Worker:
+    """Runs an independent handler on its own thread.
+
+    Stands in for the handler in the chain routing tables. Calls are queued
+    to the thread in order, so a handler never runs concurrently with
+    itself, and return False right away as independent handlers never stop
+    the chain.
+    """
+
+    def __init__(self, handler, chain):
+        self._handler = handler
+        self._chain = chain
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='plugin')
+        # Event loop running the coroutines of the handler on its thread.
+        self._loop = None
+
+    def __getattr__(self, name):
+        return getattr(self._handler, name)
+
+    def _Run(self, func, args, replies):
+        _worker_state.replies = replies
+        try:
+            result = func(*args)
+            if inspect.isawaitable(result):
+                if self._loop is None:
+                    self._loop = asyncio.new_event_loop()
+                result = self._loop.run_until_complete(result)
+            return result
+        finally:
+            _worker_state.replies = None
+
+    def _Submit(self, method, *args):
+        replies = []
+        self._chain._AddPending(
+            self._handler,
+            self._executor.submit(self._Run, getattr(self._handler, method),
+                                  args, replies), replies)
+        return False
+
+    def Drain(self, func):
+        """Returns the future of "func()", run once the handler is done with
+        the calls queued so far."""
+        return self._executor.submit(func)
+
+    def Queue(self, func, done):
+        """Queues "func()" after the calls queued so far, like a call of the
+        handler, then calls "done()" from the client loop.
+
+        "done" is called after what "func" sent, even if "func" failed.
+        """
+        replies = []
+
+        def Call():
+            try:
+                return func()
+            finally:
+                replies.append((done, (), {}))
+        self._chain._AddPending(
+            self._handler,
+            self._executor.submit(self._Run, Call, (), replies), replies)
+
+    def HandleMessage(self, msg):
+        return self._Submit('HandleMessage', msg)
+
+    def HandleChat(self, chat):
+        return self._Submit('HandleChat', chat)
+
+    def HandleTick(self):
+        return self._Submit('HandleTick')
+
+    def Shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def _ChatRouteKey(word):
+    """Returns the chat route of messages starting with "word".
+
+    Normalized like the Twitch Plays nickname check, ignoring case and any
+    '@' or ':' around the word, so "@Bot:" and "bot" take the same route.
+    """
+    return word.strip('@:').lower()
+
+
+def _Construct(plugin, conn, conf):
+    """Returns a new handler of the plugin, built for where it will run."""
+    if plugin.Handler.INDEPENDENT:
+        conn = _OrderedConnection(conn)
+    return plugin.Handler(conn, conf)
+
+
+class _ReloadCommandHandler(irc.HandlerBase):
+    """Handles the moderator command reloading plugins.
+
+    "<command>" reloads the plugins changed on disk, "<command> <name>..."
+    the named ones.
+    """
+
+    def __init__(self, conn, command, chain):
+        super().__init__(conn)
+        self._command = command
+        self._chain = chain
+
+    def ChatCommands(self):
+        return (self._command,)
+
+    def HandleChat(self, chat):
+        if chat.command.lower() != self._command.lower():
+            return False
+        userlist = self._conn.GetUserList(chat.channel)
+        user = userlist.GetUser(chat.sender) if userlist is not None else None
+        if not user or not user.HasPrivilege(irc.PRIV_ELEVATED):
+            logging.warning('Unprivileged user %r tried to reload plugins',
+                            chat.sender)
+            return True
+        logging.info('User %r requested a plugin reload', chat.sender)
+        self._chain.Reload(chat.args.split() or None)
+        return True
+
+
 class Handler(irc.HandlerBase):
     """IRC handler that delegates handling to a chain of handlers."""
 
+    CONFIG_SCHEMA = config.Schema('GENERAL', {
+        'plugins': config.Option(required=True),
+        'reload_command': config.Option(str, ''),
+        'config_poll_interval': config.Option(float, 0, minimum=0),
+    })
+
+    # Seconds between checks for the end of a background reload.
+    _RELOAD_POLL_INTERVAL = 0.1
+    # Seconds between checks for the replies of independent handlers.
+    _REPLY_POLL_INTERVAL = 0.01
+    # Seconds between HandleTick() calls, like the clients.
+    _TICK_INTERVAL = 1
+
     def __init__(self, conn, conf):
         super().__init__(conn)
+        self._conf = conf
         self._handlers = [irc.CoreHandler(conn)]
 
-        section = config.GetSection(conf, 'GENERAL')
-        if 'plugins' not in section:
-            raise Exception('"plugins" setting not found')
+        section = config.GetSection(conf, self.CONFIG_SCHEMA)
+        # Seconds it took to construct each plugin, in chain order.
+        self._load_times = []
+        # Map of chained plugin handler -> name of its plugin.
+        self._plugin_names = {}
         handlers = self._LoadPlugins(section['plugins'], conn, conf)
         if not handlers:
             raise Exception('empty list of plugins to load')
+        if section['reload_command']:
+            self._handlers.append(
+                _ReloadCommandHandler(conn, section['reload_command'], self))
         self._handlers.extend(handlers)
+        # Future of the reload running in the background, if any.
+        self._reload = None
+        # Map of independent handler -> _Worker running it.
+        self._workers = {}
+        # Calls to independent handlers in the order they were made, as
+        # (handler, future, replies) tuples.
+        self._pending = collections.deque()
+        # Whether Start() was called, timers are only set up from then on.
+        self._started = False
+        # Timer calling HandleTick(), while a chained handler wants it.
+        self._tick_timer = None
+        self._Rebuild()
 
-    @staticmethod
-    def _LoadPlugins(plugins, conn, conf):
-        result = []
+        # Seconds between checks of the config file for changes, 0 to not
+        # check, and its modification time when last read.
+        self._config_poll_interval = section['config_poll_interval']
+        self._config_mtime = getattr(conf, 'mtime', None)
+
+    def Start(self):
+        for handler in self._handlers:
+            handler.Start()
+        # Watch the config file, applying the sections that changed.
+        if self._config_poll_interval and self._config_mtime:
+            self._conn.scheduler.CallEvery(self._config_poll_interval,
+                                           self._CheckConfig)
+        self._started = True
+        self._ArmTick()
+
+    def _Rebuild(self):
+        """Recompute the per command tables after the handlers changed."""
+        workers = {}
+        for handler in self._handlers:
+            if handler.INDEPENDENT:
+                workers[handler] = (self._workers.get(handler) or
+                                    _Worker(handler, self))
+        for handler, worker in self._workers.items():
+            if handler not in workers:
+                worker.Shutdown()
+        self._workers = workers
+        # Chained handlers by IRC command, filled in as commands are seen.
+        self._command_handlers = {}
+        self._BuildChatRoutes()
+        # Chained handlers wanting the time tick.
+        self._tick_handlers = tuple(self._Route(handler)
+                                    for handler in self._handlers
+                                    if handler.HandlesTick())
+        self._ArmTick()
+
+    def _ArmTick(self):
+        """Runs the tick timer only while some chained handler wants it.
+
+        The chain has its own timer rather than the client's, which is only
+        set up at startup, as reloads change which handlers want the tick.
+        """
+        if not self._started:
+            return
+        if self._tick_handlers and self._tick_timer is None:
+            self._tick_timer = self._conn.scheduler.CallEvery(
+                self._TICK_INTERVAL, self.HandleTick)
+        elif not self._tick_handlers and self._tick_timer is not None:
+            self._tick_timer.Cancel()
+            self._tick_timer = None
+
+    def _Route(self, handler):
+        """Returns what to call for "handler", its worker if independent."""
+        return self._workers.get(handler, handler)
+
+    def _AddPending(self, handler, future, replies):
+        if not self._pending:
+            self._conn.scheduler.CallLater(self._REPLY_POLL_INTERVAL,
+                                           self._SendReplies)
+        self._pending.append((handler, future, replies))
+
+    def _SendReplies(self):
+        """Sends the replies of the finished independent handler calls.
+
+        Goes in the order the calls were made, so replies come out in
+        message then chain order, however long each handler took.
+        """
+        pending = self._pending
+        while pending and pending[0][1].done():
+            handler, future, replies = pending.popleft()
+            if future.exception() is not None:
+                logging.error('Plugin %s failed: %r',
+                              self._plugin_names.get(handler, handler),
+                              future.exception(),
+                              exc_info=future.exception())
+            for func, args, kwargs in replies:
+                func(*args, **kwargs)
+        if pending:
+            self._conn.scheduler.CallLater(self._REPLY_POLL_INTERVAL,
+                                           self._SendReplies)
+
+    def _LoadPlugins(self, plugins, conn, conf):
+        """Import the plugins then construct them concurrently, keeping their
+        chain order.
+
+        Imports run one after the other, so that each plugin import time is
+        its own and not time spent waiting on the import locks of others.
+        Some plugins block on network or disk I/O in their constructor, so
+        constructing takes about as long as the slowest plugin instead of the
+        sum of all of them. Constructors run on pool threads and leave
+        setting up timers to Start(). Plugins needing modules missing on
+        this host are skipped, any other error loading a plugin fails the
+        whole chain.
+        """
+        modules = []
         for name in plugins.split():
-            name = name.strip()
-            if not name:
+            try:
+                modules.append((name, plugin_loader.GetPlugin(name)))
+            except ImportError as err:
+                self._SkipPlugin(name, err)
+        if not modules:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(modules),
+                thread_name_prefix='plugin-init') as executor:
+            results = list(executor.map(
+                lambda item: self._LoadPlugin(*item, conn, conf), modules))
+        names = [name for name, _ in modules]
+        self._load_times = [(name, elapsed)
+                            for name, (handler, elapsed) in zip(names, results)
+                            if handler is not None]
+        self._plugin_names = {handler: name
+                              for name, (handler, _) in zip(names, results)
+                              if handler is not None}
+        return [handler for handler, _ in results if handler is not None]
+
+    @staticmethod
+    def _SkipPlugin(name, err):
+        logging.error('Skipping plugin "%s", missing dependency: %s', name,
+                      err)
+
+    @classmethod
+    def _LoadPlugin(cls, name, plugin, conn, conf):
+        """Returns the constructed plugin and the seconds its constructor took.
+
+        The plugin is None if it needs a module that could not be imported.
+        """
+        start = time.perf_counter()
+        try:
+            handler = _Construct(plugin, conn, conf)
+        except ImportError as err:
+            cls._SkipPlugin(name, err)
+            return None, 0
+        return handler, time.perf_counter() - start
+
+    def GetPluginLoadTimes(self):
+        """Returns (plugin name, constructor seconds) for the chained plugins."""
+        return list(self._load_times)
+
+    def Reload(self, names=None):
+        """Reload plugins without disturbing the connection or other plugins.
+
+        Reloads the named plugins, or by default those whose module or config
+        section changed. Their modules are imported again if changed and new
+        instances constructed on a background thread, so message handling
+        goes on meanwhile, then swapped into the chain and started from the
+        client loop.
+        Plugins supporting ApplyConfig() whose code did not change get their
+        new config section applied instead. Must be called from the client
+        loop (or a signal handler). Returns False if another reload is still
+        running.
+        """
+        if self._reload is not None:
+            logging.warning('Plugin reload already in progress, ignoring')
+            return False
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='plugin-reload')
+        self._reload = executor.submit(self._PrepareReload, names,
+                                       time.perf_counter())
+        executor.shutdown(wait=False)
+        self._conn.scheduler.CallLater(self._RELOAD_POLL_INTERVAL,
+                                       self._FinishReload)
+        return True
+
+    def _CheckConfig(self):
+        """Starts a reload when the config file was modified."""
+        try:
+            mtime = os.stat(self._conf.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._config_mtime or self._reload is not None:
+            return
+        self._config_mtime = mtime
+        logging.info('Config file %r changed', self._conf.path)
+        self.Reload()
+
+    def _ReadConfig(self):
+        """Returns the config file read again, the current config if not."""
+        if getattr(self._conf, 'path', None) is None:
+            return self._conf
+        try:
+            return config.Snapshot.Load(self._conf.path)
+        except config.ConfigError as err:
+            logging.error('%s, using the current config', err)
+            return self._conf
+
+    @staticmethod
+    def _GetPluginConfig(name, conf):
+        """Returns the config section of a plugin, raises ConfigError."""
+        schema = plugin_loader.GetPlugin(name).Handler.CONFIG_SCHEMA
+        if schema is None:
+            return dict(config.GetSection(conf, name))
+        return config.GetSection(conf, schema)
+
+    def _ConfigChanged(self, name, conf):
+        """Returns whether the plugin config section changed in "conf".
+
+        An invalid new section is logged and counts as unchanged, the plugin
+        keeps running with the current one.
+        """
+        try:
+            new = self._GetPluginConfig(name, conf)
+        except config.ConfigError as err:
+            logging.error('Not applying config to plugin "%s": %s', name, err)
+            return False
+        try:
+            return new != self._GetPluginConfig(name, self._conf)
+        except config.ConfigError:
+            return True
+
+    def _PrepareReload(self, names, start):
+        """Constructs the reloaded plugins, runs on a background thread.
+
+        Returns the config used, the maps of plugin name -> plugin module and
+        plugin name -> new handler, the names of the plugins to apply the new
+        config to and the reload start time. Plugins failing to reload are
+        left out.
+        """
+        conf = self._ReadConfig()
+        loaded = set(self._plugin_names.values())
+        new_plugins = config.GetSection(conf, 'GENERAL').get('plugins')
+        if new_plugins is not None and set(new_plugins.split()) != loaded:
+            logging.warning('Adding or removing plugins requires a restart')
+        apply = set()
+        if names is None:
+            names = []
+            for handler, name in self._plugin_names.items():
+                if plugin_loader.HasChanged(name):
+                    names.append(name)
+                elif conf is not self._conf and self._ConfigChanged(name,
+                                                                    conf):
+                    if self._AppliesConfig(handler):
+                        apply.add(name)
+                    else:
+                        names.append(name)
+        plugins = {}
+        handlers = {}
+        for name in names:
+            if name not in loaded:
+                logging.warning('Cannot reload plugin "%s", not loaded', name)
                 continue
-            result.append(plugin_loader.GetPlugin(name).Handler(conn, conf))
-        return result
+            try:
+                plugin = plugin_loader.ReloadPlugin(name)
+                handlers[name] = _Construct(plugin, self._conn, conf)
+                plugins[name] = plugin
+            except Exception:
+                logging.exception('Failed to reload plugin "%s", keeping the '
+                                  'running one', name)
+        return conf, plugins, handlers, apply, start
 
-    def HandleTick(self):
-        # Distribute the tick event to the chained plugins.
-        for handler in self._handlers:
-            if handler.HandleTick():
+    @staticmethod
+    def _AppliesConfig(handler):
+        return type(handler).ApplyConfig is not irc.HandlerBase.ApplyConfig
+
+    def _FinishReload(self):
+        """Swaps the reloaded plugins into the chain once constructed."""
+        if not self._reload.done():
+            self._conn.scheduler.CallLater(self._RELOAD_POLL_INTERVAL,
+                                           self._FinishReload)
+            return
+        reload, self._reload = self._reload, None
+        try:
+            conf, plugins, handlers, apply, start = reload.result()
+        except Exception:
+            logging.exception('Plugin reload failed')
+            return
+        swapped = []
+        for idx, old in enumerate(self._handlers):
+            name = self._plugin_names.get(old)
+            if name in apply:
+                try:
+                    old.ApplyConfig(conf)
+                except Exception:
+                    logging.exception('Failed to apply config to plugin "%s"',
+                                      name)
+                continue
+            new = handlers.get(name)
+            if new is None:
+                continue
+            # Taken before _Rebuild() stops the worker of "old".
+            swapped.append((name, old, new, self._TakeReloadState(old)))
+            self._handlers[idx] = new
+            del self._plugin_names[old]
+            self._plugin_names[new] = name
+            plugin_loader.InstallPlugin(name, plugins[name])
+        self._conf = conf
+        self._Rebuild()
+        for name, old, new, state in swapped:
+            self._HandOver(name, old, new, state)
+        logging.info('Reloaded plugins %s, applied config to %s in %.3fs',
+                     ', '.join(sorted(handlers)) or '(none)',
+                     ', '.join(sorted(apply)) or '(none)',
+                     time.perf_counter() - start)
+
+    def _TakeReloadState(self, old):
+        """Returns the future of the reload state of "old".
+
+        Independent handlers may still have calls queued to their worker,
+        their state is taken on it once done with them. The state of the
+        others is taken right away.
+        """
+        worker = self._workers.get(old)
+        if worker is not None:
+            return worker.Drain(old.GetReloadState)
+        state = concurrent.futures.Future()
+        try:
+            state.set_result(old.GetReloadState())
+        except Exception as err:
+            state.set_exception(err)
+        return state
+
+    def _HandOver(self, name, old, new, state):
+        """Hands the "state" of "old" over to "new", which replaced it.
+
+        Then unloads "old" and starts "new" from the client loop, whatever
+        happened to the state. An independent "new" takes the state on its
+        worker thread, ahead of any message queued to it, waiting there for
+        the worker of "old" if needed, so the loop never blocks.
+        """
+        def SetState():
+            try:
+                new.SetReloadState(state.result())
+            except Exception:
+                logging.exception('Failed to hand over the state of plugin '
+                                  '"%s"', name)
+
+        def Swap():
+            try:
+                old.Unload()
+            except Exception:
+                logging.exception('Failed to unload plugin "%s"', name)
+            try:
+                new.Start()
+            except Exception:
+                logging.exception('Failed to start plugin "%s"', name)
+
+        worker = self._workers.get(new)
+        if worker is not None:
+            worker.Queue(SetState, Swap)
+        elif state.done():
+            SetState()
+            Swap()
+        else:
+            # The plugin stopped being independent, the new instance gets
+            # the state once the old worker is done, after a few messages.
+            self._AddPending(old, state, [(SetState, (), {}), (Swap, (), {})])
+
+    def _GetHandlers(self, command):
+        """Returns the chained handlers that may handle "command" messages."""
+        handlers = self._command_handlers.get(command)
+        if handlers is None:
+            handlers = tuple(self._Route(handler) for handler in self._handlers
+                             if handler.Handles(command))
+            self._command_handlers[command] = handlers
+        return handlers
+
+    def _BuildChatRoutes(self):
+        """Index the chained handlers by the chat commands they own.
+
+        Handlers with a HandlePRIVMSG() get every chat message, the others
+        only the ones starting with a command they declared. Commands are
+        routed by their first word, so the owner of a multi-word command gets
+        all the messages starting with that word and checks the rest itself.
+        Either way the handlers are kept in chain order, so a rate limiter
+        placed before other plugins still sees their commands first.
+        """
+        owned = [(handler, handler.Handles('PRIVMSG'),
+                  frozenset(_ChatRouteKey(command.split(None, 1)[0])
+                            for command in handler.ChatCommands()
+                            if command.strip()))
+                 for handler in self._handlers]
+        # Handlers getting chat messages that start with no known command.
+        self._chat_handlers = tuple(
+            self._Route(handler) for handler, handles_all, _ in owned
+            if handles_all)
+        self._chat_routes = {}
+        for _, _, commands in owned:
+            for command in commands:
+                self._chat_routes[command] = tuple(
+                    self._Route(handler)
+                    for handler, handles_all, handler_commands in owned
+                    if handles_all or command in handler_commands)
+
+    def _Distribute(self, handlers, method, *args):
+        """Call "method" on each of "handlers" until one returns True.
+
+        If a handler returns an awaitable, returns a coroutine that awaits it
+        before continuing with the remaining handlers.
+        """
+        for idx, handler in enumerate(handlers):
+            result = getattr(handler, method)(*args)
+            if inspect.isawaitable(result):
+                return self._DistributeAsync(result, handlers[idx + 1:],
+                                             method, *args)
+            if result:
                 return True
         return False
 
-    def HandleDefault(self, msg):
-        # Distribute the message to the chained plugins.
-        for handler in self._handlers:
-            if handler.HandleMessage(msg):
+    async def _DistributeAsync(self, result, handlers, method, *args):
+        if await result:
+            return True
+        for handler in handlers:
+            result = getattr(handler, method)(*args)
+            if inspect.isawaitable(result):
+                result = await result
+            if result:
                 return True
         return False
+
+    @staticmethod
+    async def _AwaitAll(results):
+        handled = False
+        for result in results:
+            if inspect.isawaitable(result):
+                result = await result
+            handled = bool(result) or handled
+        return handled
+
+    def HandlesTick(self):
+        # The chain arms its own tick timer, see _ArmTick().
+        return False
+
+    def HandleTick(self):
+        # Every chained plugin gets the tick event, a plugin handling it
+        # doesn't stop the others from getting it too.
+        results = [handler.HandleTick() for handler in self._tick_handlers]
+        if any(inspect.isawaitable(result) for result in results):
+            return self._AwaitAll(results)
+        return any(results)
+
+    def HandlePRIVMSG(self, msg):
+        # Parse the chat message once and distribute it to the chained
+        # plugins owning its command and those that want all chat messages.
+        chat = irc.ParseChatMessage(msg)
+        if chat is None:
+            logging.warning('Got invalid PRIVMSG: %r', msg)
+            return False
+        words = chat.text.split(None, 1)
+        handlers = self._chat_routes.get(
+            _ChatRouteKey(words[0]) if words else '', self._chat_handlers)
+        return self._Distribute(handlers, 'HandleChat', chat)
+
+    def HandleDefault(self, msg):
+        # Distribute the message to the chained plugins that handle its type,
+        # skipping those that would ignore it anyways.
+        return self._Distribute(self._GetHandlers(msg.command),
+                                'HandleMessage', msg)
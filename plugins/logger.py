@@ -5,11 +5,27 @@ from lib import irc
 class Handler(irc.HandlerBase):
     """IRC handler that logs most messages."""
 
+    # Seconds between userlist memory usage reports.
+    _FOOTPRINT_INTERVAL = 60
+
     def __init__(self, conn, config):
         super().__init__(conn)
+        self._footprint_timer = None
+
+    def Start(self):
+        self._footprint_timer = self._conn.scheduler.CallEvery(
+            self._FOOTPRINT_INTERVAL, self._LogFootprint)
+
+    def Unload(self):
+        if self._footprint_timer is not None:
+            self._footprint_timer.Cancel()
+
+    def _LogFootprint(self):
+        logging.debug('userlists: %r', self._conn.GetUserListFootprint())
 
     def HandleTick(self):
-        logging.debug('default handling tick')
+        logging.debug('default handling tick, %r',
+                      self._conn.GetSendQueueStats())
         return False
 
     def HandleDefault(self, msg):
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import re
 import sqlite3
@@ -11,6 +12,9 @@ from lib import irc
 class Handler(irc.HandlerBase):
     """IRC handler to support !quote command."""
 
+    # Blocks on the database and the Twitch API, run it on its own thread.
+    INDEPENDENT = True
+
     # Regular expressions to match against supported commands.
     _GET_QUOTE_RE = re.compile(r'^!quote(?: +#?(\d+)$|$)', flags=re.IGNORECASE)
     _ADD_QUOTE_RE = re.compile(r'^!quote +add +([^ ].*)$', flags=re.IGNORECASE)
@@ -21,19 +25,27 @@ class Handler(irc.HandlerBase):
     _DEL_QUOTE_RE = re.compile(r'^!quote +del +#?(\d+)$', flags=re.IGNORECASE)
     _HELP_RE = re.compile(r'^!quote +help$', flags=re.IGNORECASE)
 
+    CONFIG_SCHEMA = config.Schema('QUOTES', {
+        'db_file': config.Option(required=True),
+        'db_table': config.Option(required=True),
+        'report_errors': config.Option(bool, False),
+        'use_whisper': config.Option(bool, False),
+    })
+
     def __init__(self, conn, conf):
         super().__init__(conn)
-        self._helix = helix.Helix(conf)
-        self._channel = conf['CONNECTION']['channel'].lower()
-        quote_section = config.GetSection(conf, 'quotes')
-        if 'db_file' not in quote_section:
-            raise Exception('"db_file" not found in QUOTE config section')
-        self._db = sqlite3.connect(quote_section['db_file'])
+        quote_section = config.GetSection(conf, self.CONFIG_SCHEMA)
+        self._helix = helix.Helix(conf, conn.clock)
+        # The chain constructs plugins on worker threads and runs this one on
+        # its own thread, the database is only used by one at a time.
+        self._db = sqlite3.connect(quote_section['db_file'],
+                                   check_same_thread=False)
         self._table = quote_section['db_table']
-        self._report_errors = quote_section.getboolean('report_errors')
-        self._use_whisper = quote_section.getboolean('use_whisper')
+        self._report_errors = quote_section['report_errors']
+        self._use_whisper = quote_section['use_whisper']
 
-    def _ReportError(self, recipient, fmt, *args, level=logging.WARNING):
+    def _ReportError(self, channel, recipient, fmt, *args,
+                     level=logging.WARNING):
         if level is not None:
             logging.log(level, fmt, *args)
         if self._report_errors:
@@ -42,47 +54,47 @@ class Handler(irc.HandlerBase):
             else:
                 # Send a nicely formatted chat (public) message with the
                 # user as a prefix.
-                self._conn.SendMessage(self._channel,
+                self._conn.SendMessage(channel,
                                        ''.join((recipient, ': ', fmt % args)))
 
-    def HandlePRIVMSG(self, msg):
-        """The entry point into this plugin, handle a chat message."""
-        parts = irc.SplitPRIVMSG(msg)
-        if len(parts) < 2 or not parts[1]:
-            logging.warning('Got invalid PRIVMSG: %r', msg)
-            return False
-
-        command = parts[1].strip()
-        if not command:
-            return False
-
-        match = self._GET_QUOTE_RE.match(command)
-        if match:
-            return self._HandleGetQuote(msg, match)
-
-        match = self._ADD_QUOTE_RE.match(command)
-        if match:
-            return self._HandleAddQuote(msg, match)
-
-        match = self._RAWADD_QUOTE_RE.match(command)
-        if match:
-            return self._HandleRawAddQuote(msg, match)
-
-        match = self._UPDATE_QUOTE_RE.match(command)
-        if match:
-            return self._HandleUpdateQuote(msg, match)
-
-        match = self._DEL_QUOTE_RE.match(command)
-        if match:
-            return self._HandleDelQuote(msg, match)
-
-        match = self._HELP_RE.match(command)
-        if match:
-            return self._HandleHelp()
+    def ChatCommands(self):
+        return ('!quote',)
+
+    def HandleChat(self, chat):
+        """The entry point into this plugin, handle a chat command."""
+        channel = chat.channel
+        command = chat.text
+        # Only try the expression for the subcommand that was typed.
+        subcommand = chat.args.split(' ', maxsplit=1)[0].lower()
+
+        if subcommand == 'add':
+            match = self._ADD_QUOTE_RE.match(command)
+            if match:
+                return self._HandleAddQuote(channel, chat.msg, match)
+        elif subcommand == 'rawadd':
+            match = self._RAWADD_QUOTE_RE.match(command)
+            if match:
+                return self._HandleRawAddQuote(channel, chat.msg, match)
+        elif subcommand == 'update':
+            match = self._UPDATE_QUOTE_RE.match(command)
+            if match:
+                return self._HandleUpdateQuote(channel, chat.msg, match)
+        elif subcommand == 'del':
+            match = self._DEL_QUOTE_RE.match(command)
+            if match:
+                return self._HandleDelQuote(channel, chat.msg, match)
+        elif subcommand == 'help':
+            match = self._HELP_RE.match(command)
+            if match:
+                return self._HandleHelp(channel)
+        else:
+            match = self._GET_QUOTE_RE.match(command)
+            if match:
+                return self._HandleGetQuote(channel, chat.msg, match)
 
         return False
 
-    def _HandleGetQuote(self, msg, match):
+    def _HandleGetQuote(self, channel, msg, match):
         """Handle "!quote" and "!quote <number>" commands."""
         index = match.group(1)
         cur = self._db.cursor()
@@ -95,57 +107,64 @@ class Handler(irc.HandlerBase):
                 self._table)
         row = cur.fetchone()
         if not row:
-            self._ReportError(msg.sender, 'Failed to get quote #%s', index)
+            self._ReportError(channel, msg.sender, 'Failed to get quote #%s',
+                              index)
             return False
 
-        self._conn.SendMessage(self._channel, '#%s: %s' % (row[0], row[1]))
+        self._conn.SendMessage(channel, '#%s: %s' % (row[0], row[1]))
         return True
 
-    def _AuthorizeElevatedCommand(self, sender):
-        """Return true/false if "sender" is a moderator."""
+    def _AuthorizeElevatedCommand(self, channel, sender):
+        """Return true/false if "sender" is a moderator of "channel"."""
         # Twitch takes some time (on the order of minutes) between the bot
         # joining the channel and getting the user list so it's possible that
         # users we don't know about are issuing elevated commands, in that case
         # we don't have much of a choice and just ignore them.
-        user = self._conn.GetUserList().get(sender)
+        userlist = self._conn.GetUserList(channel)
+        user = userlist.GetUser(sender) if userlist is not None else None
         if not user:
-            self._ReportError(sender, "User %r tried elevated quotes command "
-                              "but we don't know about them from Twitch yet, "
-                              "ignoring it.", sender, level=logging.INFO)
+            self._ReportError(channel, sender, "User %r tried elevated quotes "
+                              "command but we don't know about them from "
+                              "Twitch yet, ignoring it.", sender,
+                              level=logging.INFO)
             return False
-        if not user.IsModerator():
-            self._ReportError(sender, 'Unprivileged user %r tried to issue '
-                              'elevated quotes command', sender)
+        if not user.HasPrivilege(irc.PRIV_ELEVATED):
+            self._ReportError(channel, sender, 'Unprivileged user %r tried to '
+                              'issue elevated quotes command', sender)
             return False
         return True
 
-    def _GetCurrentGame(self, sender):
+    async def _CallHelix(self, command, args):
+        """Run a (blocking) Helix API call without blocking the event loop."""
+        return await asyncio.to_thread(self._helix.Call, command, args)
+
+    async def _GetCurrentGame(self, channel, sender):
         """Get the current game set on a channel using Twitch API.
 
             TODO(dizzy): Consider making these ops of the Helix class API.
         """
         # Drop "#" from the start of the channel name, Twitch doesn't need it.
-        if len(self._channel) < 2:
-            logging.warning('Unexpectadly short channel name: %r',
-                            self._channel)
+        if len(channel) < 2:
+            logging.warning('Unexpectadly short channel name: %r', channel)
             return None
-        data = self._helix.Call('streams', {'user_login': self._channel[1:]})
+        data = await self._CallHelix('streams', {'user_login': channel[1:]})
         if data is None:
             return None
         if not data or 'game_id' not in data[0]:
             self._ReportError(
-                sender, 'Missing game_id on channel (channel offline?)')
+                channel, sender,
+                'Missing game_id on channel (channel offline?)')
             return None
 
-        data = self._helix.Call('games', {'id': data[0]['game_id']})
+        data = await self._CallHelix('games', {'id': data[0]['game_id']})
         if data is None:
             return None
         if not data or 'name' not in data[0]:
-            self._ReportError(sender, 'Missing game name in query')
+            self._ReportError(channel, sender, 'Missing game name in query')
             return None
         return data[0]['name']
 
-    def _AddQuoteToDb(self, quote):
+    def _AddQuoteToDb(self, channel, quote):
         """Adds the given quote to the database."""
         cur = self._db.cursor()
         cur.execute('INSERT INTO %(table)s (CustomId, Text) '
@@ -156,45 +175,45 @@ class Handler(irc.HandlerBase):
         row = cur.fetchone()
         if not row:
             logging.error('Failed to get last added quote')
-            self._conn.SendMessage(self._channel, 'Failed to add quote')
+            self._conn.SendMessage(channel, 'Failed to add quote')
             self._db.rollback()
             return None
 
         idx = row[0]
-        self._conn.SendMessage(self._channel, 'Added quote #%s' % idx)
+        self._conn.SendMessage(channel, 'Added quote #%s' % idx)
         self._db.commit()
         return idx
 
-    def _HandleAddQuote(self, msg, match):
+    async def _HandleAddQuote(self, channel, msg, match):
         """Handle "!quote add ..." command."""
-        if not self._AuthorizeElevatedCommand(msg.sender):
+        if not self._AuthorizeElevatedCommand(channel, msg.sender):
             return True
 
         text = match.group(1).strip()
         date_str = time.strftime('%d.%m.%Y', time.gmtime())
-        game = self._GetCurrentGame(msg.sender)
+        game = await self._GetCurrentGame(channel, msg.sender)
         if not game:
             return True
         text += ' [%s] [%s]' % (game, date_str)
-        idx = self._AddQuoteToDb(text)
+        idx = self._AddQuoteToDb(channel, text)
         if idx:
             logging.info('User %r added quote #%s', msg.sender, idx)
         return True
 
-    def _HandleRawAddQuote(self, msg, match):
+    def _HandleRawAddQuote(self, channel, msg, match):
         """Handle "!quote rawadd ..." command."""
-        if not self._AuthorizeElevatedCommand(msg.sender):
+        if not self._AuthorizeElevatedCommand(channel, msg.sender):
             return True
 
         text = match.group(1).strip()
-        idx = self._AddQuoteToDb(text)
+        idx = self._AddQuoteToDb(channel, text)
         if idx:
             logging.info('User %r added quote #%s', msg.sender, idx)
         return True
 
-    def _HandleUpdateQuote(self, msg, match):
+    def _HandleUpdateQuote(self, channel, msg, match):
         """Handle "!quote update ..." command."""
-        if not self._AuthorizeElevatedCommand(msg.sender):
+        if not self._AuthorizeElevatedCommand(channel, msg.sender):
             return True
 
         index = match.group(1)
@@ -203,32 +222,34 @@ class Handler(irc.HandlerBase):
         cur.execute('UPDATE %s SET Text = ? WHERE CustomId = ?' %
                     self._table, (text, index,))
         if cur.rowcount != 1:
-            self._ReportError(msg.sender, "Failed to update quote #%s", index)
+            self._ReportError(channel, msg.sender,
+                              "Failed to update quote #%s", index)
             return True
         self._db.commit()
-        self._conn.SendMessage(self._channel, 'Updated quote #%s' % index)
+        self._conn.SendMessage(channel, 'Updated quote #%s' % index)
         logging.info('User %s updated quote #%s to: %s',
                      msg.sender, index, text)
         return True
 
-    def _HandleDelQuote(self, msg, match):
+    def _HandleDelQuote(self, channel, msg, match):
         """Handle "!quote del ..." command."""
-        if not self._AuthorizeElevatedCommand(msg.sender):
+        if not self._AuthorizeElevatedCommand(channel, msg.sender):
             return True
 
         index = match.group(1)
         cur = self._db.cursor()
         cur.execute('DELETE FROM %s WHERE CustomId = ?' % self._table, (index,))
         if cur.rowcount != 1:
-            self._ReportError(msg.sender, "Failed to remove quote #%s", index)
+            self._ReportError(channel, msg.sender,
+                              "Failed to remove quote #%s", index)
             return True
         self._db.commit()
-        self._conn.SendMessage(self._channel, 'Deleted quote #%s' % index)
+        self._conn.SendMessage(channel, 'Deleted quote #%s' % index)
         logging.info('User %r removed quote #%s', msg.sender, index)
         return True
 
-    def _HandleHelp(self):
+    def _HandleHelp(self, channel):
         """Handle "!quote help"."""
         self._conn.SendMessage(
-            self._channel, 'Quotes plugin documentation: https://goo.gl/h7028Q')
+            channel, 'Quotes plugin documentation: https://goo.gl/h7028Q')
         return True
@@ -1,15 +1,18 @@
-import bisect
+import collections
+import heapq
 import logging
+import math
+import operator
 import re
-import time
 
+from lib import clock as clock_lib
 from lib import config as config_lib
 from lib import event_queue
 from lib import irc
 
 class _Message(event_queue.Event):
-    def __init__(self, sender, text):
-        super().__init__(text)
+    def __init__(self, sender, text, timestamp=None):
+        super().__init__(text, timestamp)
         self.sender = sender
 
     def __repr__(self):
@@ -19,65 +22,330 @@ class _Message(event_queue.Event):
 
 class _MessagePool(event_queue.Queue):
     """Pool containing all events issued in the past "max_age" seconds."""
-    def __init__(self, max_age):
-        super().__init__(max_age)
-        self._idx_sender = {}
+    def __init__(self, max_age, clock=clock_lib.MONOTONIC):
+        super().__init__(max_age, clock)
+        self.max_age = max_age
+        # Number of messages in the pool by sender.
+        self._sender_counts = {}
 
-    def RemoveEvent(self, msg):
-        super().RemoveEvent(msg)
-        for idx, candidate in enumerate(self._idx_sender.get(msg.sender, [])):
-            self._idx_sender[msg.sender].pop(idx)
-            break
+    def _Forget(self, msg):
+        super()._Forget(msg)
+        count = self._sender_counts[msg.sender] - 1
+        if count:
+            self._sender_counts[msg.sender] = count
+        else:
+            del self._sender_counts[msg.sender]
 
     def CountBySender(self, sender):
         self._RemoveExpiredEvents()
-        return len(self._idx_sender.get(sender, []))
+        return self._sender_counts.get(sender, 0)
 
     def CountByText(self, text):
         return super().CountByData(text)
 
+    def TopTexts(self, k):
+        return super().TopData(k)
+
     def RecordMessage(self, msg):
+        self._sender_counts[msg.sender] = (
+            self._sender_counts.get(msg.sender, 0) + 1)
         super().RecordEvent(msg)
-        bisect.insort_right(self._idx_sender.setdefault(msg.sender, []), msg)
+
+
+class _BucketedMessagePool:
+    """Approximate _MessagePool with memory independent of the message rate.
+
+    Counts by sender and by text in event_queue.BucketedQueue windows, which
+    may count messages up to "bucket_width" seconds older than "max_age".
+    """
+    def __init__(self, max_age, bucket_width, clock=clock_lib.MONOTONIC):
+        self.max_age = max_age
+        self.bucket_width = bucket_width
+        self._by_sender = event_queue.BucketedQueue(max_age, bucket_width,
+                                                    clock)
+        self._by_text = event_queue.BucketedQueue(max_age, bucket_width, clock)
+
+    def CountBySender(self, sender):
+        return self._by_sender.CountByData(sender)
+
+    def CountByText(self, text):
+        return self._by_text.CountByData(text)
+
+    def CountAll(self):
+        return self._by_text.CountAll()
+
+    def CountKeys(self):
+        return self._by_text.CountKeys()
+
+    def TopTexts(self, k):
+        return self._by_text.TopData(k)
+
+    def RecordMessage(self, msg):
+        self._by_sender.RecordData(msg.sender, msg.timestamp)
+        self._by_text.RecordData(msg.data, msg.timestamp)
+
+
+class _SketchMessagePool(_BucketedMessagePool):
+    """_BucketedMessagePool counting by text in a fixed size sketch.
+
+    Texts are counted in an event_queue.SketchQueue, so a flood of distinct
+    texts doesn't grow memory. Counts by text may be higher than the exact
+    ones, never lower, and the distinct texts aren't counted: CountKeys()
+    returns None. Only the "top_k" texts with the highest counts can be
+    listed.
+    """
+    def __init__(self, max_age, bucket_width, width, depth, top_k,
+                 clock=clock_lib.MONOTONIC):
+        super().__init__(max_age, bucket_width, clock)
+        self._by_text = event_queue.SketchQueue(max_age, bucket_width, width,
+                                                depth, top_k, clock)
+
+    def CountKeys(self):
+        return None
+
+
+def _NewMessagePool(max_age, bucket_width=0, clock=clock_lib.MONOTONIC,
+                    sketch_width=0, sketch_depth=4, top_k=10):
+    if sketch_width:
+        # The sketch needs buckets, its memory grows with their number.
+        return _SketchMessagePool(max_age, bucket_width or max_age / 10,
+                                  sketch_width, sketch_depth, top_k, clock)
+    if bucket_width:
+        return _BucketedMessagePool(max_age, bucket_width, clock)
+    return _MessagePool(max_age, clock)
+
+
+class _Gcra:
+    """Generic cell rate algorithm, limiting the events of each key.
+
+    Allows bursts of up to "burst" events then "rate" events per "period"
+    seconds on average, like a token bucket per key, but only stores one
+    float per key: the theoretical arrival time (TAT) at which the key is
+    back to a full burst. A key past its TAT is no different from a key
+    never seen, so keys are evicted once past it. They are kept in the order
+    they were last recorded in, which is the order they become idle in for
+    a given rate, so eviction only looks at the least recently recorded
+    ones. Memory holds the keys recorded in the past burst x period / rate
+    seconds and each event is O(1) amortised.
+    """
+    def __init__(self):
+        # Map of key -> TAT, least recently recorded first.
+        self._tats = collections.OrderedDict()
+        # Seconds between events at the sustained rate.
+        self._interval = None
+        # How far ahead of the current time a TAT may go.
+        self._tolerance = None
+
+    def SetRate(self, rate, period, burst):
+        """Change the limits, keeping the state of the keys."""
+        self._interval = period / rate
+        self._tolerance = (burst - 1) * self._interval
+
+    def _Evict(self, now):
+        tats = self._tats
+        while tats:
+            key = next(iter(tats))
+            if tats[key] > now:
+                break
+            del tats[key]
+
+    def Allows(self, key, now):
+        """Returns True if an event for "key" at "now" is within limits."""
+        tat = self._tats.get(key)
+        return tat is None or tat - now <= self._tolerance
+
+    def Record(self, key, now):
+        """Record an allowed event for "key" at "now"."""
+        tat = self._tats.pop(key, now)
+        self._tats[key] = max(tat, now) + self._interval
+        self._Evict(now)
+
+    def CountKeys(self, now):
+        """Returns the number of keys not back to a full burst at "now"."""
+        self._Evict(now)
+        return len(self._tats)
+
+    def TopKeys(self, k, now):
+        """Returns up to "k" (key, events still counted) pairs at "now", the
+        keys furthest from a full burst first."""
+        self._Evict(now)
+        top = heapq.nlargest(k, self._tats.items(),
+                             key=operator.itemgetter(1))
+        return [(key, math.ceil((tat - now) / self._interval))
+                for key, tat in top]
+
+
+class _GcraPool:
+    """Per sender and per text _Gcra limits for the rate limiter.
+
+    Unlike the message pools, which count the messages of the past
+    "max_age" seconds, it holds a single float per sender and per text.
+    Only the enabled limits are recorded.
+    """
+    def __init__(self):
+        self.by_sender = None
+        self.by_text = None
+
+    def SetLimits(self, period, sender_rate, sender_burst, text_rate,
+                  text_burst):
+        """Set the limits, None to disable one."""
+        self.by_sender = self._SetLimit(self.by_sender, period, sender_rate,
+                                        sender_burst)
+        self.by_text = self._SetLimit(self.by_text, period, text_rate,
+                                      text_burst)
+
+    @staticmethod
+    def _SetLimit(gcra, period, rate, burst):
+        if not rate:
+            return None
+        if gcra is None:
+            gcra = _Gcra()
+        gcra.SetRate(rate, period, burst)
+        return gcra
+
+    def TopTexts(self, k, now):
+        if not self.by_text:
+            return []
+        return self.by_text.TopKeys(k, now)
+
+    def RecordMessage(self, msg):
+        if self.by_sender:
+            self.by_sender.Record(msg.sender, msg.timestamp)
+        if self.by_text:
+            self.by_text.Record(msg.data, msg.timestamp)
 
 
 class Handler(irc.HandlerBase):
     """IRC handler that limits the rate of incoming PRIVMSGs."""
 
+    # Characters of each text listed by the top command, to keep the reply
+    # within one chat message.
+    _TOP_TEXT_LENGTH = 40
+
+    CONFIG_SCHEMA = config_lib.Schema('RATELIMITER', {
+        'mode': config_lib.Option(str, 'window',
+                                  choices=('window', 'gcra')),
+        'max_age': config_lib.Option(int, required=True, minimum=1),
+        'bucket_width': config_lib.Option(float, 0, minimum=0),
+        'rate_per_sender': config_lib.Option(int, 0, minimum=0),
+        'rate_per_text': config_lib.Option(int, 0, minimum=0),
+        'burst_per_sender': config_lib.Option(int, 0, minimum=0),
+        'burst_per_text': config_lib.Option(int, 0, minimum=0),
+        'text_sketch_width': config_lib.Option(int, 0, minimum=0),
+        'text_sketch_depth': config_lib.Option(int, 4, minimum=1),
+        'top_texts': config_lib.Option(int, 10, minimum=1),
+        'top_command': config_lib.Option(str, ''),
+        'text_filter': config_lib.Option(str, ''),
+        'debug': config_lib.Option(bool, False),
+    })
+
     def __init__(self, conn, config):
         super().__init__(conn)
-        self._cfg = config_lib.GetSection(config, 'RATELIMITER')
-        self._pool = _MessagePool(self._cfg.getint('max_age'))
-        self._sender_rate = self._cfg.getint('rate_per_sender') or None
-        self._text_rate = self._cfg.getint('rate_per_text') or None
-        self._text_filter = self._cfg.get('text_filter') or None
-        if self._text_filter:
-            self._text_filter = re.compile(self._text_filter)
+        self._pool = None
+        # What the pool was created for, see ApplyConfig().
+        self._pool_layout = None
+        self.ApplyConfig(config)
+
+    def ApplyConfig(self, config):
+        # Rates can be tuned live, the recorded messages are only dropped if
+        # the mode or how a window counts them changed.
+        cfg = config_lib.GetSection(config, self.CONFIG_SCHEMA)
+        text_filter = cfg['text_filter'] and re.compile(cfg['text_filter'])
+        self._gcra = cfg['mode'] == 'gcra'
+        if self._gcra:
+            layout = ('gcra',)
+        else:
+            layout = ('window', cfg['max_age'], cfg['bucket_width'],
+                      cfg['text_sketch_width'], cfg['text_sketch_depth'],
+                      cfg['top_texts'])
+        if layout != self._pool_layout:
+            if self._gcra:
+                self._pool = _GcraPool()
+            else:
+                self._pool = _NewMessagePool(
+                    cfg['max_age'], cfg['bucket_width'], self._conn.clock,
+                    cfg['text_sketch_width'], cfg['text_sketch_depth'],
+                    cfg['top_texts'])
+            self._pool_layout = layout
+        self._sender_rate = cfg['rate_per_sender'] or None
+        self._text_rate = cfg['rate_per_text'] or None
+        if self._gcra:
+            # Bursts default to the rate, like the windows allow.
+            self._pool.SetLimits(
+                cfg['max_age'],
+                self._sender_rate,
+                cfg['burst_per_sender'] or self._sender_rate,
+                self._text_rate,
+                cfg['burst_per_text'] or self._text_rate)
+        self._text_filter = text_filter or None
+        self._top_texts = cfg['top_texts']
+        self._top_command = cfg['top_command'].lower() or None
+        self._debug = cfg['debug']
 
     def _Log(self, *args):
-        if self._cfg.getboolean('debug'):
+        if self._debug:
             logging.debug(*args)
 
     def HandlePRIVMSG(self, msg):
-        parts = irc.SplitPRIVMSG(msg)
-        if len(parts) < 2 or not parts[1]:
+        # Looks at every chat message, not just some commands.
+        chat = irc.ParseChatMessage(msg)
+        if chat is None:
             logging.warning('Got invalid PRIVMSG: %r', msg)
             return False
+        return self.HandleChat(chat)
 
-        msg = _Message(msg.sender, parts[1])
+    def HandleChat(self, chat):
+        if not chat.text:
+            return False
+        if self._top_command and chat.command.lower() == self._top_command:
+            return self._HandleTopCommand(chat)
+
+        msg = _Message(chat.sender, chat.text, self._conn.clock())
         # If a filter is defined then any message not matching is ignored.
         if self._text_filter and not self._text_filter.match(msg.data):
             return False
 
-        if (self._sender_rate and
-            self._pool.CountBySender(msg.sender) >= self._sender_rate):
+        if self._SenderOverLimit(msg):
             self._Log('REJECT:sender-over-limit:%s', msg)
             return True
-        if (self._text_rate and
-            self._pool.CountByText(msg.data) >= self._text_rate):
+        if self._TextOverLimit(msg):
             self._Log('REJECT:text-over-limit:%s', msg)
             return True
 
         self._Log('PASS:%s', msg)
         self._pool.RecordMessage(msg)
         return False
+
+    def _HandleTopCommand(self, chat):
+        """Lists the texts counting the most against "rate_per_text"."""
+        userlist = self._conn.GetUserList(chat.channel)
+        user = userlist.GetUser(chat.sender) if userlist is not None else None
+        if not user or not user.HasPrivilege(irc.PRIV_ELEVATED):
+            logging.warning('Unprivileged user %r asked for the top texts',
+                            chat.sender)
+            return True
+        if self._gcra:
+            top = self._pool.TopTexts(self._top_texts, self._conn.clock())
+        else:
+            top = self._pool.TopTexts(self._top_texts)
+        if not top:
+            self._conn.SendMessage(chat.channel, 'No texts counted.')
+            return True
+        self._conn.SendMessage(chat.channel, 'Top texts: %s' % ', '.join(
+            '%r (%d)' % (text[:self._TOP_TEXT_LENGTH], count)
+            for text, count in top))
+        return True
+
+    def _SenderOverLimit(self, msg):
+        if not self._sender_rate:
+            return False
+        if self._gcra:
+            return not self._pool.by_sender.Allows(msg.sender, msg.timestamp)
+        return self._pool.CountBySender(msg.sender) >= self._sender_rate
+
+    def _TextOverLimit(self, msg):
+        if not self._text_rate:
+            return False
+        if self._gcra:
+            return not self._pool.by_text.Allows(msg.data, msg.timestamp)
+        return self._pool.CountByText(msg.data) >= self._text_rate
@@ -1,60 +1,62 @@
+import asyncio
 import logging
-import requests
 import string
 
 from lib import config
 from lib import irc
+from lib import plugin_loader
+
+requests = plugin_loader.LazyImport('requests')
 
 
 class Handler(irc.HandlerBase):
     """IRC handler to print text from a given URL."""
 
+    # Blocks on fetching the URL, run it on its own thread.
+    INDEPENDENT = True
+
+    CONFIG_SCHEMA = config.Schema('READ_URL', {
+        'command': config.Option(required=True),
+        'url': config.Option(required=True),
+    })
+
     def __init__(self, conn, conf):
         super().__init__(conn)
-        self._channel = conf['CONNECTION']['channel'].lower()
 
-        read_url_section = config.GetSection(conf, 'read_url')
-        if 'command' not in read_url_section:
-            raise Exception('"command" not found in READ_URL config section')
+        read_url_section = config.GetSection(conf, self.CONFIG_SCHEMA)
         self._command = read_url_section['command']
-        if 'url' not in read_url_section:
-            raise Exception('"url" not found in READ_URL config section')
         self._url = read_url_section['url']
 
-    def HandlePRIVMSG(self, msg):
-        """The entry point into this plugin, handle a chat message."""
-        parts = irc.SplitPRIVMSG(msg)
-        if len(parts) < 2 or not parts[1]:
-            logging.warning('Got invalid PRIVMSG: %r', msg)
-            return False
+    def ChatCommands(self):
+        return (self._command,)
 
-        command = parts[1].strip()
-        if not command:
-            return False
-
-        if command == self._command:
-            self._HandleCommand(msg)
-            # The command was handled, even if it might have failed.
-            return True
+    def HandleChat(self, chat):
+        """The entry point into this plugin, handle a chat command."""
+        if chat.text == self._command:
+            return self._HandleCommand(chat.channel, chat.msg)
 
         return False
 
-    def _HandleCommand(self, msg):
-        """Handle the chat command by reading from an URL."""
+    async def _HandleCommand(self, channel, msg):
+        """Handle the chat command by reading from an URL.
+
+        Always returns True, the command was handled even if it failed.
+        """
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:6.0) '
                        'Gecko/20100101 Firefox/6.0'}
-        req = requests.get(self._url, headers=headers)
+        req = await asyncio.to_thread(requests.get, self._url, headers=headers)
         if req.status_code != 200:
             logging.error('URL request failed: %s %s',
                           req.status_code, req.reason)
-            return
+            return True
         text = req.text.strip()
         if not text:
             # No meaningful text, skip.
-            return
+            return True
         if '\n' in text:
             logging.error('got page with newlines, rejecting: %r', text)
-            return
+            return True
         self._conn.SendMessage(
-            self._channel,
+            channel,
             string.Template(text).substitute(username=msg.sender))
+        return True
@@ -1,5 +1,3 @@
-import logging
-import requests
 import string
 import urllib.parse
 
@@ -10,37 +8,31 @@ from lib import irc
 class Handler(irc.HandlerBase):
     """IRC handler to print some text based on configurable template."""
 
+    CONFIG_SCHEMA = config.Schema('SHOW_TEXT', {
+        'command': config.Option(required=True),
+        'template': config.Option(required=True),
+    })
+
     def __init__(self, conn, conf):
         super().__init__(conn)
-        self._channel = conf['CONNECTION']['channel'].lower()
 
-        show_text_section = config.GetSection(conf, 'show_text')
-        if 'command' not in show_text_section:
-            raise Exception('"command" not found in SHOW_TEXT config section')
+        show_text_section = config.GetSection(conf, self.CONFIG_SCHEMA)
         self._command = show_text_section['command']
-        if 'template' not in show_text_section:
-            raise Exception('"template" not found in SHOW_TEXT config section')
         self._template = show_text_section['template']
 
-    def HandlePRIVMSG(self, msg):
-        """The entry point into this plugin, handle a chat message."""
-        parts = irc.SplitPRIVMSG(msg)
-        if len(parts) < 2 or not parts[1]:
-            logging.warning('Got invalid PRIVMSG: %r', msg)
-            return False
-
-        command = parts[1].strip().split(' ', maxsplit=1)
-        if not command[0]:
-            return False
+    def ChatCommands(self):
+        return (self._command,)
 
-        if command[0] == self._command:
-            self._HandleCommand(msg, command[1])
+    def HandleChat(self, chat):
+        """The entry point into this plugin, handle a chat command."""
+        if chat.command == self._command:
+            self._HandleCommand(chat.channel, chat.msg, chat.args)
             # The command was handled, even if it might have failed.
             return True
 
         return False
 
-    def _HandleCommand(self, msg, args):
+    def _HandleCommand(self, channel, msg, args):
         """Handle the chat command by printing some formatted text."""
         # Substitution dictionary.
         vars = {
@@ -49,5 +41,5 @@ class Handler(irc.HandlerBase):
             'sender': msg.sender,
         }
         self._conn.SendMessage(
-            self._channel,
+            channel,
             string.Template(self._template).substitute(**vars))
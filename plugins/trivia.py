@@ -34,6 +34,19 @@ class _RandomIterator:
         return self._elements[self._idx - 1]
 
 
+class _Game:
+    """State of the trivia game played on one channel."""
+
+    def __init__(self, questions):
+        self._questions = questions
+        self.Restart()
+
+    def Restart(self):
+        """(re)start going over the question list."""
+        self.iter = _RandomIterator(self._questions)
+        self.active_question = None
+
+
 class Handler(irc.HandlerBase):
     """IRC handler to implement a trivia bot."""
 
@@ -41,19 +54,22 @@ class Handler(irc.HandlerBase):
     _QUESTION_RE = re.compile(r'^!trivia$', flags=re.IGNORECASE)
     _ANSWER_RE = re.compile(r'^!answer +([a-zA-Z])$', flags=re.IGNORECASE)
 
+    CONFIG_SCHEMA = config.Schema('TRIVIA', {
+        'questions_file': config.Option(required=True),
+        'report_errors': config.Option(bool, False),
+        'use_whisper': config.Option(bool, False),
+    })
+
     def __init__(self, conn, conf):
         super().__init__(conn)
-        self._channel = conf['CONNECTION']['channel'].lower()
-        trivia_section = config.GetSection(conf, 'trivia')
-        if 'questions_file' not in trivia_section:
-            raise Exception('"questions_file" not found in TRIVIA config '
-                            'section')
-        self._report_errors = trivia_section.getboolean('report_errors')
-        self._use_whisper = trivia_section.getboolean('use_whisper')
+        trivia_section = config.GetSection(conf, self.CONFIG_SCHEMA)
+        self._report_errors = trivia_section['report_errors']
+        self._use_whisper = trivia_section['use_whisper']
         self._questions = self._ParseQuestions(trivia_section['questions_file'])
         if not self._questions:
             raise Exception('Question list is empty.')
-        self._Restart()
+        # Games being played, by channel.
+        self._games = {}
         logging.info('plugin ready')
 
     @staticmethod
@@ -102,33 +118,40 @@ class Handler(irc.HandlerBase):
 
         return questions
 
-    def _Restart(self):
-        """(re)start going over the question list."""
-        self._iter = _RandomIterator(self._questions)
-        self._active_question = None
-
-    def HandlePRIVMSG(self, msg):
-        """The entry point into this plugin, handle a chat message."""
-        parts = irc.SplitPRIVMSG(msg)
-        if len(parts) < 2 or not parts[1]:
-            logging.warning('Got invalid PRIVMSG: %r', msg)
-            return False
-
-        command = parts[1].strip()
-        if not command:
-            return False
-
-        match = self._QUESTION_RE.match(command)
+    def GetReloadState(self):
+        return {channel: game.active_question
+                for channel, game in self._games.items()
+                if game.active_question}
+
+    def SetReloadState(self, state):
+        # Questions still being answered carry on, even if they are no longer
+        # in the (possibly changed) questions file.
+        for channel, question in (state or {}).items():
+            self._GetGame(channel).active_question = question
+
+    def _GetGame(self, channel):
+        game = self._games.get(channel)
+        if game is None:
+            game = self._games[channel] = _Game(self._questions)
+        return game
+
+    def ChatCommands(self):
+        return ('!trivia', '!answer')
+
+    def HandleChat(self, chat):
+        """The entry point into this plugin, handle a chat command."""
+        match = self._QUESTION_RE.match(chat.text)
         if match:
-            return self._HandleQuestion(msg)
+            return self._HandleQuestion(chat.channel, chat.msg)
 
-        match = self._ANSWER_RE.match(command)
+        match = self._ANSWER_RE.match(chat.text)
         if match:
-            return self._HandleAnswer(msg, match)
+            return self._HandleAnswer(chat.channel, chat.msg, match)
 
         return False
 
-    def _ReportError(self, recipient, fmt, *args, level=logging.WARNING):
+    def _ReportError(self, channel, recipient, fmt, *args,
+                     level=logging.WARNING):
         if level is not None:
             logging.log(level, fmt, *args)
         if self._report_errors:
@@ -137,7 +160,7 @@ class Handler(irc.HandlerBase):
             else:
                 # Send a nicely formatted chat (public) message with the
                 # user as a prefix.
-                self._conn.SendMessage(self._channel,
+                self._conn.SendMessage(channel,
                                        ''.join((recipient, ': ', fmt % args)))
 
     @staticmethod
@@ -147,34 +170,36 @@ class Handler(irc.HandlerBase):
         return ('%s %s. Type "!answer <letter>".' %
                 (question.question, ' | '.join(choices)))
 
-    def _HandleQuestion(self, msg):
+    def _HandleQuestion(self, channel, msg):
         """Handle "!trivia" command to ask a new question."""
-        if not self._active_question:
+        game = self._GetGame(channel)
+        if not game.active_question:
             # New question.
-            self._active_question = next(self._iter, None)
-            if not self._active_question:
+            game.active_question = next(game.iter, None)
+            if not game.active_question:
                 # Ran out of questions, restart.
                 logging.info("Exhausted all questions. Starting over.")
-                self._Restart()
-                self._active_question = next(self._iter)
+                game.Restart()
+                game.active_question = next(game.iter)
         self._conn.SendMessage(
-            self._channel, self._FormatQuestion(self._active_question))
+            channel, self._FormatQuestion(game.active_question))
         return True
 
-    def _HandleAnswer(self, msg, match):
+    def _HandleAnswer(self, channel, msg, match):
         """Handle "!answer <choice-id>" command."""
-        if not self._active_question:
-            self._ReportError(msg.sender, 'Answer given but no trivia question '
-                              'is currently active.')
+        game = self._GetGame(channel)
+        if not game.active_question:
+            self._ReportError(channel, msg.sender, 'Answer given but no trivia '
+                              'question is currently active.')
             return True
 
         choice = match.group(1).strip().upper()
         choice = ord(choice) - ord('A')
-        if choice == self._active_question.correct_answer_idx:
+        if choice == game.active_question.correct_answer_idx:
             self._conn.SendMessage(
-                self._channel,
+                channel,
                 msg.sender + ': You are correct, congratulations! To continue '
                 'type !trivia')
-            self._active_question = None
+            game.active_question = None
         # Don't do anything if the answer is wrong.
         return True
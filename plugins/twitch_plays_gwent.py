@@ -4,6 +4,7 @@ TwitchPlays IRC command handler for Gwent Card Game.
 See docs/TwitchPlays_Gwent.txt.
 """
 
+from lib import config as config_lib
 from lib import event_queue
 from lib import keygen
 from lib import twitch_plays
@@ -35,29 +36,35 @@ class Handler(twitch_plays.Handler):
                                               hold_time=0.2),
         'change-leader': lambda: keygen.SendKey(keygen.VirtualKey(keygen.VK_X),
                                                 hold_time=0.2),
-        # This is just a placeholder, the actual functor is set later.
-        'pass': None,
+        # Only sent once _DecideToPass() agrees.
+        'pass': lambda: keygen.SendKey(keygen.VirtualKey(keygen.VK_SPACE),
+                                       hold_time=2),
     }
 
     def __init__(self, conn, config):
         # Need to use an event queue to decide how many times "pass" was issued
         # within a window of time (60 seconds).
-        self._cmd_queue = event_queue.Queue(max_age=_MAX_AGE)
-        # Make a copy of the command handlers and set the "pass" handler.
-        commands = dict(self._COMMANDS)
-        commands['pass'] = self._DecideToPass
-        super().__init__(conn, config, commands)
+        section = config_lib.GetSection(config, self.CONFIG_SCHEMA)
+        self._cmd_queue = event_queue.NewQueue(self._MAX_AGE,
+                                               section['vote_bucket_width'],
+                                               conn.clock)
+        super().__init__(conn, config, self._COMMANDS)
 
-    def HandleCommand(self, command):
+    def HandleCommand(self, channel, command):
         # If the command is valid, record it.
         if command in self._COMMANDS:
-            self._cmd_queue.RecordEvent(event_queue.Event(command))
-        return super().HandleCommand(command)
+            event = event_queue.Event(command, self._conn.clock())
+            self._cmd_queue.RecordEvent(event)
+        # The decision is taken here rather than in the "pass" key function as
+        # those run outside of the IRC thread.
+        if command == 'pass' and not self._DecideToPass():
+            return True
+        return super().HandleCommand(channel, command)
 
     def _DecideToPass(self):
         count_all = self._cmd_queue.CountAll()
         # If there are a minimum of 10 commands in the last minute and the
         # number of "pass" commands is at least 80% of them, then do pass.
-        if (count_all >= _MIN_PASS_COMMANDS and
-            self._cmd_queue.CountByData('pass') / count_all > _PASS_PERCENT):
-            keygen.SendKey(keygen.VirtualKey(keygen.VK_SPACE), hold_time=2)
+        return (count_all >= self._MIN_PASS_COMMANDS and
+                self._cmd_queue.CountByData('pass') / count_all >
+                self._PASS_PERCENT)